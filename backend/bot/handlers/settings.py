@@ -8,13 +8,14 @@ from telegram.ext import ContextTypes
 from services.ai.manager import AIProviderManager
 
 
-from utils.db_config import get_db, get_settings
+from utils.db_config import get_db, get_settings, get_settings_snapshot
+from database.repositories import SettingsRepository, AIProviderRepository, KnowledgeRepository
 
 logger = logging.getLogger(__name__)
 
 
 def _check_access(user_id, context):
-    config = get_settings()
+    config = get_settings_snapshot()
     return user_id in set(config.get("allowed_manager_ids", []))
 
 
@@ -45,7 +46,7 @@ async def _show_settings_menu(target, context, edit=False):
         models_count = len(p.get("models", []))
         lines.append(f"{status} <b>{p['display_name']}</b>: {keys} ключей, модель: {model} ({models_count} доступно)")
 
-    kb_count = db.knowledge_base.count_documents({}) if db else 0
+    kb_count = await KnowledgeRepository().count()
     lines.append(f"\nБаза знаний: {kb_count} статей")
 
     text = "\n".join(lines)
@@ -90,7 +91,7 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data == "cfg:toggle_ai":
         new_val = not config.get("ai_enabled", True)
-        db.settings.update_one({}, {"$set": {"ai_enabled": new_val}})
+        await SettingsRepository().update({"ai_enabled": new_val})
         context.application.bot_data["_config"]["ai_enabled"] = new_val
         await query.answer(f"AI {'включен' if new_val else 'выключен'}")
         await _show_settings_menu(query.message, context, edit=True)
@@ -100,7 +101,7 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         provider = ai_manager.get_provider(name)
         if provider:
             new_val = not provider.get("enabled", False)
-            ai_manager.set_enabled(name, new_val)
+            await AIProviderRepository().update(name, {"$set": {"enabled": new_val}})
             await query.answer(f"{provider['display_name']} {'включен' if new_val else 'выключен'}")
         await _show_settings_menu(query.message, context, edit=True)
 
@@ -118,13 +119,14 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith("cfg:test:"):
         name = data.split(":", 2)[2]
         await query.answer("Тестирование...")
-        result = ai_manager.test_connection(name)
+        result = await ai_manager.atest_connection(name)
         if result.get("ok"):
             count = result.get("count", len(result.get("models", [])))
             if result.get("models"):
-                db.ai_providers.update_one({"name": name}, {"$set": {"models": result["models"]}})
+                update = {"models": result["models"]}
                 if not ai_manager.get_provider(name).get("selected_model"):
-                    db.ai_providers.update_one({"name": name}, {"$set": {"selected_model": result["models"][0]}})
+                    update["selected_model"] = result["models"][0]
+                await AIProviderRepository().update(name, {"$set": update})
             await query.message.reply_text(f"✅ {name}: Соединение есть! Доступно моделей: {count}")
         else:
             await query.message.reply_text(f"❌ {name}: {result.get('error', 'Ошибка')}")
@@ -132,14 +134,14 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("cfg:setactive:"):
         name = data.split(":", 2)[2]
-        ai_manager.set_active_provider(name)
+        await SettingsRepository().update({"active_provider": name})
         context.application.bot_data["_config"]["active_provider"] = name
         await query.answer(f"Активный: {name}")
         await _show_settings_menu(query.message, context, edit=True)
 
     elif data == "cfg:kb_menu":
         await query.answer()
-        articles = list(db.knowledge_base.find({}).sort("updated_at", -1).limit(10))
+        articles = await KnowledgeRepository().list(limit=10)
         lines = ["<b>База знаний AI</b>\n"]
         if articles:
             for i, a in enumerate(articles, 1):
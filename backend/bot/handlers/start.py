@@ -8,17 +8,17 @@ from telegram.ext import ContextTypes
 logger = logging.getLogger(__name__)
 
 
-from utils.db_config import get_settings
+from utils.db_config import get_settings_snapshot
 
 def _check_access(user_id):
-    config = get_settings()
+    config = get_settings_snapshot()
     allowed = set(config.get("allowed_manager_ids", []))
     return user_id in allowed
 
 
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    config = get_settings()
+    config = get_settings_snapshot()
     service_name = config.get("service_name", "Решала support")
     mini_app_url = config.get("miniapp_url", "")
     allowed_managers = config.get("allowed_manager_ids", [])
@@ -110,7 +110,7 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    config = get_settings()
+    config = get_settings_snapshot()
 
     if not _check_access(user_id):
         await update.message.reply_text("Напишите ваше сообщение — менеджер ответит здесь.")
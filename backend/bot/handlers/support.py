@@ -2,7 +2,7 @@ import logging
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from utils.db_config import get_settings
+from utils.db_config import get_support_group_id
 from utils.support_common import check_access
 from bot.handlers.support_client import (
     handle_client_message,
@@ -38,8 +38,7 @@ async def dispatch_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if handled:
             return
 
-    config = get_settings()
-    if config.get("support_group_id"):
+    if get_support_group_id():
         await handle_client_message(update, context)
     else:
         logger.warning("dispatch_message: support_group_id not configured!")
@@ -1,16 +1,28 @@
+import re
 import logging
 import asyncio
 from datetime import datetime, timezone
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from services.ai.manager import AIProviderManager
+from services.ai.prompts import get_bot_prompt, system_messages
+from services.ai.token_budget import Section, fit, message_tokens, prompt_budget
+from services.ai.conversation import history_window, overflow, summarize
+from services.ai.routing import FAST, classify
+from services.ai.answer_cache import (
+    answer_cache, user_state_class, user_facts, mentions_user_facts, DEFAULT_TTL as DEFAULT_CACHE_TTL,
+)
 
 from utils.support_common import (
     build_support_header, format_bytes, format_user_context, get_topic_name, 
     check_access, should_escalate, detect_subscription_link, 
     TOPIC_OPEN, TOPIC_ESCALATED, TOPIC_SUSPICIOUS, TOPIC_CLOSED
 )
-from utils.db_config import get_db, get_settings, get_support_group_id
+from utils.db_config import get_db, get_settings_snapshot, get_support_group_id
+from database.repositories import (
+    TicketRepository, KnowledgeRepository, TicketEventRepository,
+    EVENT_CREATE, EVENT_ESCALATE, EVENT_CLOSE,
+)
 from utils.bedolaga_api import fetch_bedolaga_balance, fetch_bedolaga_deposits
 from utils.remnawave_api import fetch_user_data
 from bot.keyboards import client_keyboard, build_support_keyboard, confirm_client_keyboard
@@ -36,8 +48,43 @@ def save_to_conversation(context, role: str, content: str):
     if len(context.user_data["ai_history"]) > 20:
         context.user_data["ai_history"] = context.user_data["ai_history"][-20:]
 
+# Пользователи, чья история сейчас сжимается в резюме (в памяти: флаг не должен пережить рестарт)
+_compacting = set()
+
+def schedule_history_compaction(context, ai_manager: AIProviderManager, user_id: int, window: int):
+    """Если сверх окна накопилось достаточно реплик — сжимаем их в резюме в фоне."""
+    turns = overflow(context.user_data.get("ai_history", []), window)
+    if not turns or user_id in _compacting:
+        return
+    _compacting.add(user_id)
+    context.application.create_task(_compact_history(context, ai_manager, user_id, turns))
+
+async def _compact_history(context, ai_manager: AIProviderManager, user_id: int, turns: list):
+    try:
+        summary = await summarize(ai_manager, context.user_data.get("ai_summary", ""), turns, clean=filter_ai_thinking)
+        if not summary:
+            return
+        context.user_data["ai_summary"] = summary
+        # Пока шло сжатие, могли добавиться новые реплики — убираем только сжатые
+        compacted = {(t.get("timestamp"), t["role"]) for t in turns}
+        context.user_data["ai_history"] = [
+            m for m in context.user_data.get("ai_history", []) if (m.get("timestamp"), m["role"]) not in compacted
+        ]
+        topic_id = context.user_data.get("topic_id")
+        if topic_id:
+            await TicketRepository().update_by_topic(topic_id, {"$set": {
+                "conversation_summary": summary,
+                "conversation_summary_at": datetime.now(timezone.utc),
+            }})
+        logger.info(f"[AI SUMMARY] user {user_id}: {len(turns)} turns compacted")
+    except Exception as e:
+        logger.warning(f"[AI SUMMARY] compaction failed for user {user_id}: {e}")
+    finally:
+        _compacting.discard(user_id)
+
 def clear_conversation(context):
     context.user_data.pop("ai_history", None)
+    context.user_data.pop("ai_summary", None)
     context.user_data.pop("user_context", None)
     context.user_data.pop("is_suspicious", None)
     context.user_data.pop("has_provided_proof", None)
@@ -46,25 +93,88 @@ def filter_ai_thinking(text: str) -> str:
     """Удаляет теги <think>...</think> и подобные из ответа AI"""
     if not text:
         return text
-    import re
     text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL | re.IGNORECASE)
     text = re.sub(r'<thinking>.*?</thinking>', '', text, flags=re.DOTALL | re.IGNORECASE)
     text = re.sub(r'<thought>.*?</thought>', '', text, flags=re.DOTALL | re.IGNORECASE)
     text = re.sub(r'\n{3,}', '\n\n', text)
     return text.strip()
 
-async def get_ai_reply(context, user_message: str, user_id: int, user_name: str = "") -> str:
+# Незакрытый блок размышлений в недописанном ответе — скрываем до конца
+_OPEN_THINKING = re.compile(r'<(think|thinking|thought)>(?:(?!</\1>).)*$', re.DOTALL | re.IGNORECASE)
+# Начало тега, который ещё не дописан целиком ("<thi")
+_PARTIAL_TAG = re.compile(r'<[a-zA-Z/]{0,9}$')
+
+
+def visible_ai_text(partial: str) -> str:
+    """Видимая часть недописанного ответа AI: как filter_ai_thinking, плюс без незакрытых блоков."""
+    text = _OPEN_THINKING.sub('', partial or '')
+    text = _PARTIAL_TAG.sub('', text)
+    return filter_ai_thinking(text)
+
+
+# Telegram ограничивает частоту правок сообщения — не чаще раза в столько секунд
+STREAM_EDIT_INTERVAL = 1.0
+STREAM_PLACEHOLDER = "💭 …"
+TELEGRAM_TEXT_LIMIT = 4096
+
+
+class StreamingReply:
+    """
+    Ответ клиенту, который дописывается по мере генерации: плейсхолдер,
+    затем редкие edit_message_text с уже видимым текстом, в конце — финальный
+    текст с клавиатурой. Ошибки правок не мешают финальному ответу.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.sent = None
+        self._shown = ""
+        self._last_edit = 0.0
+
+    async def start(self):
+        try:
+            self.sent = await self.message.reply_text(STREAM_PLACEHOLDER)
+            self._last_edit = asyncio.get_running_loop().time()
+        except Exception as e:
+            logger.warning(f"stream placeholder: {e}")
+
+    async def update(self, partial: str):
+        if self.sent is None:
+            return
+        text = visible_ai_text(partial)[:TELEGRAM_TEXT_LIMIT]
+        now = asyncio.get_running_loop().time()
+        if not text or text == self._shown or now - self._last_edit < STREAM_EDIT_INTERVAL:
+            return
+        self._last_edit = now
+        try:
+            await self.sent.edit_text(text + " ▍")
+            self._shown = text
+        except Exception as e:
+            logger.debug(f"stream edit: {e}")
+
+    async def finish(self, text: str, reply_markup=None):
+        if self.sent is not None:
+            try:
+                await self.sent.edit_text(text, reply_markup=reply_markup)
+                return
+            except Exception as e:
+                logger.warning(f"stream final edit: {e}")
+                try: await self.sent.delete()
+                except Exception: pass
+        await self.message.reply_text(text, reply_markup=reply_markup)
+
+
+async def get_ai_reply(context, user_message: str, user_id: int, user_name: str = "", on_partial=None) -> str:
     """Получение ответа от AI"""
     db = get_db()
     if db is None:
         return None
 
-    config = get_settings()
+    config = get_settings_snapshot()
     if not config.get("ai_enabled", True):
         return None
 
     ai_manager = AIProviderManager(db)
-    service_name = config.get("service_name", "Решала support")
     
     # Получаем данные пользователя
     if "user_context" not in context.user_data:
@@ -85,8 +195,31 @@ async def get_ai_reply(context, user_message: str, user_id: int, user_name: str
     user_context = format_user_context(user_data, balance_data, has_provided_proof, main_bot_username)
     context.user_data["user_context"] = user_context
 
+    # Системный промпт: стабильный префикс, контекст пользователя и база знаний — хвостом
+    system_prompt = get_bot_prompt(config)
+
+    # Последние реплики как есть, всё более раннее — в резюме
+    window = history_window(config)
+    history = get_conversation_history(context, user_id, window)
+    summary = context.user_data.get("ai_summary", "")
+
+    # Кэш ответов — только для первой реплики: история меняет ответ
+    cache_key = None
+    if config.get("ai_cache_enabled", True) and not history and not summary:
+        cache_key = answer_cache.key(
+            user_message, config.get("kb_version", 0), system_prompt,
+            user_state_class(user_data, has_provided_proof),
+        )
+        cached = answer_cache.get(cache_key)
+        if cached:
+            logger.info(f"[AI CACHE] hit for user {user_id}")
+            save_to_conversation(context, "user", user_message)
+            save_to_conversation(context, "assistant", cached)
+            return cached
+
     # База знаний
-    kb_context = ""
+    kb_parts = []
+    kb_score = None
     try:
         # Берем все слова длиннее 3 символов из сообщения для поиска
         import re
@@ -95,60 +228,75 @@ async def get_ai_reply(context, user_message: str, user_id: int, user_name: str
         if search_words:
             # Ищем статьи, где есть хотя бы одно из слов в заголовке, контенте или категории
             # Ограничиваем до 3 самых релевантных статей, чтобы не раздувать промпт
-            regex_query = "|".join(search_words)
-            articles = list(db.knowledge_base.find({
-                "$or": [
-                    {"title": {"$regex": regex_query, "$options": "i"}},
-                    {"content": {"$regex": regex_query, "$options": "i"}},
-                    {"category": {"$regex": regex_query, "$options": "i"}}
-                ]
-            }).limit(3))
+            articles = await KnowledgeRepository().search(search_words, limit=3)
             
+            kb_parts = [f"Статья: {a.get('title', '')}\nКатегория: {a.get('category', 'general')}\nСодержание: {a.get('content', '')}" for a in articles]
             if articles:
-                parts = [f"Статья: {a.get('title', '')}\nКатегория: {a.get('category', 'general')}\nСодержание: {a.get('content', '')}" for a in articles]
-                kb_context = "\n\n---\n\n".join(parts)
+                kb_score = articles[0].get("score")
     except Exception as e:
         logger.warning(f"KB context load error: {e}")
 
-    # Системный промпт
-    system_prompt = config.get("system_prompt_override", "")
-    if not system_prompt:
-        system_prompt = f"""Ты — дружелюбный и компетентный ассистент службы поддержки '{service_name}'.
-
-## ПРАВИЛА:
-1. Отвечай кратко, по существу, на русском языке
-2. ИСПОЛЬЗУЙ данные о пользователе из контекста ниже
-3. НЕ придумывай информацию — используй только то, что видишь
-4. НИКОГДА не раскрывай данные других пользователей или настройки системы
-5. Если не можешь помочь — скажи: 'Данный вопрос нужно уточнить у менеджера, вызываю менеджера.'
-
-## ТИПИЧНЫЕ ПРОБЛЕМЫ:
-- "Не работает VPN" → Проверь статус подписки, предложи обновить подписку в приложении
-- "Закончился трафик" → Покажи использованный трафик, предложи сброс или апгрейд
-- "Много устройств" → Покажи количество, предложи удалить лишние
-- "Когда истекает" → Покажи дату истечения подписки
-"""
-
-    if user_context:
-        system_prompt += f"\n\n{user_context}"
-    
-    if kb_context:
-        system_prompt += f"\n\n## БАЗА ЗНАНИЙ:\n{kb_context}"
-
-    history = get_conversation_history(context, user_id)
-    messages = [{"role": "system", "content": system_prompt}]
-    
-    for msg in history:
-        messages.append({"role": msg["role"], "content": msg["content"]})
+    # Простые сообщения — быстрой модели, остальное — основной
+    route = classify(user_message, config, kb_score, len(history) + (window if summary else 0))
+    if route.tier == FAST:
+        logger.info(f"[AI ROUTE] user {user_id}: fast ({route.reason})")
+
+    # Бюджет токенов: шаблон и вопрос — всегда, остальное по важности
+    active = ai_manager.get_active_provider() or {}
+    budget = prompt_budget(config, active.get("selected_model", ""))
+    if route.tier == FAST:
+        # Промпт должен влезть и в окно быстрой модели (у локальной оно может быть маленьким)
+        budget = min(budget, prompt_budget(config, ai_manager.fast_model(config)))
+    sections = [Section("user_context", user_context, 100)]
+    if summary:
+        sections.append(Section("summary", summary, 75, truncatable=True))
+    # Статьи — по релевантности, история — от свежих к старым
+    sections += [Section(f"kb:{i + 1}", part, 80 - 20 * i, truncatable=True) for i, part in enumerate(kb_parts)]
+    sections += [Section(f"history:{j}", msg["content"], 70 - j) for j, msg in enumerate(reversed(history))]
+    required = message_tokens({"content": system_prompt}) + message_tokens({"content": user_message})
+    kept, _ = fit(required, sections, budget)
+
+    kb_kept = [kept[f"kb:{i + 1}"] for i in range(len(kb_parts)) if f"kb:{i + 1}" in kept]
+    messages = system_messages(
+        system_prompt,
+        kept.get("user_context", ""),
+        f"## КРАТКОЕ СОДЕРЖАНИЕ ДИАЛОГА:\n{kept['summary']}" if "summary" in kept else "",
+        "## БАЗА ЗНАНИЙ:\n" + "\n\n---\n\n".join(kb_kept) if kb_kept else "",
+    )
+
+    # История — только непрерывный хвост: после первой выкинутой реплики старые не берём
+    recent = []
+    for j, msg in enumerate(reversed(history)):
+        if f"history:{j}" not in kept:
+            break
+        recent.append({"role": msg["role"], "content": msg["content"]})
+    messages.extend(reversed(recent))
     
     messages.append({"role": "user", "content": user_message})
     save_to_conversation(context, "user", user_message)
 
-    reply = ai_manager.chat(messages)
+    if on_partial is not None:
+        # Стриминг: on_partial получает весь накопленный сырой текст
+        parts = []
+        try:
+            async for chunk in ai_manager.astream(messages, route=route):
+                parts.append(chunk)
+                await on_partial("".join(parts))
+        except Exception as e:
+            logger.warning(f"AI stream interrupted: {e}")
+            # Оборванный ответ в кэш не кладём
+            cache_key = None
+        reply = "".join(parts).strip() or None
+    else:
+        reply = await ai_manager.achat(messages, route=route)
     
     if reply:
         reply = filter_ai_thinking(reply)
         save_to_conversation(context, "assistant", reply)
+        # В кэш — только ответ, верный для любого пользователя того же класса
+        if cache_key and not should_escalate(reply) and not mentions_user_facts(reply, user_facts(user_context, user_data)):
+            answer_cache.put(cache_key, reply, float(config.get("ai_cache_ttl", DEFAULT_CACHE_TTL)))
+        schedule_history_compaction(context, ai_manager, user_id, window)
     
     return reply
 
@@ -196,8 +344,8 @@ async def forward_media_to_support(update: Update, context: ContextTypes.DEFAULT
     return None, None
 
 async def handle_client_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    config = get_settings()
-    db = get_db()
+    config = get_settings_snapshot()
+    tickets = TicketRepository()
     support_group_id = get_support_group_id()
     service_name = config.get("service_name", "Решала support")
     
@@ -224,144 +372,137 @@ async def handle_client_message(update: Update, context: ContextTypes.DEFAULT_TY
     ai_disabled = False
     is_suspicious = False
     has_provided_proof = False
+    ticket_oid = None
 
     # Сначала пытаемся найти существующий тикет и восстановить состояние
-    if db is not None:
-        # Пытаемся найти по client_id или topic_id
-        # ВАЖНО: Исключаем закрытые тикеты (is_removed=True или status=closed)
-        ticket_query = {
-            "client_id": user_id, 
-            "is_removed": {"$ne": True},
-            "status": {"$ne": "closed"}
-        }
-        if thread_id:
-            ticket_query = {
-                "topic_id": thread_id, 
-                "is_removed": {"$ne": True},
-                "status": {"$ne": "closed"}
+    # Пытаемся найти по client_id или topic_id
+    # ВАЖНО: Исключаем закрытые тикеты (is_removed=True или status=closed)
+    if thread_id:
+        active_ticket = await tickets.find_live_by_topic(thread_id)
+    else:
+        active_ticket = await tickets.find_live_by_client(user_id)
+    if active_ticket:
+        ticket_oid = active_ticket["_id"]
+        ai_disabled = active_ticket.get("ai_disabled", False)
+        is_suspicious = active_ticket.get("status") == "suspicious"
+        has_provided_proof = bool(active_ticket.get("attachments"))
+        
+        # Синхронизируем context.user_data для совместимости с остальным кодом
+        context.user_data["is_suspicious"] = is_suspicious
+        context.user_data["has_provided_proof"] = has_provided_proof
+        # Резюме диалога хранится и в тикете — переживает потерю user_data
+        if active_ticket.get("conversation_summary") and not context.user_data.get("ai_summary"):
+            context.user_data["ai_summary"] = active_ticket["conversation_summary"]
+        
+        if not thread_id and active_ticket.get("topic_id"):
+            thread_id = active_ticket.get("topic_id")
+            topic_by_client[user_id] = {
+                "chat_id": support_group_id,
+                "message_thread_id": thread_id,
+                "topic_name": get_topic_name(user_name, active_ticket["status"]),
             }
-            
-        active_ticket = db.tickets.find_one(ticket_query)
-        if active_ticket:
-            ai_disabled = active_ticket.get("ai_disabled", False)
-            is_suspicious = active_ticket.get("status") == "suspicious"
-            has_provided_proof = bool(active_ticket.get("attachments"))
-            
-            # Синхронизируем context.user_data для совместимости с остальным кодом
-            context.user_data["is_suspicious"] = is_suspicious
-            context.user_data["has_provided_proof"] = has_provided_proof
-            
-            if not thread_id and active_ticket.get("topic_id"):
-                thread_id = active_ticket.get("topic_id")
-                topic_by_client[user_id] = {
-                    "chat_id": support_group_id,
-                    "message_thread_id": thread_id,
-                    "topic_name": get_topic_name(user_name, active_ticket["status"]),
-                }
-                thread_to_client[(support_group_id, thread_id)] = user_id
-                context.user_data["topic_id"] = thread_id
+            thread_to_client[(support_group_id, thread_id)] = user_id
+            context.user_data["topic_id"] = thread_id
+    
+    if not thread_id:
+        user_data = await fetch_user_data(user_id)
+        balance_data = await fetch_bedolaga_balance(user_id)
         
-        if not thread_id:
-            user_data = await fetch_user_data(user_id)
-            balance_data = await fetch_bedolaga_balance(user_id)
+        is_suspicious = user_data.get("not_found", False)
+        context.user_data["is_suspicious"] = is_suspicious
+        context.user_data["user_data_raw"] = user_data
+        context.user_data["balance_data"] = balance_data
+        context.user_data["has_provided_proof"] = False
+        
+        main_bot_username = config.get("main_bot_username", "")
+        context.user_data["user_context"] = format_user_context(user_data, balance_data, False, main_bot_username)
+        
+        topic_name = get_topic_name(user_name, "suspicious" if is_suspicious else "open")
+        
+        try:
+            topic = await context.bot.create_forum_topic(chat_id=support_group_id, name=topic_name[:128])
+            thread_id = topic.message_thread_id
+            context.user_data["topic_id"] = thread_id
             
-            is_suspicious = user_data.get("not_found", False)
-            context.user_data["is_suspicious"] = is_suspicious
-            context.user_data["user_data_raw"] = user_data
-            context.user_data["balance_data"] = balance_data
-            context.user_data["has_provided_proof"] = False
+            topic_by_client[user_id] = {"chat_id": support_group_id, "message_thread_id": thread_id, "topic_name": topic_name}
+            thread_to_client[(support_group_id, thread_id)] = user_id
             
-            main_bot_username = config.get("main_bot_username", "")
-            context.user_data["user_context"] = format_user_context(user_data, balance_data, False, main_bot_username)
+            user_info = user_data.get("user", {})
+            support_clients[user_id] = {
+                "user": user_info,
+                "subscription": user_data.get("subscription"),
+                "hwid_devices": user_data.get("devices", []),
+                "bedolaga_user": balance_data,
+                "is_suspicious": is_suspicious,
+            }
             
-            topic_name = get_topic_name(user_name, "suspicious" if is_suspicious else "open")
+            header_user_info = user_info or {"username": user.username, "first_name": user.first_name, "id": user.id, "telegramId": user.id}
+            header = build_support_header(header_user_info, balance_data, is_suspicious)
             
-            try:
-                topic = await context.bot.create_forum_topic(chat_id=support_group_id, name=topic_name[:128])
-                thread_id = topic.message_thread_id
-                context.user_data["topic_id"] = thread_id
-                
-                topic_by_client[user_id] = {"chat_id": support_group_id, "message_thread_id": thread_id, "topic_name": topic_name}
-                thread_to_client[(support_group_id, thread_id)] = user_id
-                
-                user_info = user_data.get("user", {})
-                support_clients[user_id] = {
-                    "user": user_info,
-                    "subscription": user_data.get("subscription"),
-                    "hwid_devices": user_data.get("devices", []),
-                    "bedolaga_user": balance_data,
-                    "is_suspicious": is_suspicious,
-                }
-                
-                header_user_info = user_info or {"username": user.username, "first_name": user.first_name, "id": user.id, "telegramId": user.id}
-                header = build_support_header(header_user_info, balance_data, is_suspicious)
-                
-                card_msg = await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=header, parse_mode="HTML", reply_markup=build_support_keyboard(user_id, user_info, balance_data, is_suspicious))
-                try: await context.bot.pin_chat_message(chat_id=support_group_id, message_id=card_msg.message_id) 
-                except: pass
-                
-                if db is not None:
-                    db.tickets.insert_one({
-                        "client_id": user_id,
-                        "client_name": user.first_name or user_name,
-                        "client_username": user.username,
-                        "topic_id": thread_id,
-                        "status": "suspicious" if is_suspicious else "open",
-                        "reason": "Пользователь не найден в системе" if is_suspicious else None,
-                        "user_data": user_data if not is_suspicious else None,
-                        "last_messages": [], "history": [], "attachments": [],
-                        "ai_disabled": False,
-                        "created_at": datetime.now(timezone.utc), "is_removed": False,
-                    })
-            except Exception as e:
-                logger.error(f"create topic: {e}")
-                await update.message.reply_text("Ошибка создания тикета.")
-                return
-
-    is_suspicious = context.user_data.get("is_suspicious", False)
-    has_provided_proof = context.user_data.get("has_provided_proof", False)
-    proof_received = False
+            card_msg = await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=header, parse_mode="HTML", reply_markup=build_support_keyboard(user_id, user_info, balance_data, is_suspicious))
+            try: await context.bot.pin_chat_message(chat_id=support_group_id, message_id=card_msg.message_id) 
+            except: pass
+            
+            ticket_oid = await tickets.insert({
+                "client_id": user_id,
+                "client_name": user.first_name or user_name,
+                "client_username": user.username,
+                "topic_id": thread_id,
+                "status": "suspicious" if is_suspicious else "open",
+                "reason": "Пользователь не найден в системе" if is_suspicious else None,
+                "user_data": user_data if not is_suspicious else None,
+                "last_messages": [], "attachments": [],
+                "ai_disabled": False,
+                "created_at": datetime.now(timezone.utc), "is_removed": False,
+            })
+            await TicketEventRepository().publish(EVENT_CREATE, ticket_oid, thread_id, "suspicious" if is_suspicious else "open")
+        except Exception as e:
+            logger.error(f"create topic: {e}")
+            await update.message.reply_text("Ошибка создания тикета.")
+            return
+
+    # Входящее (сообщение клиента, вложения, статус) пишется одной операцией до вызова AI:
+    # ответ модели может идти десятки секунд, а менеджер в Mini App должен видеть сообщение сразу
+    async with tickets.write_buffer(thread_id, ticket_oid) as ticket_writes:
+        is_suspicious = context.user_data.get("is_suspicious", False)
+        has_provided_proof = context.user_data.get("has_provided_proof", False)
+        proof_received = False
     
-    if text:
-        sub_link = detect_subscription_link(text)
-        if sub_link:
-            proof_received = True
-            if db is not None: db.tickets.update_one({"topic_id": thread_id}, {"$push": {"attachments": {"type": "subscription_link", "value": sub_link, "added_at": datetime.now(timezone.utc).isoformat()}}})
-            await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"📎 <b>Получена ссылка:</b>\n<code>{sub_link}</code>", parse_mode="HTML")
+        if text:
+            sub_link = detect_subscription_link(text)
+            if sub_link:
+                proof_received = True
+                ticket_writes.push("attachments", {"type": "subscription_link", "value": sub_link, "added_at": datetime.now(timezone.utc).isoformat()})
+                await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"📎 <b>Получена ссылка:</b>\n<code>{sub_link}</code>", parse_mode="HTML")
             
-    if update.message.photo:
-        proof_received = True
-        if db is not None: db.tickets.update_one({"topic_id": thread_id}, {"$push": {"attachments": {"type": "photo", "file_id": update.message.photo[-1].file_id, "added_at": datetime.now(timezone.utc).isoformat()}}})
-        if is_suspicious and not has_provided_proof:
-            await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text="📷 <b>Получен скриншот от подозрительного пользователя</b>", parse_mode="HTML")
-
-    if is_suspicious and proof_received and not has_provided_proof:
-        context.user_data["has_provided_proof"] = True
-        has_provided_proof = True
-        user_data = context.user_data.get("user_data_raw", {})
-        balance_data = context.user_data.get("balance_data", {})
-        main_bot_username = config.get("main_bot_username", "")
-        context.user_data["user_context"] = format_user_context(user_data, balance_data, True, main_bot_username)
+        if update.message.photo:
+            proof_received = True
+            ticket_writes.push("attachments", {"type": "photo", "file_id": update.message.photo[-1].file_id, "added_at": datetime.now(timezone.utc).isoformat()})
+            if is_suspicious and not has_provided_proof:
+                await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text="📷 <b>Получен скриншот от подозрительного пользователя</b>", parse_mode="HTML")
+
+        if is_suspicious and proof_received and not has_provided_proof:
+            context.user_data["has_provided_proof"] = True
+            has_provided_proof = True
+            user_data = context.user_data.get("user_data_raw", {})
+            balance_data = context.user_data.get("balance_data", {})
+            main_bot_username = config.get("main_bot_username", "")
+            context.user_data["user_context"] = format_user_context(user_data, balance_data, True, main_bot_username)
         
-        try: await context.bot.edit_forum_topic(chat_id=support_group_id, message_thread_id=thread_id, name=get_topic_name(user_name, "suspicious"))
-        except: pass
+            try: await context.bot.edit_forum_topic(chat_id=support_group_id, message_thread_id=thread_id, name=get_topic_name(user_name, "suspicious"))
+            except: pass
         
-        await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"🚨 <b>ВНИМАНИЕ!</b> Пользователь @{user_name} не найден, но предоставил данные. Требуется проверка.", parse_mode="HTML")
-        if db is not None: db.tickets.update_one({"topic_id": thread_id}, {"$set": {"status": "suspicious", "reason": "Пользователь не найден", "escalated_at": datetime.now(timezone.utc)}})
-
-    # Сохраняем сообщение клиента в историю БД
-    if text and db is not None and thread_id:
-        try:
-            db.tickets.update_one(
-                {"topic_id": thread_id},
-                {"$push": {"history": {
-                    "role": "user",
-                    "content": text,
-                    "timestamp": datetime.now(timezone.utc).isoformat()
-                }}}
-            )
-        except Exception as e:
-            logger.warning(f"Failed to save client message to DB history: {e}")
+            await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"🚨 <b>ВНИМАНИЕ!</b> Пользователь @{user_name} не найден, но предоставил данные. Требуется проверка.", parse_mode="HTML")
+            ticket_writes.set({"status": "suspicious", "reason": "Пользователь не найден", "escalated_at": datetime.now(timezone.utc)})
+            ticket_writes.event(EVENT_ESCALATE, "suspicious")
+
+        # Сохраняем сообщение клиента в историю БД
+        if text and thread_id:
+            ticket_writes.message({
+                "role": "user",
+                "content": text,
+                "timestamp": datetime.now(timezone.utc).isoformat()
+            })
 
     await forward_media_to_support(update, context, support_group_id, thread_id, user_name)
 
@@ -371,51 +512,50 @@ async def handle_client_message(update: Update, context: ContextTypes.DEFAULT_TY
     # 2. ИИ эскалировал тикет
     # 3. Менеджер вмешался в тикет
     should_reply = text.strip() and not ai_disabled
-    
+
     # Отладочные логи
     logger.info(f"[AI DECISION] user_id={user_id}, ai_disabled={ai_disabled}, should_reply={should_reply}, is_suspicious={is_suspicious}, has_provided_proof={has_provided_proof}, text={text[:50] if text else 'None'}")
-    
+
     if should_reply:
         ai_message = text if text.strip() else "[Пользователь прислал данные]"
-        ai_reply = await get_ai_reply(context, ai_message, user_id, user_name)
-        
+        streaming = StreamingReply(update.message)
+        if config.get("ai_streaming", True):
+            await streaming.start()
+        ai_reply = await get_ai_reply(context, ai_message, user_id, user_name,
+                                      on_partial=streaming.update if streaming.sent else None)
+    
         if ai_reply:
-            if should_escalate(ai_reply):
-                await update.message.reply_text(ai_reply, reply_markup=client_keyboard(is_suspicious))
-                
-                # Меняем название темы и статус только если НЕ подозрительный
-                if not is_suspicious:
-                    try: await context.bot.edit_forum_topic(chat_id=support_group_id, message_thread_id=thread_id, name=get_topic_name(user_name, "escalated"))
-                    except: pass
-                    await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"🔥 <b>Эскалация</b>: AI не смог ответить.\nAI: {ai_reply[:300]}", parse_mode="HTML")
-                    if db is not None: 
-                        db.tickets.update_one({"topic_id": thread_id}, {"$set": {"status": "escalated", "escalated_at": datetime.now(timezone.utc)}})
-                else:
-                    # Для подозрительных - просто уведомляем без смены статуса
-                    await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"⚠️ <b>AI не смог ответить подозрительному пользователю</b>\nAI: {ai_reply[:300]}", parse_mode="HTML")
-                
-                # Отключаем ИИ после эскалации в БД
-                if db is not None:
-                    db.tickets.update_one({"topic_id": thread_id}, {"$set": {"ai_disabled": True}})
-            else:
-                await update.message.reply_text(ai_reply, reply_markup=client_keyboard(is_suspicious))
-                await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"🤖 AI:\n{ai_reply[:3000]}")
+            # Ответ AI и эскалация — своей пачкой, после ответа
+            async with tickets.write_buffer(thread_id, ticket_oid) as ticket_writes:
+                if should_escalate(ai_reply):
+                    await streaming.finish(ai_reply, reply_markup=client_keyboard(is_suspicious))
             
-            # Сохраняем ответ ИИ в историю БД
-            if db is not None and thread_id:
-                try:
-                    db.tickets.update_one(
-                        {"topic_id": thread_id},
-                        {"$push": {"history": {
-                            "role": "ai",
-                            "content": ai_reply,
-                            "timestamp": datetime.now(timezone.utc).isoformat()
-                        }}}
-                    )
-                except Exception as e:
-                    logger.warning(f"Failed to save AI reply to DB history: {e}")
+                    # Меняем название темы и статус только если НЕ подозрительный
+                    if not is_suspicious:
+                        try: await context.bot.edit_forum_topic(chat_id=support_group_id, message_thread_id=thread_id, name=get_topic_name(user_name, "escalated"))
+                        except: pass
+                        await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"🔥 <b>Эскалация</b>: AI не смог ответить.\nAI: {ai_reply[:300]}", parse_mode="HTML")
+                        ticket_writes.set({"status": "escalated", "escalated_at": datetime.now(timezone.utc)})
+                        ticket_writes.event(EVENT_ESCALATE, "escalated")
+                    else:
+                        # Для подозрительных - просто уведомляем без смены статуса
+                        await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"⚠️ <b>AI не смог ответить подозрительному пользователю</b>\nAI: {ai_reply[:300]}", parse_mode="HTML")
+            
+                    # Отключаем ИИ после эскалации в БД
+                    ticket_writes.set({"ai_disabled": True})
+                else:
+                    await streaming.finish(ai_reply, reply_markup=client_keyboard(is_suspicious))
+                    await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"🤖 AI:\n{ai_reply[:3000]}")
+        
+                # Сохраняем ответ ИИ в историю БД
+                if thread_id:
+                    ticket_writes.message({
+                        "role": "ai",
+                        "content": ai_reply,
+                        "timestamp": datetime.now(timezone.utc).isoformat()
+                    })
         else:
-            await update.message.reply_text("Ваше сообщение принято.", reply_markup=client_keyboard(is_suspicious))
+            await streaming.finish("Ваше сообщение принято.", reply_markup=client_keyboard(is_suspicious))
     elif has_media and not text:
         await update.message.reply_text("Получил ваш файл.", reply_markup=client_keyboard(is_suspicious))
 
@@ -440,21 +580,21 @@ async def cancel_client_action_callback(update: Update, context: ContextTypes.DE
 async def call_manager_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer("Менеджер вызван!")
-    db = get_db()
+    tickets = TicketRepository()
     support_group_id = get_support_group_id()
     user_id = query.from_user.id
     
     # Пытаемся достать из памяти, если нет - из БД
     thread_id = context.user_data.get("topic_id")
-    if not thread_id and db is not None:
-        ticket = db.tickets.find_one({"client_id": user_id, "is_removed": {"$ne": True}})
+    if not thread_id:
+        ticket = await tickets.find_live_by_client(user_id)
         if ticket:
             thread_id = ticket.get("topic_id")
 
     is_suspicious = context.user_data.get("is_suspicious", False)
     # Если в памяти пусто, проверяем статус в БД
-    if not is_suspicious and db is not None and thread_id:
-        ticket = db.tickets.find_one({"topic_id": thread_id})
+    if not is_suspicious and thread_id:
+        ticket = await tickets.find_by_topic(thread_id)
         is_suspicious = ticket.get("status") == "suspicious" if ticket else False
 
     if support_group_id and thread_id:
@@ -467,13 +607,14 @@ async def call_manager_callback(update: Update, context: ContextTypes.DEFAULT_TY
         await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"🔥 <b>Клиент @{user_name} вызывает менеджера!</b>", parse_mode="HTML")
         
         # Меняем статус только если он НЕ подозрительный
-        if db is not None:
-            update_data = {"ai_disabled": True}
-            if not is_suspicious:
-                update_data["status"] = "escalated"
-                update_data["escalated_at"] = datetime.now(timezone.utc)
-            
-            db.tickets.update_one({"topic_id": thread_id}, {"$set": update_data})
+        update_data = {"ai_disabled": True}
+        if not is_suspicious:
+            update_data["status"] = "escalated"
+            update_data["escalated_at"] = datetime.now(timezone.utc)
+        
+        await tickets.update_by_topic(thread_id, {"$set": update_data})
+        if not is_suspicious:
+            await TicketEventRepository().publish(EVENT_ESCALATE, topic_id=thread_id, status="escalated")
 
     await query.edit_message_reply_markup(reply_markup=None)
     await query.message.reply_text("Менеджер скоро подключится.")
@@ -481,7 +622,7 @@ async def call_manager_callback(update: Update, context: ContextTypes.DEFAULT_TY
 async def client_close_ticket_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer("Тикет закрыт.")
-    db = get_db()
+    tickets = TicketRepository()
     support_group_id = get_support_group_id()
     thread_id = context.user_data.get("topic_id")
     is_suspicious = context.user_data.get("is_suspicious", False)
@@ -494,11 +635,11 @@ async def client_close_ticket_callback(update: Update, context: ContextTypes.DEF
             # Подозрительный тикет: не закрываем тему, сохраняем эмодзи 🚨
             await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"✅ Клиент закрыл чат. Тикет остаётся для проверки!", parse_mode="HTML")
             # Оставляем в БД с пометкой closed_at
-            if db is not None: 
-                db.tickets.update_one(
-                    {"topic_id": thread_id}, 
-                    {"$set": {"status": "suspicious", "closed_at": datetime.now(timezone.utc)}}
-                )
+            await tickets.update_by_topic(
+                thread_id, 
+                {"$set": {"status": "suspicious", "closed_at": datetime.now(timezone.utc)}}
+            )
+            await TicketEventRepository().publish(EVENT_CLOSE, topic_id=thread_id, status="suspicious")
         else:
             # Обычный тикет: переименование → закрытие → сообщение
             # 1. Переименовываем тему (используем 🟢 вместо ✅)
@@ -520,9 +661,9 @@ async def client_close_ticket_callback(update: Update, context: ContextTypes.DEF
             await context.bot.send_message(chat_id=support_group_id, message_thread_id=thread_id, text=f"✅ <b>Тикет закрыт клиентом.</b>", parse_mode="HTML")
 
             
-            # 4. Удаляем из БД
-            if db is not None: 
-                db.tickets.delete_one({"topic_id": thread_id})
+            # 4. Помечаем закрытым (в архив тикет перенесёт архиватор)
+            await tickets.mark_closed({"topic_id": thread_id})
+            await TicketEventRepository().publish(EVENT_CLOSE, topic_id=thread_id, status="closed")
 
     if "support_topic_by_client" in context.application.bot_data: context.application.bot_data["support_topic_by_client"].pop(user_id, None)
     if "support_thread_to_client" in context.application.bot_data: context.application.bot_data["support_thread_to_client"].pop((support_group_id, thread_id), None)
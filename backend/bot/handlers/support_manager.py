@@ -6,7 +6,8 @@ from telegram.ext import ContextTypes
 from utils.support_common import (
     build_support_header, check_access, get_support_chat_ids, TOPIC_CLOSED
 )
-from utils.db_config import get_db, get_settings, get_support_group_id
+from utils.db_config import get_async_db, get_settings, get_support_group_id
+from database.repositories import TicketRepository, TicketMessageRepository, TicketEventRepository, EVENT_REPLY
 from utils.bedolaga_api import fetch_bedolaga_balance, fetch_bedolaga_transactions
 from utils.remnawave_api import remnawave_action
 from services.ticket_service import TicketService
@@ -50,11 +51,11 @@ async def handle_support_group_message(update: Update, context: ContextTypes.DEF
     thread_to_client = context.application.bot_data.get("support_thread_to_client", {})
     client_id = thread_to_client.get((support_group_id, thread_id))
     
-    db = get_db()
+    tickets = TicketRepository()
     
     # Если нет в памяти, ищем в БД
-    if not client_id and db:
-        ticket = db.tickets.find_one({"topic_id": thread_id})
+    if not client_id:
+        ticket = await tickets.find_by_topic(thread_id)
         if ticket:
             client_id = ticket.get("client_id")
             # Восстанавливаем маппинг
@@ -96,7 +97,7 @@ async def handle_support_group_message(update: Update, context: ContextTypes.DEF
             await context.bot.send_animation(chat_id=client_id, animation=msg.animation.file_id, caption=f"👨‍💼 <b>Поддержка:</b>\n{text}" if text else None, parse_mode="HTML")
             sent = True
 
-        if sent and db is not None:
+        if sent:
             # Логируем ответ менеджера
             reply_record = {
                 "role": "manager",
@@ -105,10 +106,9 @@ async def handle_support_group_message(update: Update, context: ContextTypes.DEF
                 "timestamp": datetime.now(timezone.utc).isoformat(),
                 "sent_to_telegram": True
             }
-            db.tickets.update_one(
-                {"topic_id": thread_id},
+            ticket_oid = await tickets.update_by_topic_returning_id(
+                thread_id,
                 {
-                    "$push": {"history": reply_record},
                     "$set": {
                         "last_reply_at": datetime.now(timezone.utc),
                         "status": "answered", # Меняем статус на answered (или оставляем как есть, но для порядка)
@@ -116,6 +116,9 @@ async def handle_support_group_message(update: Update, context: ContextTypes.DEF
                     }
                 }
             )
+            if ticket_oid:
+                await TicketMessageRepository(tickets.db).append(ticket_oid, [reply_record])
+                await TicketEventRepository(tickets.db).publish(EVENT_REPLY, ticket_oid, thread_id, "answered")
             
             # Добавляем в last_messages для контекста AI
             # Нужно аккуратно, чтобы контекст AI обновлялся
@@ -143,7 +146,7 @@ async def close_ticket_callback(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer("Закрываю тикет...")
     
     # Создаем экземпляр сервиса с существующим ботом
-    db = get_db()
+    db = get_async_db()
     support_group_id = get_support_group_id()
     from services.telegram_service import TelegramService
     # Используем существующий бот вместо создания нового
@@ -183,13 +186,12 @@ async def remove_ticket_callback(update: Update, context: ContextTypes.DEFAULT_T
 
     await query.answer("Тикет удалён.")
 
-    db = get_db()
     support_group_id = get_support_group_id()
 
-    if db is not None and ticket_id:
+    if ticket_id:
         try:
             thread_id = int(ticket_id)
-            db.tickets.update_one({"topic_id": thread_id}, {"$set": {"is_removed": True, "removed_at": datetime.now(timezone.utc)}})
+            await TicketRepository().update_by_topic(thread_id, {"$set": {"is_removed": True, "removed_at": datetime.now(timezone.utc)}})
             try: await context.bot.close_forum_topic(chat_id=support_group_id, message_thread_id=thread_id)
             except: pass
         except Exception as e:
@@ -288,16 +290,12 @@ async def support_action_callback(update: Update, context: ContextTypes.DEFAULT_
     
     # AI actions
     if action == "stop_ai":
-        db = get_db()
-        if db is not None:
-            db.tickets.update_one({"client_id": client_id, "is_removed": {"$ne": True}}, {"$set": {"ai_disabled": True}})
+        await TicketRepository().update_live_by_client(client_id, {"$set": {"ai_disabled": True}})
         await query.answer("AI остановлен.")
         return
     
     if action == "start_ai":
-        db = get_db()
-        if db is not None:
-            db.tickets.update_one({"client_id": client_id, "is_removed": {"$ne": True}}, {"$set": {"ai_disabled": False}})
+        await TicketRepository().update_live_by_client(client_id, {"$set": {"ai_disabled": False}})
         await query.answer("AI включён.")
         return
     
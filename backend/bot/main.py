@@ -7,14 +7,19 @@ import os
 import sys
 import logging
 import asyncio
-from pymongo import MongoClient
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     filters, PicklePersistence
 )
 
-from utils.db_config import get_db, get_settings
+from utils.db_config import get_db, get_settings, close_db, close_async_db
+from database.indexes import ensure_capped_collections, ensure_timeseries_collections
+from services.ai.transport import close_clients as close_ai_clients
+from services.ai.reporter import AIStatsReporter
+from services.ai.telemetry import AICallWriter
 from utils.support_common import get_support_chat_ids
+from utils.config_watcher import start_config_watcher, stop_config_watcher
+from bot.update_processor import ChatOrderedUpdateProcessor
 
 
 from bot.handlers.start import start_handler, help_handler
@@ -35,12 +40,34 @@ from bot.handlers.actions import (
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Фильтр чата группы поддержки. Один экземпляр на процесс — при смене
+# support_group_id в Mini App меняем его chat_ids на лету, без рестарта.
+support_chat_filter = filters.Chat(allow_empty=False)
 
 
+def bind_support_group(support_group_id) -> None:
+    """Привязывает обработчик сообщений менеджеров к (новой) группе поддержки."""
+    chat_ids = set(get_support_chat_ids(support_group_id))
+    if chat_ids != set(support_chat_filter.chat_ids):
+        support_chat_filter.chat_ids = chat_ids
+        logger.info(f"Support group handler bound to chat_ids: {sorted(chat_ids)}")
 
 
+def apply_config(application: Application, config: dict) -> None:
+    """Кладёт уже загруженные настройки в bot_data и перепривязывает обработчики (в event loop, без I/O)."""
+    application.bot_data["_config"] = config
+    bind_support_group(config.get("support_group_id"))
 
 
+def _on_config_change(application: Application, loop: asyncio.AbstractEventLoop, collection: str) -> None:
+    # Вызывается из потока ConfigWatcher: свежие настройки читаем здесь (sync pymongo),
+    # в event loop бота передаём только готовое значение
+    if collection != "settings":
+        return
+    config = get_settings()
+    if config:
+        loop.call_soon_threadsafe(apply_config, application, config)
+
 
 async def post_init(application: Application) -> None:
     from telegram import MenuButtonCommands, MenuButtonWebApp, WebAppInfo
@@ -62,6 +89,38 @@ async def post_init(application: Application) -> None:
         application.bot_data["_config"] = config
         logger.info(f"post_init: Loaded config, support_group_id={config.get('support_group_id')}")
 
+    # Подписываемся на изменения настроек из Mini App / backend
+    db = get_db()
+    if db is not None:
+        # ticket_events должна быть capped до первой записи (бот может стартовать раньше backend)
+        ensure_capped_collections(db)
+        ensure_timeseries_collections(db)
+        loop = asyncio.get_running_loop()
+        watcher = start_config_watcher(db)
+        watcher.add_listener(lambda collection: _on_config_change(application, loop, collection))
+
+    # Сводка статистики AI-вызовов бота (хеджирование и т.п.) для Mini App
+    reporter = AIStatsReporter("bot")
+    reporter.start()
+    application.bot_data["_ai_stats_reporter"] = reporter
+    # Телеметрия каждой попытки AI-вызова (ai_calls)
+    calls = AICallWriter("bot")
+    calls.start()
+    application.bot_data["_ai_call_writer"] = calls
+
+
+async def post_shutdown(application: Application) -> None:
+    stop_config_watcher()
+    reporter = application.bot_data.pop("_ai_stats_reporter", None)
+    if reporter is not None:
+        await reporter.stop()
+    calls = application.bot_data.pop("_ai_call_writer", None)
+    if calls is not None:
+        await calls.stop()
+    await close_ai_clients()
+    close_db()
+    close_async_db()
+
 
 def main():
     config = get_settings()
@@ -82,7 +141,9 @@ def main():
     except Exception:
         persistence = None
 
-    builder = Application.builder().token(bot_token).post_init(post_init)
+    builder = Application.builder().token(bot_token).post_init(post_init).post_shutdown(post_shutdown)
+    # Разные чаты — параллельно (ожидание AI не задерживает остальных клиентов), один чат — по очереди
+    builder = builder.concurrent_updates(ChatOrderedUpdateProcessor())
     if persistence:
         builder = builder.persistence(persistence)
     application = builder.build()
@@ -117,14 +178,13 @@ def main():
         | filters.VIDEO_NOTE | filters.Sticker.ALL | filters.ANIMATION
     ) & ~filters.COMMAND
 
-    # Сообщения от менеджера в группе поддержки
-    if support_group_id:
-        chat_ids = get_support_chat_ids(support_group_id)
-        logger.info(f"Registered support group handler for chat_ids: {chat_ids}")
-        application.add_handler(MessageHandler(
-            support_content & filters.Chat(chat_ids),
-            handle_support_group_message,
-        ))
+    # Сообщения от менеджера в группе поддержки.
+    # Регистрируем всегда: пока группа не задана, фильтр пуст и ничего не пропускает.
+    bind_support_group(support_group_id)
+    application.add_handler(MessageHandler(
+        support_content & support_chat_filter,
+        handle_support_group_message,
+    ))
 
     # Все остальные сообщения (личные чаты) — dispatch_message
     logger.info("Registered dispatch_message handler for private chats")
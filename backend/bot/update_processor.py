@@ -0,0 +1,61 @@
+"""
+Параллельная обработка апдейтов с очередью на чат.
+
+Апдейты разных чатов обрабатываются одновременно (не больше
+BOT_CONCURRENT_UPDATES), апдейты одного чата — строго по очереди, в порядке
+получения. Обработчики читают и меняют user_data/chat_data и тикет клиента
+между await (например, "нет темы — создать"), и два сообщения одного клиента,
+обработанные параллельно, создали бы две темы. Группа поддержки — форум, там
+очередь своя у каждой темы, чтобы менеджеры разных тикетов не ждали друг друга.
+"""
+import os
+import asyncio
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+BOT_CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", "32"))
+
+# Семафор базового класса берётся до очереди чата: делаем его шире, чтобы
+# апдейты, ждущие своей очереди, не занимали все слоты обработки
+_PENDING_PER_SLOT = 4
+
+
+def chat_key(update: object) -> Optional[Hashable]:
+    """Ключ очереди: чат, а в форуме — тема; None — апдейт без чата (обрабатывается сразу)."""
+    if not isinstance(update, Update) or update.effective_chat is None:
+        return None
+    message = update.effective_message
+    thread_id = message.message_thread_id if message is not None and message.is_topic_message else None
+    return update.effective_chat.id, thread_id
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int = BOT_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates * _PENDING_PER_SLOT)
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        # ключ -> [lock, сколько апдейтов держат или ждут lock]
+        self._chats: Dict[Hashable, list] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = chat_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        entry = self._chats.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._chats.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -1,31 +1,237 @@
-from pymongo.database import Database
+"""
+Декларативный каталог индексов MongoDB.
+
+INDEX_CATALOGUE — единственный источник правды: ensure_indexes создаёт
+недостающие индексы и обновляет изменившиеся. Индексы управляемых коллекций,
+которых в каталоге нет, по умолчанию только попадают в лог; удаляются они
+с MONGO_PRUNE_INDEXES=true или вручную:
+
+    python -m database.indexes --prune [--mongo-url mongodb://localhost:27017] [--db-name reshala_support]
+
+Каждая форма запроса из database/queries.py должна обслуживаться одним из
+этих индексов — это проверяет `python -m database.query_plans`.
+"""
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+import argparse
 import logging
+import os
+import sys
+
+from pymongo import MongoClient, TEXT
+from pymongo.database import Database
+
+from database.queries import LIVE_FILTER
 
 logger = logging.getLogger(__name__)
 
-async def ensure_indexes(db: Database):
+# Сколько дней хранить архив тикетов (TTL по archived_at; 0 — бессрочно)
+ARCHIVE_RETENTION_DAYS = int(os.environ.get("ARCHIVE_RETENTION_DAYS", "180"))
+# Сколько дней истории ai_calls хранить (TTL коллекции) и отдавать в /api/ai/stats
+AI_CALLS_RETENTION_DAYS = int(os.environ.get("AI_CALLS_RETENTION_DAYS", "30"))
+# Удалять при старте индексы, которых нет в каталоге (иначе — только предупреждение)
+MONGO_PRUNE_INDEXES = os.environ.get("MONGO_PRUNE_INDEXES", "false").lower() == "true"
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    collection: str
+    name: str
+    keys: List[Tuple[str, object]]
+    options: Dict = field(default_factory=dict)
+
+
+INDEX_CATALOGUE: List[IndexSpec] = [
+    # tickets — partial-индексы только по живым тикетам (is_removed: False), чтобы
+    # закрытые/убранные до архивации не раздували горячие индексы
+    IndexSpec("tickets", "live_client", [("client_id", 1)],
+              {"partialFilterExpression": LIVE_FILTER}),
+    # Списки Mini App: порядок сортировки целиком в индексе (включая _id для keyset-курсора)
+    IndexSpec("tickets", "live_status_created", [("status", -1), ("created_at", -1), ("_id", -1)],
+              {"partialFilterExpression": LIVE_FILTER}),
+    IndexSpec("tickets", "live_status_escalated", [("status", 1), ("escalated_at", -1), ("_id", -1)],
+              {"partialFilterExpression": LIVE_FILTER}),
+    # Дельта-синхронизация дашборда (/api/tickets/changes) — по всем тикетам,
+    # чтобы видеть и выпавшие из активных
+    IndexSpec("tickets", "updated_at_1__id_1", [("updated_at", 1), ("_id", 1)]),
+    # Обновления бота идут по topic_id без фильтра is_removed — индекс полный
+    IndexSpec("tickets", "topic_id_1", [("topic_id", 1)]),
+    # Кандидаты в архив
+    IndexSpec("tickets", "closed_at_closed", [("closed_at", 1)],
+              {"partialFilterExpression": {"status": "closed"}}),
+    IndexSpec("tickets", "removed", [("is_removed", 1)],
+              {"partialFilterExpression": {"is_removed": True}}),
+
+    # ticket_messages — поиск незаполненного бакета и пагинация по времени
+    IndexSpec("ticket_messages", "ticket_id_1_first_ts_-1__id_-1", [("ticket_id", 1), ("first_ts", -1), ("_id", -1)]),
+
+    # tickets_archive — очистка по TTL
+    IndexSpec("tickets_archive", "client_id_1", [("client_id", 1)]),
+    IndexSpec("tickets_archive", "archived_at_1", [("archived_at", 1)],
+              {"expireAfterSeconds": ARCHIVE_RETENTION_DAYS * 86400} if ARCHIVE_RETENTION_DAYS > 0 else {}),
+
+    # knowledge_base — полнотекстовый поиск вместо неякорного $regex
+    IndexSpec("knowledge_base", "kb_text", [("title", TEXT), ("category", TEXT), ("content", TEXT)],
+              {"weights": {"title": 10, "category": 5, "content": 1}, "default_language": "russian"}),
+    IndexSpec("knowledge_base", "updated_at_-1", [("updated_at", -1)]),
+
+    # ai_providers — выборка/обновление по имени
+    IndexSpec("ai_providers", "name_1", [("name", 1)], {"unique": True}),
+]
+
+# Capped-коллекции: имя -> размер в байтах (tailable-курсоры работают только на них)
+CAPPED_COLLECTIONS: Dict[str, int] = {
+    "ticket_events": int(os.environ.get("TICKET_EVENTS_SIZE_MB", "4")) * 1024 * 1024,
+}
+
+# Time-series коллекции (MongoDB 5.0+): имя -> опции create_collection
+TIMESERIES_COLLECTIONS: Dict[str, Dict] = {
+    "ai_calls": {
+        "timeseries": {"timeField": "ts", "metaField": "meta", "granularity": "seconds"},
+        "expireAfterSeconds": AI_CALLS_RETENTION_DAYS * 86400,
+    },
+}
+
+# Опции, которые сравниваются с существующим индексом
+_COMPARED_OPTIONS = ("partialFilterExpression", "unique", "expireAfterSeconds", "weights", "default_language")
+
+
+def _key_matches(existing: dict, spec: IndexSpec) -> bool:
+    if any(v == TEXT for _, v in spec.keys):
+        # Текстовый индекс хранится как {_fts: "text", _ftsx: 1}; поля — в weights
+        return existing.get("key") == [("_fts", "text"), ("_ftsx", 1)]
+    return list(existing.get("key", [])) == [(k, v) for k, v in spec.keys]
+
+
+def _options_match(existing: dict, spec: IndexSpec) -> bool:
+    for option in _COMPARED_OPTIONS:
+        if option == "weights" and option not in spec.options:
+            continue
+        if option == "default_language" and option not in spec.options:
+            continue
+        if existing.get(option) != spec.options.get(option):
+            return False
+    return True
+
+
+def _sync_index(db: Database, spec: IndexSpec, existing: dict):
+    collection = db[spec.collection]
+    current = existing.get(spec.name)
+    if current is not None and _key_matches(current, spec):
+        if _options_match(current, spec):
+            return
+        only_ttl_changed = all(
+            current.get(o) == spec.options.get(o) for o in _COMPARED_OPTIONS if o != "expireAfterSeconds"
+        )
+        if only_ttl_changed and "expireAfterSeconds" in spec.options:
+            db.command("collMod", spec.collection,
+                       index={"name": spec.name, "expireAfterSeconds": spec.options["expireAfterSeconds"]})
+            logger.info(f"Updated TTL of {spec.collection}.{spec.name}")
+            return
+    if current is not None:
+        collection.drop_index(spec.name)
+        logger.info(f"Recreating index {spec.collection}.{spec.name}")
+    collection.create_index(spec.keys, name=spec.name, **spec.options)
+
+
+def ensure_indexes(db: Database, prune: bool = False):
     """
     Ensure required indexes exist on MongoDB collections.
-    This should be called on application startup.
+    This should be called on application startup (вызовы pymongo блокирующие —
+    из event loop запускать через asyncio.to_thread).
+    prune=True also drops indexes of managed collections that are not in the catalogue.
+    """
+    by_collection: Dict[str, List[IndexSpec]] = {}
+    for spec in INDEX_CATALOGUE:
+        by_collection.setdefault(spec.collection, []).append(spec)
+
+    for collection, specs in by_collection.items():
+        logger.info(f"Ensuring indexes for '{collection}' collection...")
+        try:
+            existing = db[collection].index_information()
+        except Exception as e:
+            logger.error(f"Error reading indexes of {collection}: {e}")
+            continue
+
+        # Индексы, которых нет в каталоге (в т.ч. старые одиночные), только замедляют запись,
+        # но их мог завести и оператор руками — без prune не трогаем
+        wanted = {s.name for s in specs}
+        for name in list(existing):
+            if name == "_id_" or name in wanted:
+                continue
+            if not prune:
+                logger.warning(f"Index {collection}.{name} is not in the catalogue "
+                               f"(drop with `python -m database.indexes --prune` or MONGO_PRUNE_INDEXES=true)")
+                continue
+            try:
+                db[collection].drop_index(name)
+                existing.pop(name)
+                logger.info(f"Dropped index {collection}.{name} (not in catalogue)")
+            except Exception as e:
+                logger.error(f"Error dropping index {collection}.{name}: {e}")
+
+        for spec in specs:
+            try:
+                _sync_index(db, spec, existing)
+            except Exception as e:
+                logger.error(f"Error creating index {collection}.{spec.name}: {e}")
+
+    logger.info("Indexes created successfully.")
+
+
+def ensure_capped_collections(db: Database):
     """
+    Создаёт capped-коллекции из CAPPED_COLLECTIONS. Если коллекция уже появилась
+    обычной (первая запись раньше старта backend) — конвертирует её.
+    """
+    existing = set(db.list_collection_names())
+    for name, size in CAPPED_COLLECTIONS.items():
+        try:
+            if name not in existing:
+                db.create_collection(name, capped=True, size=size)
+                logger.info(f"Created capped collection {name} ({size} bytes)")
+            elif not db[name].options().get("capped"):
+                db.command("convertToCapped", name, size=size)
+                logger.info(f"Converted {name} to capped ({size} bytes)")
+        except Exception as e:
+            logger.error(f"Error ensuring capped collection {name}: {e}")
+
+
+def ensure_timeseries_collections(db: Database):
+    """
+    Создаёт time-series коллекции из TIMESERIES_COLLECTIONS. Уже существующие
+    не трогает (обычную коллекцию в time-series не сконвертировать), только
+    обновляет срок хранения. На MongoDB старше 5.0 коллекция останется обычной.
+    """
+    existing = set(db.list_collection_names())
+    for name, options in TIMESERIES_COLLECTIONS.items():
+        try:
+            if name not in existing:
+                db.create_collection(name, **options)
+                logger.info(f"Created time-series collection {name}")
+            elif db[name].options().get("timeseries"):
+                db.command("collMod", name, expireAfterSeconds=options["expireAfterSeconds"])
+            else:
+                logger.warning(f"{name} exists but is not a time-series collection")
+        except Exception as e:
+            logger.error(f"Error ensuring time-series collection {name}: {e}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Apply the MongoDB index catalogue")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default=os.environ.get("DB_NAME", "reshala_support"))
+    parser.add_argument("--prune", action="store_true", help="удалить индексы, которых нет в каталоге")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(levelname)s %(message)s", level=logging.INFO)
+    client = MongoClient(args.mongo_url, serverSelectionTimeoutMS=5000)
     try:
-        # Tickets collection
-        # Compound index for active tickets query (escalated first, then created desc)
-        # Note: 'status' is heavily filtered
-        logger.info("Ensuring indexes for 'tickets' collection...")
-        
-        # 1. Status + CreatedAt (for sorting/filtering)
-        db.tickets.create_index([("status", 1), ("created_at", -1)])
-        
-        # 2. Client ID (for lookup)
-        db.tickets.create_index("client_id")
-        
-        # 3. Topic ID (for Telegram thread lookup)
-        db.tickets.create_index("topic_id")
-        
-        # 4. Escalated At (for sorting)
-        db.tickets.create_index([("escalated_at", -1)])
-        
-        logger.info("Indexes created successfully.")
-    except Exception as e:
-        logger.error(f"Error creating indexes: {e}")
+        ensure_indexes(client[args.db_name], prune=args.prune)
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+Миграции данных, выполняемые при старте backend.
+Каждая миграция идемпотентна и работает пачками, чтобы не держать
+в памяти всю коллекцию и не блокировать базу надолго.
+"""
+import logging
+from datetime import datetime, timezone
+from typing import List
+
+from pymongo import UpdateOne
+
+from database.repositories import MESSAGE_BUCKET_SIZE
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_BATCH_SIZE = 100
+
+
+def _message_ts(record: dict, fallback: datetime) -> datetime:
+    try:
+        ts = datetime.fromisoformat(str(record.get("timestamp")).replace("Z", "+00:00"))
+    except ValueError:
+        return fallback
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def _history_buckets(ticket: dict) -> List[dict]:
+    fallback = ticket.get("created_at") or ticket["_id"].generation_time.replace(tzinfo=None)
+    records = [{**r, "ts": _message_ts(r, fallback)} for r in ticket.get("history") or []]
+    buckets = []
+    for i in range(0, len(records), MESSAGE_BUCKET_SIZE):
+        chunk = records[i:i + MESSAGE_BUCKET_SIZE]
+        buckets.append({
+            "ticket_id": ticket["_id"],
+            "first_ts": min(r["ts"] for r in chunk),
+            "last_ts": max(r["ts"] for r in chunk),
+            "count": len(chunk),
+            "messages": chunk,
+            "migrated": True,
+        })
+    return buckets
+
+
+async def migrate_ticket_history(db, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """
+    Переносит tickets.history в бакеты ticket_messages и убирает поле history.
+    db — async (Motor) база. Возвращает число перенесённых тикетов.
+    """
+    migrated = 0
+    while True:
+        tickets = await db.tickets.find(
+            {"history": {"$exists": True}},
+            {"history": 1, "created_at": 1},
+        ).limit(batch_size).to_list(length=batch_size)
+        if not tickets:
+            break
+
+        ids = [t["_id"] for t in tickets]
+        # Если прошлый запуск прервался между вставкой бакетов и $unset — не дублируем
+        await db.ticket_messages.delete_many({"ticket_id": {"$in": ids}, "migrated": True})
+
+        buckets = [b for t in tickets for b in _history_buckets(t)]
+        if buckets:
+            await db.ticket_messages.insert_many(buckets, ordered=False)
+        await db.tickets.bulk_write(
+            [UpdateOne({"_id": tid}, {"$unset": {"history": ""}}) for tid in ids],
+            ordered=False,
+        )
+        migrated += len(tickets)
+        logger.info(f"[MIGRATION] ticket history -> ticket_messages: {migrated} tickets")
+
+    return migrated
+
+
+async def backfill_is_removed(db) -> int:
+    """
+    Проставляет is_removed: False старым тикетам без этого поля: запросы по живым
+    тикетам фильтруют равенством и иначе их не увидят (и partial-индексы тоже).
+    """
+    result = await db.tickets.update_many({"is_removed": {"$exists": False}}, {"$set": {"is_removed": False}})
+    if result.modified_count:
+        logger.info(f"[MIGRATION] is_removed backfilled on {result.modified_count} tickets")
+    return result.modified_count
+
+
+async def backfill_updated_at(db) -> int:
+    """updated_at для тикетов, созданных до дельта-синхронизации (= created_at)."""
+    result = await db.tickets.update_many(
+        {"updated_at": {"$exists": False}},
+        [{"$set": {"updated_at": {"$ifNull": ["$created_at", "$$NOW"]}}}],
+    )
+    if result.modified_count:
+        logger.info(f"[MIGRATION] updated_at backfilled on {result.modified_count} tickets")
+    return result.modified_count
+
+
+# Провайдер для своего OpenAI-совместимого сервера (llama.cpp, vLLM, Ollama):
+# адрес — в endpoint, ключ — любой, если сервер запущен без проверки ключа
+LOCAL_PROVIDER = {
+    "name": "local", "display_name": "Локальная модель", "api_keys": [], "active_key_index": 0,
+    "base_url": "", "endpoint": "", "models": [], "selected_model": "", "vision_model": "",
+    "enabled": False, "proxy": "",
+}
+
+
+async def add_local_provider(db) -> int:
+    """Добавляет провайдера local (быстрый уровень маршрутизации, services/ai/routing.py)."""
+    result = await db.ai_providers.update_one({"name": "local"}, {"$setOnInsert": LOCAL_PROVIDER}, upsert=True)
+    if result.upserted_id is not None:
+        logger.info("[MIGRATION] local AI provider added")
+        return 1
+    return 0
+
+
+MIGRATIONS = (backfill_is_removed, backfill_updated_at, migrate_ticket_history, add_local_provider)
+
+
+async def run_migrations(db):
+    """Все миграции по порядку; ошибки логируются и не мешают старту."""
+    for migration in MIGRATIONS:
+        try:
+            await migration(db)
+        except Exception as e:
+            logger.error(f"[MIGRATION] {migration.__name__} failed: {e}")
@@ -0,0 +1,62 @@
+"""
+Keyset-пагинация.
+
+Курсор — значения ключей сортировки последнего документа страницы
+(base64 от Extended JSON, чтобы сохранить datetime и ObjectId).
+Следующая страница — документы строго "после" курсора в порядке сортировки,
+поэтому стоимость страницы не зависит от её номера, а порядок держит индекс.
+"""
+import base64
+import binascii
+from typing import List, Optional, Tuple
+
+from bson import json_util
+from bson.errors import InvalidBSON
+
+Sort = List[Tuple[str, int]]
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _get_path(doc: dict, path: str):
+    value = doc
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def encode_cursor(doc: dict, sort: Sort) -> str:
+    values = [_get_path(doc, key) for key, _ in sort]
+    raw = json_util.dumps(values).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: Sort) -> list:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json_util.loads(raw.decode("utf-8"))
+    except (binascii.Error, UnicodeDecodeError, ValueError, InvalidBSON) as e:
+        raise InvalidCursor(str(e)) from e
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise InvalidCursor("cursor does not match sort order")
+    return values
+
+
+def keyset_filter(query: dict, sort: Sort, values: Optional[list]) -> dict:
+    """
+    query + "после values" для сортировки sort.
+
+    Для (a, b, c) это $or веток (a > va), (a = va, b > vb), (a = va, b = vb, c > vc)
+    с учётом направлений. Каждая ветка содержит исходный фильтр — $or получается
+    корневым, и каждая ветка идёт своим IXSCAN, сливаясь по сортировке (SORT_MERGE).
+    """
+    if values is None:
+        return query
+    branches = []
+    for i, (key, direction) in enumerate(sort):
+        branch = {k: v for (k, _), v in zip(sort[:i], values[:i])}
+        branch[key] = {"$lt" if direction < 0 else "$gt": values[i]}
+        branches.append({"$and": [query, branch]})
+    return {"$or": branches}
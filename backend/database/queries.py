@@ -0,0 +1,151 @@
+"""
+Формы запросов к MongoDB.
+
+Все фильтры и сортировки по тикетам, переписке и базе знаний собраны здесь:
+их используют репозитории и TicketService, а database/query_plans.py
+прогоняет их через explain() и проверяет, что каждая форма обслуживается
+индексом из database/indexes.INDEX_CATALOGUE.
+
+Живые тикеты фильтруются равенством `is_removed: False` (а не `$ne: True`),
+иначе планировщик не сможет использовать partial-индексы по живым тикетам.
+"""
+from datetime import datetime
+from typing import Iterable, List
+
+# Partial-фильтр индексов по живым тикетам
+LIVE_FILTER = {"is_removed": False}
+
+# Статусы, которые видит менеджер в Mini App
+ACTIVE_STATUSES = ["escalated", "suspicious"]
+
+NOT_CLOSED = {"$ne": "closed"}
+
+
+# --- tickets ---
+
+def live_by_client(client_id: int) -> dict:
+    """Открытый (не убранный и не закрытый) тикет клиента."""
+    return {"client_id": client_id, **LIVE_FILTER, "status": NOT_CLOSED}
+
+
+def live_by_topic(topic_id: int) -> dict:
+    return {"topic_id": topic_id, **LIVE_FILTER, "status": NOT_CLOSED}
+
+
+def by_topic(topic_id: int) -> dict:
+    return {"topic_id": topic_id}
+
+
+def active_tickets() -> dict:
+    return {"status": {"$in": ACTIVE_STATUSES}, **LIVE_FILTER}
+
+
+# Подозрительные выше эскалированных ("suspicious" > "escalated"), внутри — новые сверху.
+# _id в конце делает порядок строгим для keyset-пагинации.
+ACTIVE_SORT = [("status", -1), ("created_at", -1), ("_id", -1)]
+
+
+def escalated_tickets() -> dict:
+    return {"status": "escalated", **LIVE_FILTER}
+
+
+ESCALATED_SORT = [("escalated_at", -1), ("_id", -1)]
+
+
+def suspicious_tickets() -> dict:
+    return {"status": "suspicious", **LIVE_FILTER}
+
+
+SUSPICIOUS_SORT = [("created_at", -1), ("_id", -1)]
+
+# Поля тикета в списках по умолчанию (без user_data, last_messages, attachments)
+TICKET_LIST_FIELDS = (
+    "client_id", "client_name", "client_username", "topic_id", "status", "reason",
+    "escalated_at", "created_at", "closed_at", "is_removed", "ai_disabled",
+)
+
+
+def ticket_projection(fields) -> dict:
+    return {f: 1 for f in fields}
+
+
+def changed_tickets(since: datetime) -> dict:
+    """Все тикеты (в т.ч. закрытые и убранные) с версией не старше since."""
+    return {"updated_at": {"$gte": since}}
+
+
+# Порядок выдачи изменений; _id — для продолжения пачки с того же updated_at
+CHANGES_SORT = [("updated_at", 1), ("_id", 1)]
+LATEST_CHANGE_SORT = [("updated_at", -1), ("_id", -1)]
+
+
+def is_active_ticket(ticket: dict) -> bool:
+    """Тикет виден в Mini App (то же условие, что active_tickets())."""
+    return ticket.get("status") in ACTIVE_STATUSES and ticket.get("is_removed") is False
+
+
+def archivable_tickets(closed_before: datetime) -> dict:
+    """Убранные или закрытые до closed_before (тикеты со старым history ждут миграции)."""
+    not_legacy = {"history": {"$exists": False}}
+    # $or на верхнем уровне — каждая ветка планируется по своему partial-индексу
+    return {"$or": [
+        {"is_removed": True, **not_legacy},
+        {"status": "closed", "closed_at": {"$lte": closed_before}, **not_legacy},
+    ]}
+
+
+def archived_since(since: datetime) -> dict:
+    return {"archived_at": {"$gte": since}}
+
+
+# --- ticket_messages ---
+
+def open_bucket(ticket_id, bucket_size: int) -> dict:
+    return {"ticket_id": ticket_id, "count": {"$lt": bucket_size}}
+
+
+def buckets_before(ticket_id, before: datetime = None) -> dict:
+    query = {"ticket_id": ticket_id}
+    if before is not None:
+        # $lte: бакет, начатый в ту же миллисекунду, ещё может содержать более ранние по курсору
+        query["first_ts"] = {"$lte": before}
+    return query
+
+
+BUCKETS_NEWEST_FIRST = [("first_ts", -1), ("_id", -1)]
+# Порядок сообщений переписки и ключ курсора: ts не уникален (пачка из одного
+# flush, миллисекундная точность BSON), поэтому добиваем бакетом и позицией в нём
+MESSAGES_CURSOR = [("ts", 1), ("bucket", 1), ("pos", 1)]
+
+
+def buckets_for_tickets(ticket_ids: Iterable) -> dict:
+    return {"ticket_id": {"$in": list(ticket_ids)}}
+
+
+BUCKETS_OLDEST_FIRST = [("first_ts", 1)]
+
+
+# --- knowledge_base ---
+
+KNOWLEDGE_RECENT_SORT = [("updated_at", -1)]
+
+# Проекция/сортировка по релевантности для $text
+TEXT_SCORE = {"score": {"$meta": "textScore"}}
+TEXT_SCORE_SORT = [("score", {"$meta": "textScore"})]
+
+
+def knowledge_text_search(words: List[str]) -> dict:
+    """Полнотекстовый поиск (любое из слов) по текстовому индексу базы знаний."""
+    return {"$text": {"$search": " ".join(words)}}
+
+
+# --- ai_providers ---
+
+def provider_by_name(name: str) -> dict:
+    return {"name": name}
+
+
+# --- ai_calls (time-series, services/ai/telemetry.py) ---
+
+def ai_calls_since(since: datetime) -> dict:
+    return {"ts": {"$gte": since}}
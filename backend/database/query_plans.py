@@ -0,0 +1,185 @@
+"""
+Проверка планов запросов.
+
+Создаёт временную базу на локальном mongod, применяет INDEX_CATALOGUE,
+заполняет коллекции образцами и прогоняет через explain() каждую форму
+запроса из TicketService, обработчиков бота и роутеров (database/queries.py).
+Падает (код возврата 1), если какая-то форма ушла в COLLSCAN или в сортировку
+в памяти (SORT).
+
+    python -m database.query_plans [--mongo-url mongodb://localhost:27017] [--keep]
+"""
+import argparse
+import os
+import sys
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import MongoClient
+
+from database import queries
+from database.indexes import ensure_indexes
+from database.pagination import keyset_filter
+from database.repositories import MESSAGE_BUCKET_SIZE
+
+
+@dataclass
+class QueryShape:
+    name: str
+    collection: str
+    filter: dict
+    sort: Optional[List[Tuple[str, object]]] = None
+    projection: Optional[dict] = None
+    limit: int = 0
+    # Сортировка по textScore делается в памяти по определению — это допустимо
+    allow_sort_on: Tuple[str, ...] = field(default_factory=tuple)
+
+
+_SAMPLE_TICKET = ObjectId()
+_NOW = datetime.now(timezone.utc)
+
+QUERY_SHAPES: List[QueryShape] = [
+    # TicketService / routers/tickets.py
+    QueryShape("TicketService.get_active_tickets", "tickets", queries.active_tickets(), queries.ACTIVE_SORT, limit=100),
+    QueryShape("TicketService.get_escalated_tickets", "tickets", queries.escalated_tickets(), queries.ESCALATED_SORT, limit=50),
+    QueryShape("TicketService.get_suspicious_tickets", "tickets", queries.suspicious_tickets(), queries.SUSPICIOUS_SORT, limit=50),
+    # Следующие страницы (?after=): корневой $or веток курсора, слияние по SORT_MERGE
+    QueryShape("TicketService.get_active_tickets (after)", "tickets",
+               keyset_filter(queries.active_tickets(), queries.ACTIVE_SORT, ["suspicious", _NOW, _SAMPLE_TICKET]),
+               queries.ACTIVE_SORT, queries.ticket_projection(queries.TICKET_LIST_FIELDS), limit=51),
+    QueryShape("TicketService.get_escalated_tickets (after)", "tickets",
+               keyset_filter(queries.escalated_tickets(), queries.ESCALATED_SORT, [_NOW, _SAMPLE_TICKET]),
+               queries.ESCALATED_SORT, queries.ticket_projection(queries.TICKET_LIST_FIELDS), limit=51),
+    QueryShape("TicketService.get_suspicious_tickets (after)", "tickets",
+               keyset_filter(queries.suspicious_tickets(), queries.SUSPICIOUS_SORT, [_NOW, _SAMPLE_TICKET]),
+               queries.SUSPICIOUS_SORT, queries.ticket_projection(queries.TICKET_LIST_FIELDS), limit=51),
+    # /api/tickets/changes
+    QueryShape("TicketService.get_changes", "tickets", queries.changed_tickets(_NOW), queries.CHANGES_SORT, limit=501),
+    QueryShape("TicketService.get_changes (continuation)", "tickets",
+               keyset_filter(queries.changed_tickets(_NOW), queries.CHANGES_SORT, [_NOW, _SAMPLE_TICKET]),
+               queries.CHANGES_SORT, limit=501),
+    QueryShape("TicketService.get_sync_token", "tickets", {}, queries.LATEST_CHANGE_SORT, {"updated_at": 1}, limit=1),
+    QueryShape("TicketService.get_changes (archived)", "tickets_archive", queries.archived_since(_NOW), limit=500),
+    QueryShape("TicketService.close_ticket (by client)", "tickets", queries.live_by_client(123456789)),
+    QueryShape("TicketService.close_ticket (by topic)", "tickets", queries.by_topic(42)),
+    # bot/handlers/support_client.py, support_manager.py
+    QueryShape("handle_client_message (by client)", "tickets", queries.live_by_client(123456789)),
+    QueryShape("handle_client_message (by topic)", "tickets", queries.live_by_topic(42)),
+    QueryShape("ticket writes by topic", "tickets", queries.by_topic(42)),
+    QueryShape("call_manager / stop_ai / start_ai", "tickets", queries.live_by_client(123456789)),
+    # services/archive_service.py
+    QueryShape("TicketArchiver candidates", "tickets", queries.archivable_tickets(_NOW), limit=200),
+    # ticket_messages
+    QueryShape("TicketMessageRepository.append", "ticket_messages", queries.open_bucket(_SAMPLE_TICKET, MESSAGE_BUCKET_SIZE)),
+    QueryShape("TicketMessageRepository.page", "ticket_messages", queries.buckets_before(_SAMPLE_TICKET, _NOW),
+               queries.BUCKETS_NEWEST_FIRST),
+    QueryShape("TicketArchiver messages", "ticket_messages", queries.buckets_for_tickets([_SAMPLE_TICKET, ObjectId()]),
+               queries.BUCKETS_OLDEST_FIRST),
+    # knowledge_base (routers/knowledge.py, routers/ai_router.py, бот)
+    QueryShape("KnowledgeRepository.list", "knowledge_base", {}, queries.KNOWLEDGE_RECENT_SORT, limit=10),
+    QueryShape("KnowledgeRepository.search", "knowledge_base", queries.knowledge_text_search(["подписка", "vpn"]),
+               queries.TEXT_SCORE_SORT, queries.TEXT_SCORE, limit=20, allow_sort_on=("score",)),
+    # ai_providers (AIProviderManager, routers/settings.py)
+    QueryShape("ai_providers by name", "ai_providers", queries.provider_by_name("groq")),
+]
+
+# Коллекции-конфиги из одного/нескольких документов (settings, ai_providers целиком)
+# читаются полностью намеренно и в проверку не входят.
+
+
+def _seed(db):
+    tickets = []
+    for i in range(50):
+        status = ["open", "escalated", "suspicious", "closed"][i % 4]
+        tickets.append({
+            "client_id": 1000000 + i,
+            "topic_id": i,
+            "status": status,
+            "is_removed": i % 10 == 0,
+            "created_at": _NOW - timedelta(minutes=i),
+            "updated_at": _NOW - timedelta(seconds=i),
+            "escalated_at": _NOW - timedelta(minutes=i) if status == "escalated" else None,
+            "closed_at": _NOW - timedelta(hours=i) if status == "closed" else None,
+        })
+    db.tickets.insert_many(tickets)
+    db.ticket_messages.insert_many([
+        {"ticket_id": ObjectId(), "first_ts": _NOW - timedelta(hours=i), "last_ts": _NOW, "count": 1,
+         "messages": [{"role": "user", "content": "test", "ts": _NOW}]}
+        for i in range(20)
+    ])
+    db.knowledge_base.insert_many([
+        {"title": f"Статья {i}", "category": "vpn", "content": "Как обновить подписку VPN",
+         "updated_at": (_NOW - timedelta(days=i)).isoformat()}
+        for i in range(20)
+    ])
+    db.ai_providers.insert_many([{"name": n} for n in ("groq", "openai", "anthropic", "google", "openrouter")])
+
+
+def _walk(plan: dict):
+    if not isinstance(plan, dict):
+        return
+    yield plan
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _walk(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _walk(child)
+
+
+def check_shape(db, shape: QueryShape) -> List[str]:
+    """Список проблем плана (пустой — план в порядке)."""
+    cursor = db[shape.collection].find(shape.filter, shape.projection)
+    if shape.sort:
+        cursor = cursor.sort(shape.sort)
+    if shape.limit:
+        cursor = cursor.limit(shape.limit)
+    winning = cursor.explain()["queryPlanner"]["winningPlan"]
+
+    problems = []
+    for stage in _walk(winning):
+        name = stage.get("stage")
+        if name == "COLLSCAN":
+            problems.append("COLLSCAN")
+        elif name == "SORT":
+            pattern = stage.get("sortPattern", {})
+            if not set(pattern) <= set(shape.allow_sort_on):
+                problems.append(f"in-memory SORT {dict(pattern)}")
+    return problems
+
+
+def run(mongo_url: str, keep: bool = False) -> Dict[str, List[str]]:
+    client = MongoClient(mongo_url, serverSelectionTimeoutMS=5000)
+    db_name = f"query_plans_{ObjectId()}"
+    db = client[db_name]
+    try:
+        ensure_indexes(db)
+        _seed(db)
+        return {shape.name: check_shape(db, shape) for shape in QUERY_SHAPES}
+    finally:
+        if not keep:
+            client.drop_database(db_name)
+        client.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Check MongoDB query plans against the index catalogue")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--keep", action="store_true", help="не удалять временную базу")
+    args = parser.parse_args(argv)
+
+    results = run(args.mongo_url, args.keep)
+    failed = 0
+    for name, problems in results.items():
+        if problems:
+            failed += 1
+            print(f"FAIL  {name}: {', '.join(problems)}")
+        else:
+            print(f"ok    {name}")
+    print(f"\n{len(results) - failed}/{len(results)} query shapes use indexes")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
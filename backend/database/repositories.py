@@ -0,0 +1,544 @@
+"""
+Async repositories (Motor) for tickets, settings, ai_providers and knowledge_base.
+
+Async код (бот, TicketService, async роутеры) работает с MongoDB только через
+эти классы, чтобы не блокировать event loop синхронным pymongo.
+Синхронный клиент (utils.db_config.get_db) остаётся для кэша настроек,
+ConfigWatcher и AIProviderManager.
+"""
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import CursorType, UpdateOne
+
+from database import queries
+from database.pagination import InvalidCursor, encode_cursor, decode_cursor, keyset_filter
+from utils.db_config import get_async_db, invalidate_settings, invalidate_ai_providers
+
+logger = logging.getLogger(__name__)
+
+# Максимум сообщений в одном бакете ticket_messages
+MESSAGE_BUCKET_SIZE = 50
+
+
+def to_object_id(value) -> Optional[ObjectId]:
+    """ObjectId из строки или None, если строка невалидна."""
+    if isinstance(value, ObjectId):
+        return value
+    if value is not None and ObjectId.is_valid(str(value)):
+        return ObjectId(str(value))
+    return None
+
+
+def _touched(update: dict, now: datetime = None) -> dict:
+    """update + $set.updated_at — версия тикета для /api/tickets/changes."""
+    stamp = {"updated_at": now or datetime.now(timezone.utc)}
+    return {**update, "$set": {**update.get("$set", {}), **stamp}}
+
+
+class TicketRepository:
+    """
+    Все записи в tickets идут через этот класс (и TicketWriteBuffer), который
+    проставляет updated_at — на нём держится дельта-синхронизация дашборда.
+    """
+
+
+    def __init__(self, db: AsyncIOMotorDatabase = None):
+        self.db = db if db is not None else get_async_db()
+        self.collection = self.db.tickets
+
+    async def insert(self, ticket: dict) -> ObjectId:
+        ticket = {**ticket, "updated_at": ticket.get("created_at") or datetime.now(timezone.utc)}
+        result = await self.collection.insert_one(ticket)
+        return result.inserted_id
+
+    async def find_one(self, query: dict) -> Optional[dict]:
+        return await self.collection.find_one(query)
+
+    async def get(self, ticket_id) -> Optional[dict]:
+        oid = to_object_id(ticket_id)
+        if oid is None:
+            return None
+        return await self.collection.find_one({"_id": oid})
+
+    async def find_by_topic(self, topic_id: int) -> Optional[dict]:
+        return await self.collection.find_one(queries.by_topic(topic_id))
+
+    async def find_live_by_client(self, client_id: int) -> Optional[dict]:
+        return await self.collection.find_one(queries.live_by_client(client_id))
+
+    async def find_live_by_topic(self, topic_id: int) -> Optional[dict]:
+        return await self.collection.find_one(queries.live_by_topic(topic_id))
+
+    async def list(self, query: dict, sort=None, limit: int = 0) -> List[dict]:
+        cursor = self.collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(length=limit or None)
+
+    async def page(self, query: dict, sort, limit: int, after: Optional[str] = None,
+                   projection: Optional[dict] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Страница по keyset-курсору: (документы, курсор следующей страницы или None).
+        Бросает pagination.InvalidCursor на битом курсоре.
+        """
+        values = decode_cursor(after, sort) if after else None
+        cursor = self.collection.find(keyset_filter(query, sort, values), projection).sort(sort).limit(limit + 1)
+        docs = await cursor.to_list(length=limit + 1)
+        next_cursor = encode_cursor(docs[limit - 1], sort) if len(docs) > limit else None
+        return docs[:limit], next_cursor
+
+    async def changed_since(self, since: datetime, after: Optional[list] = None, limit: int = 500,
+                            projection: Optional[dict] = None) -> List[dict]:
+        """
+        Тикеты с updated_at >= since по возрастанию версии; after — значения
+        (updated_at, _id) последнего документа предыдущей пачки.
+        """
+        query = queries.changed_tickets(since)
+        cursor = self.collection.find(keyset_filter(query, queries.CHANGES_SORT, after), projection)
+        return await cursor.sort(queries.CHANGES_SORT).limit(limit).to_list(length=limit)
+
+    async def latest_version(self) -> Optional[datetime]:
+        doc = await self.collection.find_one({}, {"updated_at": 1}, sort=queries.LATEST_CHANGE_SORT)
+        return doc.get("updated_at") if doc else None
+
+    async def update(self, query: dict, update: dict) -> int:
+        result = await self.collection.update_one(query, _touched(update))
+        return result.modified_count
+
+    async def update_by_id(self, ticket_id, update: dict) -> int:
+        oid = to_object_id(ticket_id)
+        if oid is None:
+            return 0
+        return await self.update({"_id": oid}, update)
+
+    async def update_by_topic(self, topic_id: int, update: dict) -> int:
+        return await self.update(queries.by_topic(topic_id), update)
+
+    async def update_by_topic_returning_id(self, topic_id: int, update: dict) -> Optional[ObjectId]:
+        """update_one по topic_id, возвращает _id тикета (или None) за тот же round-trip."""
+        doc = await self.collection.find_one_and_update(queries.by_topic(topic_id), _touched(update), projection={"_id": 1})
+        return doc["_id"] if doc else None
+
+    async def update_live_by_client(self, client_id: int, update: dict) -> int:
+        return await self.update(queries.live_by_client(client_id), update)
+
+    async def push_attachment(self, topic_id: int, attachment: dict) -> int:
+        return await self.update_by_topic(topic_id, {"$push": {"attachments": attachment}})
+
+    async def mark_closed(self, query: dict) -> int:
+        """Закрывает тикет; удалением из горячей коллекции занимается архиватор."""
+        return await self.update(query, {"$set": {"status": "closed", "closed_at": datetime.now(timezone.utc)}})
+
+    def write_buffer(self, topic_id: int, ticket_id: ObjectId = None) -> "TicketWriteBuffer":
+        return TicketWriteBuffer(self.collection, queries.by_topic(topic_id), TicketMessageRepository(self.db), ticket_id,
+                                 TicketEventRepository(self.db), topic_id)
+
+
+class TicketMessageRepository:
+    """
+    Переписка тикета в коллекции ticket_messages, бакетами по MESSAGE_BUCKET_SIZE
+    сообщений: {ticket_id, first_ts, last_ts, count, messages: [...]}.
+    Документ тикета не растёт с каждым сообщением.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase = None):
+        self.collection = (db if db is not None else get_async_db()).ticket_messages
+
+    async def append(self, ticket_id: ObjectId, records: List[dict]):
+        """Дописывает сообщения в последний незаполненный бакет (или создаёт новый)."""
+        if not records:
+            return
+        now = datetime.now(timezone.utc)
+        records = [{**r, "ts": r.get("ts") or now} for r in records]
+        await self.collection.update_one(
+            queries.open_bucket(ticket_id, MESSAGE_BUCKET_SIZE),
+            {
+                "$push": {"messages": {"$each": records}},
+                "$inc": {"count": len(records)},
+                "$min": {"first_ts": records[0]["ts"]},
+                "$max": {"last_ts": records[-1]["ts"]},
+            },
+            upsert=True,
+        )
+
+    async def page(self, ticket_id: ObjectId, before: Optional[str] = None,
+                   limit: int = 30) -> Tuple[List[dict], Optional[str]]:
+        """
+        До `limit` сообщений строго раньше курсора `before` (или последних), по
+        возрастанию времени, и курсор на более ранние (None — их нет).
+        Читает бакеты от новых к старым и останавливается, как только набрано достаточно.
+        Бросает pagination.InvalidCursor на битом курсоре.
+        """
+        before_key = None
+        if before:
+            ts, bucket_id, pos = decode_cursor(before, queries.MESSAGES_CURSOR)
+            if not isinstance(ts, datetime) or not isinstance(bucket_id, ObjectId) or not isinstance(pos, int):
+                raise InvalidCursor("cursor does not match message order")
+            if ts.tzinfo is not None:
+                # pymongo отдаёт naive UTC — сравниваем в том же виде
+                ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+            before_key = (ts, bucket_id, pos)
+        collected: List[tuple] = []
+        query = queries.buckets_before(ticket_id, before_key[0] if before_key else None)
+        cursor = self.collection.find(query, {"messages": 1}).sort(queries.BUCKETS_NEWEST_FIRST)
+        async for bucket in cursor:
+            keyed = [((m["ts"], bucket["_id"], pos), m) for pos, m in enumerate(bucket.get("messages", []))]
+            if before_key is not None:
+                keyed = [item for item in keyed if item[0] < before_key]
+            collected = keyed + collected
+            if len(collected) > limit:
+                break
+        collected.sort(key=lambda item: item[0])
+        page = collected[-limit:]
+        next_before = None
+        if len(collected) > limit:
+            ts, bucket_id, pos = page[0][0]
+            next_before = encode_cursor({"ts": ts, "bucket": bucket_id, "pos": pos}, queries.MESSAGES_CURSOR)
+        return [m for _, m in page], next_before
+
+
+def _paths_overlap(a: str, b: str) -> bool:
+    return a == b or a.startswith(b + ".") or b.startswith(a + ".")
+
+
+class TicketWriteBuffer:
+    """
+    Собирает $set/$push одного тикета за время обработки update и пишет их
+    одним update_one. Если операции конфликтуют по пути (например, $set и $push
+    одного поля), начинается новая пачка, и все пачки уходят одним ordered
+    bulk_write — порядок операций сохраняется.
+
+    Сообщения переписки (message) копятся отдельно и дописываются в
+    ticket_messages одной операцией после обновления тикета. Если _id тикета
+    заранее неизвестен, последнее обновление идёт через find_one_and_update
+    и возвращает его за тот же round-trip.
+
+    События тикета (event) публикуются последними — когда подписчик придёт
+    за изменениями, запись уже видна.
+
+    Используется как async context manager: flush выполняется и при ошибке.
+    """
+
+    def __init__(self, collection, query: dict, messages: "TicketMessageRepository" = None,
+                 ticket_id: ObjectId = None, events: "TicketEventRepository" = None, topic_id: int = None):
+        self.collection = collection
+        self.query = query
+        self.messages = messages
+        self.ticket_id = ticket_id
+        self.events = events
+        self.topic_id = topic_id
+        self._batches: List[dict] = []
+        self._messages: List[dict] = []
+        self._events: List[tuple] = []
+
+    def set(self, fields: dict):
+        for field, value in fields.items():
+            self._batch_for("$set", field)["$set"][field] = value
+
+    def push(self, field: str, value):
+        self._batch_for("$push", field)["$push"].setdefault(field, []).append(value)
+
+    def message(self, record: dict):
+        """Сообщение переписки (уходит в ticket_messages); время — момент вызова, а не flush."""
+        self._messages.append({**record, "ts": record.get("ts") or datetime.now(timezone.utc)})
+
+    def event(self, event_type: str, status: str = None):
+        """Событие для ticket_events (публикуется после записи)."""
+        self._events.append((event_type, status))
+
+    def _batch_for(self, op: str, field: str) -> dict:
+        batch = self._batches[-1] if self._batches else None
+        if batch is None or self._conflicts(batch, op, field):
+            batch = {"$set": {}, "$push": {}}
+            self._batches.append(batch)
+        return batch
+
+    @staticmethod
+    def _conflicts(batch: dict, op: str, field: str) -> bool:
+        for batch_op, fields in batch.items():
+            for path in fields:
+                if batch_op == op and path == field:
+                    continue
+                if _paths_overlap(path, field):
+                    return True
+        return False
+
+    @staticmethod
+    def _to_update(batch: dict) -> dict:
+        update = {}
+        if batch["$set"]:
+            update["$set"] = batch["$set"]
+        if batch["$push"]:
+            update["$push"] = {field: {"$each": values} for field, values in batch["$push"].items()}
+        return update
+
+    async def flush(self):
+        batches, self._batches = self._batches, []
+        messages, self._messages = self._messages, []
+        events, self._events = self._events, []
+        updates = [self._to_update(b) for b in batches]
+        if messages and not updates:
+            updates = [{}]
+        if updates:
+            updates[-1] = _touched(updates[-1])
+        if messages and self.ticket_id is None:
+            # Без _id сообщения не к чему привязать — берём его из последнего обновления
+            if len(updates) > 1:
+                await self.collection.bulk_write([UpdateOne(self.query, u) for u in updates[:-1]], ordered=True)
+            doc = await self.collection.find_one_and_update(self.query, updates[-1], projection={"_id": 1})
+            self.ticket_id = doc["_id"] if doc else None
+        elif len(updates) == 1:
+            await self.collection.update_one(self.query, updates[0])
+        elif updates:
+            await self.collection.bulk_write([UpdateOne(self.query, u) for u in updates], ordered=True)
+        if messages and self.messages is not None:
+            if self.ticket_id is not None:
+                await self.messages.append(self.ticket_id, messages)
+            else:
+                logger.warning(f"Ticket for topic {self.topic_id} not found, dropped {len(messages)} message(s)")
+        if self.events is not None:
+            for event_type, status in events:
+                await self.events.publish(event_type, self.ticket_id, self.topic_id, status)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.flush()
+        except Exception as e:
+            if exc_type is None:
+                raise
+            # Не подменяем исходную ошибку обработчика
+            logger.error(f"Ticket write buffer flush failed: {e}")
+        return False
+
+
+# Типы событий ticket_events (push в Mini App, routers/events.py)
+EVENT_CREATE = "create"
+EVENT_ESCALATE = "escalate"
+EVENT_REPLY = "reply"
+EVENT_CLOSE = "close"
+EVENT_REMOVE = "remove"
+
+# На сколько секунд назад перечитывать при возобновлении по Last-Event-ID:
+# _id событий из бота и backend упорядочены только примерно
+EVENT_RESUME_OVERLAP_SECONDS = 2
+
+
+class TicketEventRepository:
+    """
+    Журнал событий по тикетам в capped-коллекции ticket_events (её создаёт
+    database.indexes.ensure_capped_collections). Пишут TicketService и бот,
+    читает SSE-эндпоинт tailable-курсором — работает и без replica set.
+    Доставка "хотя бы один раз": событие — сигнал перечитать /api/tickets/changes.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase = None):
+        self.collection = (db if db is not None else get_async_db()).ticket_events
+
+    async def publish(self, event_type: str, ticket_id=None, topic_id: int = None, status: str = None):
+        """Ошибка публикации не должна ломать саму операцию с тикетом — только логируем."""
+        try:
+            await self.collection.insert_one({
+                "type": event_type,
+                "ticket_id": str(ticket_id) if ticket_id is not None else None,
+                "topic_id": topic_id,
+                "status": status,
+                "ts": datetime.now(timezone.utc),
+            })
+        except Exception as e:
+            logger.error(f"Ticket event publish failed ({event_type}, {ticket_id}): {e}")
+
+    async def oldest_id(self) -> Optional[ObjectId]:
+        doc = await self.collection.find_one({}, {"_id": 1}, sort=[("$natural", 1)])
+        return doc["_id"] if doc else None
+
+    async def newest_id(self) -> Optional[ObjectId]:
+        doc = await self.collection.find_one({}, {"_id": 1}, sort=[("$natural", -1)])
+        return doc["_id"] if doc else None
+
+    @staticmethod
+    def resume_point(after: ObjectId) -> ObjectId:
+        """С какого _id перечитывать после события `after` (с перекрытием)."""
+        since = after.generation_time - timedelta(seconds=EVENT_RESUME_OVERLAP_SECONDS)
+        return ObjectId.from_datetime(since)
+
+    def tail(self, start: ObjectId, max_await_ms: int = 15000):
+        """
+        Tailable-курсор по событиям с _id >= start. Запрос должен что-то найти —
+        иначе сервер сразу закрывает курсор, поэтому start — существующее событие
+        (последнее отданное или самое свежее) либо точка возобновления.
+        """
+        query = {"_id": {"$gte": start}}
+        return self.collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT).max_await_time_ms(max_await_ms)
+
+
+class SettingsRepository:
+    """Запись в settings. Чтение — через кэш (utils.db_config.get_settings_snapshot)."""
+
+    def __init__(self, db: AsyncIOMotorDatabase = None):
+        self.collection = (db if db is not None else get_async_db()).settings
+
+    async def get(self) -> dict:
+        return await self.collection.find_one({}, {"_id": 0}) or {}
+
+    async def update(self, fields: dict) -> int:
+        result = await self.collection.update_one({}, {"$set": fields})
+        invalidate_settings()
+        return result.modified_count
+
+
+class AIProviderRepository:
+    def __init__(self, db: AsyncIOMotorDatabase = None):
+        self.collection = (db if db is not None else get_async_db()).ai_providers
+
+    async def list(self) -> List[dict]:
+        return await self.collection.find({}, {"_id": 0}).to_list(length=None)
+
+    async def get(self, name: str) -> Optional[dict]:
+        return await self.collection.find_one(queries.provider_by_name(name), {"_id": 0})
+
+    async def update(self, name: str, update: dict) -> int:
+        result = await self.collection.update_one(queries.provider_by_name(name), update)
+        invalidate_ai_providers()
+        return result.modified_count
+
+
+class AIStatsRepository:
+    """Сводки статистики AI-вызовов по процессам (services/ai/reporter.py)."""
+
+    def __init__(self, db: AsyncIOMotorDatabase = None):
+        self.collection = (db if db is not None else get_async_db()).ai_stats
+
+    async def save(self, source: str, sections: dict):
+        await self.collection.update_one(
+            {"_id": source},
+            {"$set": {**sections, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+
+    async def list(self) -> List[dict]:
+        return await self.collection.find({}).to_list(length=None)
+
+
+class AICallRepository:
+    """
+    Попытки AI-вызовов (services/ai/telemetry.py) в time-series коллекции
+    ai_calls (её создаёт database.indexes.ensure_timeseries_collections).
+    """
+
+    # Исходы, которые считаются ошибкой провайдера/ключа
+    ERROR_STATUSES = ["error", "key_limit", "empty"]
+
+    def __init__(self, db: AsyncIOMotorDatabase = None):
+        self.collection = (db if db is not None else get_async_db()).ai_calls
+
+    async def insert_many(self, docs: List[dict]):
+        if docs:
+            await self.collection.insert_many(docs, ordered=False)
+
+    async def aggregate(self, group_id: dict, since: datetime) -> List[dict]:
+        """
+        Счётчики, токены, стоимость и p50/p95 задержки удачных попыток по группам
+        group_id. Перцентили считает сервер ($percentile, MongoDB 7+) — задержки
+        всех попыток за период в приложение не выгружаются.
+        """
+        def count_if(condition):
+            return {"$sum": {"$cond": [condition, 1, 0]}}
+
+        pipeline = [
+            {"$match": queries.ai_calls_since(since)},
+            {"$group": {
+                "_id": group_id,
+                "calls": {"$sum": 1},
+                "ok": count_if({"$eq": ["$status", "ok"]}),
+                "errors": count_if({"$in": ["$status", self.ERROR_STATUSES]}),
+                "key_limits": count_if({"$eq": ["$status", "key_limit"]}),
+                "cancelled": count_if({"$eq": ["$status", "cancelled"]}),
+                "overloaded": count_if({"$eq": ["$status", "overloaded"]}),
+                "failovers": count_if("$failover"),
+                "prompt_tokens": {"$sum": "$prompt_tokens"},
+                "completion_tokens": {"$sum": "$completion_tokens"},
+                "cost_usd": {"$sum": {"$ifNull": ["$cost_usd", 0]}},
+                # null (неудачные попытки) $percentile пропускает
+                "latency_pct": {"$percentile": {
+                    "input": {"$cond": [{"$eq": ["$status", "ok"]}, "$latency_ms", None]},
+                    "p": [0.5, 0.95],
+                    "method": "approximate",
+                }},
+            }},
+            {"$sort": {"_id": 1}},
+        ]
+        return await self.collection.aggregate(pipeline).to_list(length=None)
+
+
+class KnowledgeRepository:
+    def __init__(self, db: AsyncIOMotorDatabase = None):
+        db = db if db is not None else get_async_db()
+        self.collection = db.knowledge_base
+        self.settings = db.settings
+
+    async def _bump_version(self):
+        """settings.kb_version — ключ кэша ответов AI (services/ai/answer_cache.py)."""
+        await self.settings.update_one({}, {"$inc": {"kb_version": 1}})
+        invalidate_settings()
+
+    async def list(self, limit: int = 0) -> List[dict]:
+        cursor = self.collection.find({}).sort(queries.KNOWLEDGE_RECENT_SORT)
+        if limit:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(length=limit or None)
+
+    async def get(self, article_id) -> Optional[dict]:
+        oid = to_object_id(article_id)
+        if oid is None:
+            return None
+        return await self.collection.find_one({"_id": oid})
+
+    async def count(self) -> int:
+        return await self.collection.count_documents({})
+
+    async def create(self, title: str, content: str, category: str = "general") -> ObjectId:
+        now = datetime.now(timezone.utc).isoformat()
+        result = await self.collection.insert_one({
+            "title": title,
+            "content": content,
+            "category": category,
+            "created_at": now,
+            "updated_at": now,
+        })
+        await self._bump_version()
+        return result.inserted_id
+
+    async def update(self, article_id, fields: dict) -> int:
+        oid = to_object_id(article_id)
+        if oid is None:
+            return 0
+        fields = {**fields, "updated_at": datetime.now(timezone.utc).isoformat()}
+        result = await self.collection.update_one({"_id": oid}, {"$set": fields})
+        if result.modified_count:
+            await self._bump_version()
+        return result.modified_count
+
+    async def delete(self, article_id) -> int:
+        oid = to_object_id(article_id)
+        if oid is None:
+            return 0
+        result = await self.collection.delete_one({"_id": oid})
+        if result.deleted_count:
+            await self._bump_version()
+        return result.deleted_count
+
+    async def search(self, words: List[str], limit: int = 20) -> List[dict]:
+        """Полнотекстовый поиск по текстовому индексу (title > category > content), лучшие сверху."""
+        if not words:
+            return []
+        cursor = self.collection.find(queries.knowledge_text_search(words), queries.TEXT_SCORE)
+        return await cursor.sort(queries.TEXT_SCORE_SORT).limit(limit).to_list(length=limit)
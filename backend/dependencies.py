@@ -1,7 +1,8 @@
 from fastapi import Depends
-from utils.db_config import get_db, get_bot_token, get_support_group_id
+from utils.db_config import get_db, get_async_db, get_bot_token, get_support_group_id
 from services.telegram_service import TelegramService
 from services.ticket_service import TicketService
+from services.ai.manager import AIProviderManager
 
 async def get_database():
     """Dependency for database connection."""
@@ -10,6 +11,10 @@ async def get_database():
         raise Exception("Database connection failed")
     yield db
 
+async def get_async_database():
+    """Dependency for the async (Motor) database."""
+    return get_async_db()
+
 async def get_telegram_service():
     """Dependency for TelegramService."""
     token = get_bot_token()
@@ -21,9 +26,13 @@ async def get_telegram_service():
     return TelegramService(token)
 
 async def get_ticket_service(
-    db = Depends(get_database),
+    db = Depends(get_async_database),
     telegram_service: TelegramService = Depends(get_telegram_service)
 ):
     """Dependency for TicketService."""
     support_group_id = get_support_group_id()
     return TicketService(db, telegram_service, support_group_id)
+
+async def get_ai_manager(db = Depends(get_database)):
+    """Dependency for AIProviderManager (uses the shared client)."""
+    return AIProviderManager(db)
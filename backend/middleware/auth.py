@@ -6,7 +6,7 @@ import urllib.parse
 import os
 from typing import Dict, Optional
 
-from fastapi import Header, HTTPException, Depends, Request
+from fastapi import Header, HTTPException, Depends, Query, Request
 from utils.db_config import get_bot_token
 
 async def verify_telegram_auth(
@@ -16,6 +16,22 @@ async def verify_telegram_auth(
     Validates Telegram WebApp initData.
     Expects header: X-Telegram-Init-Data
     """
+    return validate_init_data(x_telegram_init_data)
+
+
+async def verify_telegram_auth_query(
+    init_data: Optional[str] = Query(None),
+    x_telegram_init_data: Optional[str] = Header(None, alias="X-Telegram-Init-Data")
+):
+    """
+    То же, что verify_telegram_auth, но initData можно передать в ?init_data=
+    (EventSource не умеет ставить заголовки).
+    """
+    return validate_init_data(x_telegram_init_data or init_data)
+
+
+def validate_init_data(x_telegram_init_data: Optional[str]) -> dict:
+    """Проверка подписи initData; возвращает пользователя Telegram."""
     # SKIP_AUTH for local development/debugging
     skip_auth = os.environ.get("SKIP_AUTH", "false").lower() == "true"
 
@@ -0,0 +1,104 @@
+"""
+Events Router — push-обновления тикетов в Mini App (Server-Sent Events)
+
+События (create / escalate / reply / close / remove) пишут TicketService и бот
+в capped-коллекцию ticket_events; здесь они читаются tailable-курсором и
+отдаются потоком. Браузер сам переподключается с заголовком Last-Event-ID,
+и поток продолжается с того же места. Если событие уже вытеснено из
+capped-коллекции, приходит `event: reset` — клиент перечитывает список целиком.
+"""
+import asyncio
+import json
+import logging
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, Query, Request
+from fastapi.responses import StreamingResponse
+
+from database.repositories import TicketEventRepository, to_object_id
+from dependencies import get_async_database
+from middleware.auth import verify_telegram_auth_query
+from middleware.rate_limit import limiter
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(dependencies=[Depends(verify_telegram_auth_query)])
+
+# Раз в столько секунд шлём комментарий-пинг (прокси не рвут соединение, отвалившийся клиент замечаем)
+HEARTBEAT_SECONDS = 15
+
+
+def _sse(event: str, data: dict, event_id: str = None) -> str:
+    lines = []
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def _serialize_event(doc: dict) -> dict:
+    return {
+        "type": doc.get("type"),
+        "ticket_id": doc.get("ticket_id"),
+        "topic_id": doc.get("topic_id"),
+        "status": doc.get("status"),
+        "ts": doc["ts"].isoformat() + "Z" if doc.get("ts") else None,
+    }
+
+
+async def _stream(request: Request, events: TicketEventRepository, last_event_id: Optional[str]):
+    # Браузер повторит подключение через retry мс
+    yield "retry: 3000\n\n"
+
+    resume_from = None
+    if last_event_id:
+        after = to_object_id(last_event_id)
+        oldest = await events.oldest_id()
+        if after is None or (oldest is not None and after < oldest):
+            # Пропущенные события уже вытеснены — только полная перезагрузка
+            yield _sse("reset", {})
+        else:
+            resume_from = events.resume_point(after)
+
+    last_sent = None
+    while not await request.is_disconnected():
+        if resume_from is not None:
+            # Возобновление: повторы допустимы, ничего не пропускаем
+            start, skip_id, resume_from = resume_from, None, None
+        else:
+            # Продолжаем с последнего отданного (или с текущего конца) — его самого не повторяем
+            start = last_sent or await events.newest_id()
+            skip_id = start
+        if start is None:
+            # Событий ещё не было
+            yield ": ping\n\n"
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            continue
+
+        cursor = events.tail(start, max_await_ms=HEARTBEAT_SECONDS * 1000)
+        while cursor.alive and not await request.is_disconnected():
+            async for doc in cursor:
+                if doc["_id"] == skip_id:
+                    continue
+                last_sent = doc["_id"]
+                yield _sse("ticket", _serialize_event(doc), str(doc["_id"]))
+            yield ": ping\n\n"
+        # Курсор закрыт сервером (вытеснение, перезапуск) — открываем заново
+        await asyncio.sleep(1)
+
+
+@router.get("/tickets")
+@limiter.limit("30/minute")
+async def ticket_events(
+    request: Request,
+    last_event_id: Optional[str] = Query(None),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+    db=Depends(get_async_database),
+):
+    """Stream of ticket events (text/event-stream); resume via Last-Event-ID"""
+    return StreamingResponse(
+        _stream(request, TicketEventRepository(db), last_event_id_header or last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
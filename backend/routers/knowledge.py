@@ -1,31 +1,28 @@
-from fastapi import APIRouter, Body
-from pymongo import MongoClient
-from bson import ObjectId
-from datetime import datetime, timezone
-import os
+from fastapi import APIRouter, Body, Depends
+
+from database.repositories import KnowledgeRepository, to_object_id
+from dependencies import get_async_database
 
 router = APIRouter()
 
-MONGO_URL = os.environ.get("MONGO_URL")
-DB_NAME = os.environ.get("DB_NAME", "reshala_support")
-client = MongoClient(MONGO_URL)
-db = client[DB_NAME]
+
+async def get_knowledge_repo(db = Depends(get_async_database)):
+    return KnowledgeRepository(db)
 
 
 @router.get("")
-def get_articles():
-    articles = list(db.knowledge_base.find({}).sort("updated_at", -1))
+async def get_articles(repo: KnowledgeRepository = Depends(get_knowledge_repo)):
+    articles = await repo.list()
     for a in articles:
         a["id"] = str(a.pop("_id"))
     return {"articles": articles}
 
 
 @router.get("/{article_id}")
-def get_article(article_id: str):
-    try:
-        doc = db.knowledge_base.find_one({"_id": ObjectId(article_id)})
-    except Exception:
+async def get_article(article_id: str, repo: KnowledgeRepository = Depends(get_knowledge_repo)):
+    if to_object_id(article_id) is None:
         return {"ok": False, "error": "invalid_id"}
+    doc = await repo.get(article_id)
     if not doc:
         return {"ok": False, "error": "not_found"}
     doc["id"] = str(doc.pop("_id"))
@@ -33,29 +30,19 @@ def get_article(article_id: str):
 
 
 @router.post("")
-def create_article(data: dict = Body(...)):
+async def create_article(data: dict = Body(...), repo: KnowledgeRepository = Depends(get_knowledge_repo)):
     title = (data.get("title") or "").strip()
     content = (data.get("content") or "").strip()
     category = (data.get("category") or "general").strip()
     if not title or not content:
         return {"ok": False, "error": "title and content required"}
-    now = datetime.now(timezone.utc).isoformat()
-    doc = {
-        "title": title,
-        "content": content,
-        "category": category,
-        "created_at": now,
-        "updated_at": now,
-    }
-    result = db.knowledge_base.insert_one(doc)
-    return {"ok": True, "id": str(result.inserted_id)}
+    inserted_id = await repo.create(title, content, category)
+    return {"ok": True, "id": str(inserted_id)}
 
 
 @router.put("/{article_id}")
-def update_article(article_id: str, data: dict = Body(...)):
-    try:
-        oid = ObjectId(article_id)
-    except Exception:
+async def update_article(article_id: str, data: dict = Body(...), repo: KnowledgeRepository = Depends(get_knowledge_repo)):
+    if to_object_id(article_id) is None:
         return {"ok": False, "error": "invalid_id"}
     update = {}
     for k in ["title", "content", "category"]:
@@ -63,27 +50,22 @@ def update_article(article_id: str, data: dict = Body(...)):
             update[k] = data[k]
     if not update:
         return {"ok": False, "error": "nothing to update"}
-    update["updated_at"] = datetime.now(timezone.utc).isoformat()
-    db.knowledge_base.update_one({"_id": oid}, {"$set": update})
+    await repo.update(article_id, update)
     return {"ok": True}
 
 
 @router.delete("/{article_id}")
-def delete_article(article_id: str):
-    try:
-        oid = ObjectId(article_id)
-    except Exception:
+async def delete_article(article_id: str, repo: KnowledgeRepository = Depends(get_knowledge_repo)):
+    if to_object_id(article_id) is None:
         return {"ok": False, "error": "invalid_id"}
-    result = db.knowledge_base.delete_one({"_id": oid})
-    return {"ok": result.deleted_count > 0}
+    deleted = await repo.delete(article_id)
+    return {"ok": deleted > 0}
 
 
 @router.get("/search/{query}")
-def search_articles(query: str):
-    regex = {"$regex": query, "$options": "i"}
-    articles = list(db.knowledge_base.find(
-        {"$or": [{"title": regex}, {"content": regex}, {"category": regex}]}
-    ).sort("updated_at", -1).limit(20))
+async def search_articles(query: str, repo: KnowledgeRepository = Depends(get_knowledge_repo)):
+    articles = await repo.search(query.split(), limit=20)
     for a in articles:
         a["id"] = str(a.pop("_id"))
+        a.pop("score", None)
     return {"articles": articles}
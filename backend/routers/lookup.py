@@ -1,23 +1,20 @@
 from fastapi import APIRouter, Body, Header
 from typing import Optional
 import requests
-import os
 import logging
 
+from utils.db_config import get_settings_snapshot
+
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
 def _get_remnawave_config():
-    from pymongo import MongoClient
-    MONGO_URL = os.environ.get("MONGO_URL")
-    DB_NAME = os.environ.get("DB_NAME", "reshala_support")
-    client = MongoClient(MONGO_URL)
-    db = client[DB_NAME]
-    settings = db.settings.find_one({}, {"_id": 0})
-    if not settings:
+    # Берём из общего снимка настроек — без похода в MongoDB на каждый запрос
+    settings = get_settings_snapshot()
+    if not settings.data:
         return None, None
-    return settings.get("remnawave_api_url", "").rstrip("/"), settings.get("remnawave_api_token", "")
+    return (settings.get("remnawave_api_url") or "").rstrip("/"), settings.get("remnawave_api_token", "")
 
 
 @router.post("")
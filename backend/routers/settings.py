@@ -6,10 +6,11 @@ import os
 
 # Add utils to path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from utils.db_config import get_db, get_settings
+from utils.db_config import get_settings
+from database.repositories import SettingsRepository, AIProviderRepository
+from dependencies import get_async_database
 
 router = APIRouter()
-db = get_db()
 
 
 def mask_secret(secret: str) -> str:
@@ -33,7 +34,11 @@ def get_settings_endpoint(user_data: dict = Depends(verify_telegram_auth)):
 
 
 @router.put("")
-def update_settings(data: dict = Body(...), user_data: dict = Depends(verify_telegram_auth)):
+async def update_settings(
+    data: dict = Body(...),
+    user_data: dict = Depends(verify_telegram_auth),
+    db = Depends(get_async_database),
+):
     protected = ["_id"]
     update = {}
     
@@ -47,13 +52,13 @@ def update_settings(data: dict = Body(...), user_data: dict = Depends(verify_tel
         
     if not update:
         return {"ok": False, "error": "nothing to update"}
-    db.settings.update_one({}, {"$set": update})
+    await SettingsRepository(db).update(update)
     return {"ok": True}
 
 
 @router.get("/providers")
-def get_providers():
-    providers = list(db.ai_providers.find({}, {"_id": 0}))
+async def get_providers(db = Depends(get_async_database)):
+    providers = await AIProviderRepository(db).list()
     for p in providers:
         keys = p.get("api_keys", [])
         p["keys_count"] = len(keys)
@@ -62,27 +67,28 @@ def get_providers():
 
 
 @router.put("/providers/{name}")
-def update_provider(name: str, data: dict = Body(...)):
+async def update_provider(name: str, data: dict = Body(...), db = Depends(get_async_database)):
     protected = ["_id", "name"]
     update = {k: v for k, v in data.items() if k not in protected}
     if not update:
         return {"ok": False, "error": "nothing to update"}
-    db.ai_providers.update_one({"name": name}, {"$set": update})
+    await AIProviderRepository(db).update(name, {"$set": update})
     return {"ok": True}
 
 
 @router.post("/providers/{name}/keys")
-def add_provider_key(name: str, data: dict = Body(...)):
+async def add_provider_key(name: str, data: dict = Body(...), db = Depends(get_async_database)):
     key = data.get("key", "").strip()
     if not key:
         return {"ok": False, "error": "key required"}
-    db.ai_providers.update_one({"name": name}, {"$addToSet": {"api_keys": key}})
+    await AIProviderRepository(db).update(name, {"$addToSet": {"api_keys": key}})
     return {"ok": True}
 
 
 @router.delete("/providers/{name}/keys/{index}")
-def remove_provider_key(name: str, index: int):
-    provider = db.ai_providers.find_one({"name": name})
+async def remove_provider_key(name: str, index: int, db = Depends(get_async_database)):
+    providers = AIProviderRepository(db)
+    provider = await providers.get(name)
     if not provider:
         return {"ok": False, "error": "provider not found"}
     keys = provider.get("api_keys", [])
@@ -91,8 +97,8 @@ def remove_provider_key(name: str, index: int):
         active_idx = provider.get("active_key_index", 0)
         if active_idx >= len(keys):
             active_idx = max(0, len(keys) - 1)
-        db.ai_providers.update_one(
-            {"name": name},
+        await providers.update(
+            name,
             {"$set": {"api_keys": keys, "active_key_index": active_idx}}
         )
         return {"ok": True}
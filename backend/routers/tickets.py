@@ -7,8 +7,9 @@ Tickets Router — управление тикетами поддержки
   🚨 suspicious — Подозрительный (пользователь не найден в системе)
   ✅ closed — Закрыт
 """
-from fastapi import APIRouter, Body, Depends, Request
-from typing import List
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request
+from datetime import datetime, timezone
+from typing import List, Optional
 import logging
 import sys
 import os
@@ -17,6 +18,8 @@ import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from services.ticket_service import TicketService
+from database import queries
+from database.pagination import InvalidCursor
 from dependencies import get_ticket_service
 from middleware.rate_limit import limiter
 from middleware.auth import verify_telegram_auth
@@ -25,11 +28,19 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter(dependencies=[Depends(verify_telegram_auth)])
 
-def serialize_ticket(ticket):
-    """Convert MongoDB document to JSON-serializable dict"""
+# Поля, которые можно запросить через ?fields= (id возвращается всегда)
+TICKET_FIELDS = (
+    "client_id", "client_name", "client_username", "topic_id", "status", "reason",
+    "escalated_at", "created_at", "closed_at", "last_messages", "user_data",
+    "attachments", "is_removed", "ai_disabled", "conversation_summary",
+)
+
+
+def serialize_ticket(ticket, fields=None):
+    """Convert MongoDB document to JSON-serializable dict (only `fields`, if given)"""
     if not ticket:
         return None
-    return {
+    data = {
         "id": str(ticket.get("_id", "")),
         "client_id": ticket.get("client_id"),
         "client_name": ticket.get("client_name"),
@@ -41,44 +52,97 @@ def serialize_ticket(ticket):
         "created_at": ticket.get("created_at").isoformat() if ticket.get("created_at") else None,
         "closed_at": ticket.get("closed_at").isoformat() if ticket.get("closed_at") else None,
         "last_messages": ticket.get("last_messages", []),
-        "history": ticket.get("history", []),
         "user_data": ticket.get("user_data"),
         "attachments": ticket.get("attachments", []),
         "is_removed": ticket.get("is_removed", False),
+        "ai_disabled": ticket.get("ai_disabled", False),
+        "conversation_summary": ticket.get("conversation_summary"),
     }
+    if fields is not None:
+        data = {k: v for k, v in data.items() if k == "id" or k in fields}
+    return data
+
+
+def parse_fields(fields: Optional[str]) -> tuple:
+    """?fields=a,b,c -> кортеж полей; по умолчанию — лёгкая проекция для списков"""
+    if not fields:
+        return queries.TICKET_LIST_FIELDS
+    requested = tuple(f.strip() for f in fields.split(",") if f.strip() and f.strip() != "id")
+    unknown = [f for f in requested if f not in TICKET_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+
+async def _ticket_page(fetch, after: Optional[str], limit: int, fields: Optional[str]) -> dict:
+    selected = parse_fields(fields)
+    try:
+        tickets, next_cursor = await fetch(limit=limit, after=after, projection=queries.ticket_projection(selected))
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="invalid_cursor")
+    return {"tickets": [serialize_ticket(t, selected) for t in tickets], "next_cursor": next_cursor}
+
+
+@router.get("/changes")
+@limiter.limit("120/minute")
+async def get_ticket_changes(
+    request: Request,
+    since: str,
+    fields: Optional[str] = None,
+    ticket_service: TicketService = Depends(get_ticket_service)
+):
+    """Delta of the active list since sync_token (from /active or a previous /changes)"""
+    selected = parse_fields(fields)
+    try:
+        changes = await ticket_service.get_changes(since, projection=queries.ticket_projection(selected))
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="invalid_token")
+    changes["tickets"] = [serialize_ticket(t, selected) for t in changes["tickets"]]
+    return changes
 
 
 @router.get("/escalated")
 @limiter.limit("30/minute")
 async def get_escalated_tickets(
     request: Request,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=100),
+    fields: Optional[str] = None,
     ticket_service: TicketService = Depends(get_ticket_service)
 ):
     """Get escalated (🔥) tickets only"""
-    tickets = await ticket_service.get_escalated_tickets()
-    return {"tickets": [serialize_ticket(t) for t in tickets]}
+    return await _ticket_page(ticket_service.get_escalated_tickets, after, limit, fields)
 
 
 @router.get("/active")
 @limiter.limit("30/minute")
 async def get_active_tickets(
     request: Request,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=100),
+    fields: Optional[str] = None,
     ticket_service: TicketService = Depends(get_ticket_service)
 ):
     """Get all active tickets (escalated + suspicious) — без open (они у AI) и closed!"""
-    tickets = await ticket_service.get_active_tickets()
-    return {"tickets": [serialize_ticket(t) for t in tickets]}
+    # Токен берём до чтения списка: изменения во время чтения придут в /changes
+    sync_token = await ticket_service.get_sync_token() if after is None else None
+    page = await _ticket_page(ticket_service.get_active_tickets, after, limit, fields)
+    if sync_token:
+        page["sync_token"] = sync_token
+    return page
 
 
 @router.get("/suspicious")
 @limiter.limit("30/minute")
 async def get_suspicious_tickets(
     request: Request,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=100),
+    fields: Optional[str] = None,
     ticket_service: TicketService = Depends(get_ticket_service)
 ):
     """Get suspicious (🚨) tickets — users not found in system"""
-    tickets = await ticket_service.get_suspicious_tickets()
-    return {"tickets": [serialize_ticket(t) for t in tickets]}
+    return await _ticket_page(ticket_service.get_suspicious_tickets, after, limit, fields)
 
 
 @router.get("/{ticket_id}")
@@ -98,6 +162,45 @@ async def get_ticket(
         return {"ok": False, "error": str(e)}
 
 
+def _utc_iso(value: datetime) -> str:
+    return value.replace(tzinfo=value.tzinfo or timezone.utc).isoformat()
+
+
+def serialize_message(message: dict) -> dict:
+    """Сообщение из ticket_messages -> JSON (ts как ISO в UTC)"""
+    data = {k: v for k, v in message.items() if k != "ts"}
+    data["ts"] = _utc_iso(message["ts"]) if message.get("ts") else None
+    data.setdefault("timestamp", data["ts"])
+    return data
+
+
+@router.get("/{ticket_id}/messages")
+@limiter.limit("60/minute")
+async def get_ticket_messages(
+    request: Request,
+    ticket_id: str,
+    before: Optional[str] = None,
+    limit: int = Query(30, ge=1, le=100),
+    ticket_service: TicketService = Depends(get_ticket_service)
+):
+    """
+    Переписка тикета, страницами от новых к старым.
+    `before` — курсор (`next_before` из прошлого ответа): сообщения строго раньше него.
+    """
+    try:
+        result = await ticket_service.get_messages(ticket_id, before=before, limit=limit)
+    except InvalidCursor:
+        return {"ok": False, "error": "invalid_cursor"}
+    if result is None:
+        return {"ok": False, "error": "ticket_not_found"}
+    messages, next_before = result
+    return {
+        "ok": True,
+        "messages": [serialize_message(m) for m in messages],
+        "next_before": next_before,
+    }
+
+
 @router.post("/{ticket_id}/reply")
 @limiter.limit("20/minute")
 async def reply_to_ticket(
@@ -1,11 +1,14 @@
-import os
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
+
+# .env должен быть загружен до импорта модулей, читающих окружение (utils.db_config)
+load_dotenv()
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
 
 # Rate Limiting
 from slowapi import _rate_limit_exceeded_handler
@@ -16,21 +19,30 @@ from middleware.rate_limit import limiter
 from exception_handlers import add_exception_handlers
 
 # Database Indexes
-from database.indexes import ensure_indexes
+from database.indexes import MONGO_PRUNE_INDEXES, ensure_indexes, ensure_capped_collections, ensure_timeseries_collections
 
-load_dotenv()
+# Data migrations
+from database.migrations import LOCAL_PROVIDER, run_migrations
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
+# Ticket archival
+from services.archive_service import TicketArchiver
+
+# Пулы HTTP-соединений к AI-провайдерам
+from services.ai.transport import close_clients as close_ai_clients
+from services.ai.reporter import AIStatsReporter
+from services.ai.telemetry import AICallWriter
+
+# Shared MongoClient
+from utils.db_config import get_db, get_async_db, get_client, close_db, close_async_db, get_pool_stats, get_async_pool_stats
 
-MONGO_URL = os.environ.get("MONGO_URL")
-DB_NAME = os.environ.get("DB_NAME", "reshala_support")
+# Config change propagation (bot <-> backend)
+from utils.config_watcher import start_config_watcher, stop_config_watcher
 
-client = MongoClient(MONGO_URL)
-db = client[DB_NAME]
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 
-def init_default_settings():
+def init_default_settings(db):
     if db.settings.count_documents({}) == 0:
         db.settings.insert_one({
             "service_name": "Решала support",
@@ -53,25 +65,59 @@ def init_default_settings():
             {"name": "anthropic", "display_name": "Anthropic", "api_keys": [], "active_key_index": 0, "base_url": "https://api.anthropic.com", "models": [], "selected_model": "", "vision_model": "", "enabled": False, "proxy": ""},
             {"name": "google", "display_name": "Google AI (Gemini)", "api_keys": [], "active_key_index": 0, "base_url": "https://generativelanguage.googleapis.com/v1beta", "models": [], "selected_model": "", "vision_model": "", "enabled": False, "proxy": ""},
             {"name": "openrouter", "display_name": "OpenRouter", "api_keys": [], "active_key_index": 0, "base_url": "https://openrouter.ai/api/v1", "models": [], "selected_model": "", "vision_model": "", "enabled": False, "proxy": ""},
+            dict(LOCAL_PROVIDER),
         ]
         db.ai_providers.insert_many(providers)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Один MongoClient (и один пул соединений) на весь backend
+    db = get_db()
+    if db is None:
+        raise RuntimeError("MongoDB is not available")
+
     # Initialize settings
-    init_default_settings()
+    init_default_settings(db)
     
     # Create Indexes
     try:
-        await ensure_indexes(db)
+        await asyncio.to_thread(ensure_indexes, db, prune=MONGO_PRUNE_INDEXES)
         logger.info("MongoDB indexes verified.")
     except Exception as e:
         logger.error(f"Failed to create indexes: {e}")
+
+    # Журнал событий тикетов для push в Mini App
+    ensure_capped_collections(db)
+    # Телеметрия AI-вызовов (ai_calls)
+    ensure_timeseries_collections(db)
+
+    # Следим за изменениями settings/ai_providers (например, из бота)
+    start_config_watcher(db)
+
+    # Миграции данных — в фоне, чтобы не задерживать старт API
+    migrations = asyncio.create_task(run_migrations(get_async_db()))
+
+    # Перенос закрытых/убранных тикетов в архив
+    archiver = TicketArchiver(get_async_db())
+    archiver.start()
+
+    # Сводка статистики AI-вызовов backend
+    ai_stats = AIStatsReporter("backend", get_async_db())
+    ai_stats.start()
+    ai_calls = AICallWriter("backend", get_async_db())
+    ai_calls.start()
         
     logger.info("Решала support от DonMatteo - Backend started")
     yield
-    client.close()
+    archiver.stop()
+    migrations.cancel()
+    await ai_stats.stop()
+    await ai_calls.stop()
+    await close_ai_clients()
+    stop_config_watcher()
+    close_db()
+    close_async_db()
 
 
 app = FastAPI(title="Решала support от DonMatteo", lifespan=lifespan)
@@ -98,6 +144,7 @@ from routers.actions import router as actions_router
 from routers.knowledge import router as knowledge_router
 from routers.tickets import router as tickets_router
 from routers.bedolaga import router as bedolaga_router
+from routers.events import router as events_router
 
 app.include_router(settings_router, prefix="/api/settings", tags=["settings"])
 app.include_router(ai_router, prefix="/api/ai", tags=["ai"])
@@ -106,13 +153,14 @@ app.include_router(actions_router, prefix="/api/actions", tags=["actions"])
 app.include_router(knowledge_router, prefix="/api/knowledge", tags=["knowledge"])
 app.include_router(tickets_router, prefix="/api/tickets", tags=["tickets"])
 app.include_router(bedolaga_router, prefix="/api/bedolaga", tags=["bedolaga"])
+app.include_router(events_router, prefix="/api/events", tags=["events"])
 
 
 @app.get("/api/health")
 def health():
     # Simple check
     try:
-        client.admin.command('ping')
+        get_client().admin.command('ping')
         db_status = "connected"
     except Exception:
         db_status = "disconnected"
@@ -120,5 +168,7 @@ def health():
     return {
         "status": "ok", 
         "service": "Решала support от DonMatteo",
-        "database": db_status
+        "database": db_status,
+        "db_pool": get_pool_stats(),
+        "db_pool_async": get_async_pool_stats(),
     }
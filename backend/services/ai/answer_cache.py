@@ -0,0 +1,138 @@
+"""
+Кэш ответов AI на типовые вопросы ("не работает VPN", "когда истекает").
+
+Ключ: нормализованный вопрос + версия базы знаний (settings.kb_version,
+растёт при любой правке статей) + отпечаток шаблона системного промпта +
+грубый класс пользователя (active / expired / not_found). Смена статей или
+промпта меняет ключ — старые ответы просто перестают находиться и вытесняются.
+
+Кладём только ответы, которые годятся любому пользователю того же класса:
+первая реплика диалога, без эскалации и без фактов из контекста пользователя
+(дат, чисел, username, UUID). LRU + TTL, в памяти процесса.
+"""
+import os
+import re
+import time
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "500"))
+# settings.ai_cache_ttl, секунды
+DEFAULT_TTL = 3600
+# Длинные вопросы почти не повторяются дословно
+MAX_QUESTION_LENGTH = 200
+
+_NOT_WORD = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+_FACT_TOKEN = re.compile(r"[\w.@:/-]*\d[\w.@:/-]*")
+
+
+def normalize_question(text: str) -> Optional[str]:
+    """Нижний регистр, ё → е, без пунктуации и эмодзи; None — вопрос не кэшируем."""
+    text = _SPACES.sub(" ", _NOT_WORD.sub(" ", (text or "").lower().replace("ё", "е"))).strip()
+    if not text or len(text) > MAX_QUESTION_LENGTH:
+        return None
+    return text
+
+
+def prompt_fingerprint(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode()).hexdigest()[:16]
+
+
+def user_state_class(user_data: dict, has_provided_proof: bool = False) -> Optional[str]:
+    """active / expired / not_found; None — состояние нестандартное, ответ не кэшируем."""
+    if user_data.get("not_found"):
+        # После скриншота/ссылки промпт диктует особый ответ
+        return None if has_provided_proof else "not_found"
+    user = user_data.get("user")
+    if not user:
+        return None
+    status = str(user.get("status", "")).upper()
+    expired = status == "EXPIRED"
+    expire_at = user.get("expireAt")
+    if expire_at:
+        try:
+            expired = expired or datetime.fromisoformat(expire_at.replace("Z", "+00:00")) <= datetime.now(timezone.utc)
+        except ValueError:
+            return None
+    if expired:
+        return "expired"
+    return "active" if status == "ACTIVE" else None
+
+
+def user_facts(user_context: str, user_data: dict) -> set:
+    """Токены контекста пользователя, которых не должно быть в общем ответе: всё с цифрами и username."""
+    facts = {token.lower() for token in _FACT_TOKEN.findall(user_context or "")}
+    username = (user_data.get("user") or {}).get("username")
+    if username:
+        facts.add(username.lower())
+    return facts
+
+
+def mentions_user_facts(reply: str, facts: set) -> bool:
+    lowered = reply.lower()
+    reply_tokens = {token.lower() for token in _FACT_TOKEN.findall(reply)}
+    return bool(reply_tokens & facts) or any(not f[0].isdigit() and f in lowered for f in facts)
+
+
+class AnswerCache:
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple, Tuple[float, str]]" = OrderedDict()
+        self._generation: Optional[Tuple] = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @staticmethod
+    def key(question: str, kb_version: int, prompt: str, state: str) -> Optional[Tuple]:
+        normalized = normalize_question(question)
+        if normalized is None or state is None:
+            return None
+        return normalized, kb_version, prompt_fingerprint(prompt), state
+
+    def _check_generation(self, key: Tuple):
+        # Сменилась база знаний или промпт — старые записи уже не найдутся, освобождаем память
+        generation = key[1:3]
+        if generation != self._generation:
+            self._entries.clear()
+            self._generation = generation
+
+    def get(self, key: Optional[Tuple]) -> Optional[str]:
+        if key is None:
+            return None
+        self._check_generation(key)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Optional[Tuple], answer: str, ttl: float = DEFAULT_TTL):
+        if key is None or not answer:
+            return
+        self._check_generation(key)
+        self._entries[key] = (time.monotonic() + ttl, answer)
+        self._entries.move_to_end(key)
+        self.stores += 1
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+answer_cache = AnswerCache()
@@ -0,0 +1,71 @@
+"""
+Скользящее резюме длинного диалога с AI.
+
+В промпт уходят только последние ai_history_window реплик как есть и краткое
+резюме всего, что было раньше. Когда сверх окна накапливается SUMMARY_BATCH
+реплик, они в фоне сжимаются в резюме вместе с предыдущим резюме (ответ
+пользователю не ждёт). Размер промпта не растёт, сколько бы ни шёл диалог.
+"""
+import logging
+from typing import Callable, Dict, List, Optional
+
+from services.ai.dispatcher import PRIORITY_BACKGROUND, with_priority
+from services.ai.token_budget import truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+# settings.ai_history_window — сколько последних реплик отдаём модели как есть
+DEFAULT_HISTORY_WINDOW = 6
+# Сжимаем, когда сверх окна накопилось столько реплик
+SUMMARY_BATCH = 4
+SUMMARY_MAX_TOKENS = 250
+
+SUMMARY_PROMPT = """Ты ведёшь заметки службы поддержки VPN-сервиса.
+Сожми диалог клиента с ассистентом в краткое резюме для продолжения разговора:
+- в чём проблема клиента;
+- что уже выяснили (статус подписки, устройства, ошибки);
+- что клиенту уже советовали и чем это закончилось;
+- о чём договорились или что осталось нерешённым.
+Не больше 6 коротких пунктов, без приветствий и без выдуманных деталей.
+Если дано предыдущее резюме — дополни его, а не пересказывай заново."""
+
+ROLE_NAMES = {"user": "Клиент", "assistant": "Ассистент"}
+
+
+def history_window(settings) -> int:
+    return max(2, int(settings.get("ai_history_window", DEFAULT_HISTORY_WINDOW)))
+
+
+def overflow(history: List[Dict], window: int) -> List[Dict]:
+    """Реплики, которые пора сжать в резюме; пусто, если сжимать ещё рано."""
+    if len(history) < window + SUMMARY_BATCH:
+        return []
+    return history[:-window]
+
+
+def summary_messages(previous: str, turns: List[Dict]) -> List[Dict]:
+    transcript = "\n".join(f"{ROLE_NAMES.get(t['role'], t['role'])}: {t['content']}" for t in turns)
+    parts = []
+    if previous:
+        parts.append(f"Предыдущее резюме:\n{previous}")
+    parts.append(f"Новые реплики:\n{transcript}")
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": "\n\n".join(parts)},
+    ]
+
+
+async def summarize(ai_manager, previous: str, turns: List[Dict],
+                    clean: Callable[[str], str] = None) -> Optional[str]:
+    """
+    Новое резюме (предыдущее + turns) или None, если провайдеры не ответили.
+    clean — очистка ответа модели (например, от блоков <think>) до обрезки.
+    """
+    # Фоновая работа: живым ответам клиентам не мешает
+    with with_priority(PRIORITY_BACKGROUND):
+        reply = await ai_manager.achat(summary_messages(previous, turns), fallback=False)
+    if reply and clean is not None:
+        reply = clean(reply)
+    if not reply or not reply.strip():
+        return None
+    return truncate_to_tokens(reply.strip(), SUMMARY_MAX_TOKENS)
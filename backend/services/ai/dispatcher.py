@@ -0,0 +1,220 @@
+"""
+Диспетчер AI-запросов: приоритеты и лимиты одновременных запросов.
+
+Каждая попытка (ключ провайдера) сначала получает слот: не больше
+ai_max_concurrency_per_provider запросов к провайдеру и
+ai_max_concurrency_per_key к одному ключу одновременно. Остальные ждут в
+очереди, и освободившийся слот достаётся самому приоритетному ожидающему:
+
+    PRIORITY_LIVE        — ответы клиентам в боте
+    PRIORITY_MANAGER     — тестовый чат менеджера в Mini App
+    PRIORITY_BACKGROUND  — проверка ключей, резюме диалогов и прочая фоновая работа
+
+Очереди ограничены: у низких приоритетов свои маленькие лимиты, общий —
+ai_queue_limit. Когда места нет, вытесняется самый свежий из менее важных
+ожидающих, а если таких нет — отказ (AIOverloaded). Приоритет задаётся для
+всего вызова через with_priority(...) (contextvar) и доходит до каждой попытки.
+
+Состояние — в памяти процесса и отдельно для каждого event loop.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import weakref
+from collections import Counter, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Tuple
+
+from services.ai.errors import AIOverloaded
+from services.ai.health import key_id
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_LIVE = 0
+PRIORITY_MANAGER = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_LIVE: "live", PRIORITY_MANAGER: "manager", PRIORITY_BACKGROUND: "background"}
+
+# Настройки (settings) по умолчанию
+DEFAULT_MAX_PER_PROVIDER = 8
+DEFAULT_MAX_PER_KEY = 4
+DEFAULT_QUEUE_LIMIT = 100
+# Сколько ожидающих допускаем для менее важных классов (у live — только общий лимит)
+CLASS_QUEUE_LIMITS = {PRIORITY_MANAGER: 10, PRIORITY_BACKGROUND: 5}
+WAIT_WINDOW = 500
+
+_priority: contextvars.ContextVar = contextvars.ContextVar("ai_priority", default=PRIORITY_LIVE)
+
+
+@contextmanager
+def with_priority(priority: int):
+    """Все AI-вызовы внутри блока идут с этим приоритетом."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    provider: str = field(compare=False)
+    key: str = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued: float = field(compare=False)
+
+
+@dataclass
+class _ClassStats:
+    waits: Deque[float] = field(default_factory=lambda: deque(maxlen=WAIT_WINDOW))
+    admitted: int = 0
+    queued: int = 0
+    shed: int = 0
+    rejected: int = 0
+
+    def percentile(self, pct: float):
+        if not self.waits:
+            return None
+        ordered = sorted(self.waits)
+        return round(ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)], 3)
+
+
+class Dispatcher:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.by_provider: Counter = Counter()
+        self.by_key: Counter = Counter()
+        self.waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+
+    @staticmethod
+    def _limits(settings) -> Tuple[int, int, int]:
+        return (
+            int(settings.get("ai_max_concurrency_per_provider", DEFAULT_MAX_PER_PROVIDER)),
+            int(settings.get("ai_max_concurrency_per_key", DEFAULT_MAX_PER_KEY)),
+            int(settings.get("ai_queue_limit", DEFAULT_QUEUE_LIMIT)),
+        )
+
+    def _can_run(self, provider: str, kid: str, settings) -> bool:
+        per_provider, per_key, _ = self._limits(settings)
+        return self.by_provider[provider] < per_provider and self.by_key[(provider, kid)] < per_key
+
+    def _take(self, provider: str, kid: str):
+        self.by_provider[provider] += 1
+        self.by_key[(provider, kid)] += 1
+
+    def _waiting(self, priority: int = None) -> int:
+        return sum(1 for w in self.waiters if priority is None or w.priority == priority)
+
+    def _shed_for(self, priority: int) -> bool:
+        """Вытесняет самого свежего из менее важных ожидающих; False — вытеснять некого."""
+        victims = [w for w in self.waiters if w.priority > priority]
+        if not victims:
+            return False
+        victim = max(victims, key=lambda w: (w.priority, w.seq))
+        self.waiters.remove(victim)
+        heapq.heapify(self.waiters)
+        _stats(victim.priority).shed += 1
+        if not victim.future.done():
+            victim.future.set_exception(AIOverloaded(f"shed for higher-priority work ({PRIORITY_NAMES[victim.priority]})"))
+        return True
+
+    async def acquire(self, provider: str, kid: str, priority: int, settings):
+        stats = _stats(priority)
+        # Свободно и никто поважнее к этому провайдеру не ждёт — сразу
+        ahead = any(w.priority <= priority and w.provider == provider for w in self.waiters)
+        if not ahead and self._can_run(provider, kid, settings):
+            self._take(provider, kid)
+            stats.admitted += 1
+            stats.waits.append(0.0)
+            return
+
+        _, _, queue_limit = self._limits(settings)
+        class_limit = CLASS_QUEUE_LIMITS.get(priority)
+        if class_limit is not None and self._waiting(priority) >= class_limit:
+            stats.rejected += 1
+            raise AIOverloaded(f"{PRIORITY_NAMES[priority]} queue is full")
+        if len(self.waiters) >= queue_limit and not self._shed_for(priority):
+            stats.rejected += 1
+            raise AIOverloaded("AI queue is full")
+
+        waiter = _Waiter(priority, next(self._seq), provider, kid, self.loop.create_future(), self.loop.time())
+        heapq.heappush(self.waiters, waiter)
+        stats.queued += 1
+        try:
+            await waiter.future
+        except BaseException:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+                heapq.heapify(self.waiters)
+            elif waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                # Слот уже выдан, но ждущий отменён — возвращаем
+                self.release(provider, kid, settings)
+            raise
+        stats.admitted += 1
+        stats.waits.append(self.loop.time() - waiter.enqueued)
+
+    def release(self, provider: str, kid: str, settings):
+        self.by_provider[provider] = max(0, self.by_provider[provider] - 1)
+        self.by_key[(provider, kid)] = max(0, self.by_key[(provider, kid)] - 1)
+        # Слоты — ожидающим по приоритету (и по очереди внутри приоритета)
+        for waiter in sorted(self.waiters):
+            if not waiter.future.done() and self._can_run(waiter.provider, waiter.key, settings):
+                self.waiters.remove(waiter)
+                self._take(waiter.provider, waiter.key)
+                waiter.future.set_result(None)
+        heapq.heapify(self.waiters)
+
+
+_dispatchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dispatcher]" = weakref.WeakKeyDictionary()
+_class_stats: Dict[int, _ClassStats] = {}
+
+
+def _stats(priority: int) -> _ClassStats:
+    return _class_stats.setdefault(priority, _ClassStats())
+
+
+def get_dispatcher() -> Dispatcher:
+    loop = asyncio.get_running_loop()
+    dispatcher = _dispatchers.get(loop)
+    if dispatcher is None:
+        dispatcher = _dispatchers[loop] = Dispatcher()
+    return dispatcher
+
+
+async def acquire(provider: str, key: str, settings):
+    """Ждёт слот под попытку с текущим приоритетом; AIOverloaded — запрос сброшен."""
+    await get_dispatcher().acquire(provider, key_id(key), current_priority(), settings)
+
+
+def release(provider: str, key: str, settings):
+    get_dispatcher().release(provider, key_id(key), settings)
+
+
+def stats_snapshot() -> dict:
+    dispatchers = list(_dispatchers.values())
+    return {
+        "classes": {
+            PRIORITY_NAMES[p]: {
+                "admitted": s.admitted,
+                "queued": s.queued,
+                "shed": s.shed,
+                "rejected": s.rejected,
+                "waiting": sum(d._waiting(p) for d in dispatchers),
+                "wait_p50": s.percentile(50),
+                "wait_p95": s.percentile(95),
+            }
+            for p, s in sorted(_class_stats.items())
+        },
+        "active": dict(sum((d.by_provider for d in dispatchers), Counter())),
+    }
@@ -0,0 +1,100 @@
+"""
+Async-адаптер emergentintegrations (ключи sk-emergent-*).
+
+LlmChat.send_message — корутина, поэтому вызываем её прямо в event loop
+вызывающего кода: без отдельных потоков, asyncio.run и nest_asyncio.
+
+LlmChat помнит историю своего диалога, поэтому сессия переиспользуется
+только для продолжения того же разговора. Сессия хранится под отпечатком
+состояния: ключ, модель, системный промпт и все реплики до текущей. После
+ответа она перекладывается под новое состояние (с этим вопросом и ответом).
+Разные разговоры сессию не делят: на время запроса её забирают из пула.
+"""
+import hashlib
+import json
+import logging
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    from emergentintegrations.llm.chat import LlmChat, UserMessage
+    EMERGENT_AVAILABLE = True
+except ImportError:
+    EMERGENT_AVAILABLE = False
+    logger.warning("emergentintegrations not available, using direct API calls")
+
+EMERGENT_KEY_PREFIX = "sk-emergent-"
+# Сколько незавершённых диалогов держим в пуле (LRU)
+MAX_SESSIONS = 200
+
+_sessions: "OrderedDict[str, object]" = OrderedDict()
+
+
+def is_emergent_key(key: str) -> bool:
+    return EMERGENT_AVAILABLE and bool(key) and key.startswith(EMERGENT_KEY_PREFIX)
+
+
+def provider_for_model(model: str, default: str) -> str:
+    """Провайдер emergentintegrations по имени модели."""
+    if model.startswith(("gpt", "o1", "o3", "o4")):
+        return "openai"
+    if model.startswith("claude"):
+        return "anthropic"
+    if model.startswith("gemini"):
+        return "gemini"
+    return default
+
+
+def _state_key(key: str, provider: str, model: str, system: str, turns: List[Tuple[str, str]]) -> str:
+    raw = json.dumps([key, provider, model, system, turns], ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _split(messages: List[Dict]) -> Tuple[str, List[Tuple[str, str]], str]:
+    """(системный промпт, реплики до последнего вопроса, последний вопрос пользователя)."""
+    system_parts = []
+    turns = []
+    for m in messages:
+        role = m.get("role")
+        if role == "system":
+            system_parts.append(m.get("content", ""))
+        elif role in ("user", "assistant"):
+            turns.append((role, m.get("content", "")))
+    for i in range(len(turns) - 1, -1, -1):
+        if turns[i][0] == "user":
+            return "\n\n".join(system_parts), turns[:i], turns[i][1]
+    return "\n\n".join(system_parts), turns, ""
+
+
+async def chat(key: str, model: str, messages: List[Dict], provider_name: str = "gemini") -> Optional[str]:
+    system, history, question = _split(messages)
+    if not question:
+        return None
+    provider = provider_for_model(model, provider_name)
+
+    state = _state_key(key, provider, model, system, history)
+    session = _sessions.pop(state, None)
+    if session is None:
+        session = LlmChat(
+            api_key=key,
+            session_id=f"support_{uuid.uuid4().hex}",
+            system_message=system,
+        ).with_model(provider, model)
+
+    try:
+        response = await session.send_message(UserMessage(text=question))
+    except Exception as e:
+        # Сессия в неизвестном состоянии — в пул не возвращаем
+        logger.warning(f"Emergent AI error: {e}")
+        raise Exception(f"Emergent error: {e}")
+
+    reply = response.strip() if response else None
+    if reply:
+        _sessions[_state_key(key, provider, model, system, history + [("user", question), ("assistant", response)])] = session
+        while len(_sessions) > MAX_SESSIONS:
+            _sessions.popitem(last=False)
+    logger.info(f"Emergent AI response: {reply[:100] if reply else 'None'}...")
+    return reply
@@ -0,0 +1,58 @@
+"""
+Ошибки AI-провайдеров.
+
+KeyLimitError — ответ, который говорит о проблеме конкретного ключа
+(лимит, оплата, доступ): такой ключ уходит на паузу, а запрос — следующему.
+"""
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# Статусы, при которых виноват ключ, а не запрос
+KEY_ERROR_STATUSES = (429, 402, 403)
+
+
+class ProviderError(Exception):
+    """Неудачный ответ провайдера (status — HTTP-код)."""
+
+    def __init__(self, status: int, message: str = "", retry_after: Optional[float] = None):
+        super().__init__(message or f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class KeyLimitError(ProviderError):
+    """429 / 402 / 403: ключ исчерпан, не оплачен или заблокирован."""
+
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(status, f"Key limit/auth error: {status}", retry_after)
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Retry-After в секундах (число или HTTP-дата); None, если заголовка нет или он кривой."""
+    value = headers.get("retry-after") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def key_limit_error(response) -> KeyLimitError:
+    return KeyLimitError(response.status_code, parse_retry_after(response.headers))
+
+
+class AIOverloaded(Exception):
+    """Диспетчер не принял попытку: очередь полна или её вытеснила более важная работа."""
+
+
+class KeyUnavailable(Exception):
+    """Ключ на паузе или его единственную пробную попытку (half-open) уже заняли."""
@@ -0,0 +1,194 @@
+"""
+Здоровье AI-ключей (circuit breaker) — в памяти процесса.
+
+По каждому ключу: доля ошибок за последние попытки, EWMA задержки и пауза.
+Ключ уходит на паузу (open) после 429 — до Retry-After, после 402/403 —
+надолго, после серии ошибок — на растущий интервал. Когда пауза истекает,
+ключ переходит в half-open: пропускается одна пробная попытка, успех
+возвращает ключ в работу, ошибка — снова на паузу, вдвое дольше.
+
+Ключи на паузе не пробуются вовсе; остальные упорядочиваются по здоровью,
+а равные по здоровью — по нагрузке (services/ai/key_pool.py).
+Сводка раз в AI_STATS_INTERVAL секунд выгружается в ai_stats (services/ai/reporter.py).
+"""
+import hashlib
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from services.ai.errors import KeyLimitError
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# Окно попыток для доли ошибок и порог размыкания
+ERROR_WINDOW = 20
+MIN_SAMPLES = 5
+ERROR_RATE_THRESHOLD = 0.5
+# Паузы (секунды): базовая растёт вдвое с каждым размыканием подряд
+BASE_COOLDOWN = 30.0
+MAX_COOLDOWN = 600.0
+# 402 / 403 — оплата или доступ, сами собой быстро не пройдут
+AUTH_COOLDOWN = 600.0
+EWMA_ALPHA = 0.3
+# Сколько держим пробную попытку half-open занятой, если её исход так и не пришёл
+PROBE_TIMEOUT = 120.0
+
+
+def key_id(key: str) -> str:
+    """Короткий отпечаток ключа — сам ключ в памяти статистики и в базе не храним."""
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+
+def mask_key(key: str) -> str:
+    return key[:8] + "..." + key[-4:] if len(key) > 12 else "***"
+
+
+@dataclass
+class KeyHealth:
+    masked: str = ""
+    outcomes: Deque[bool] = field(default_factory=lambda: deque(maxlen=ERROR_WINDOW))
+    # EWMA задержки по mode (chat — целый ответ, stream — первый кусок)
+    latency: Dict[str, float] = field(default_factory=dict)
+    state: str = CLOSED
+    cooldown_until: float = 0.0
+    # Размыканий подряд — для роста паузы
+    trips: int = 0
+    # До какого момента занята пробная попытка half-open
+    probing_until: float = 0.0
+    last_error: Optional[str] = None
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def refresh(self, now: float):
+        if self.state == OPEN and now >= self.cooldown_until:
+            self.state = HALF_OPEN
+
+    def available(self, now: float) -> bool:
+        self.refresh(now)
+        if self.state == HALF_OPEN:
+            return now >= self.probing_until
+        return self.state == CLOSED
+
+    def trip(self, seconds: float, now: float):
+        self.state = OPEN
+        self.cooldown_until = now + seconds
+        self.trips += 1
+        self.probing_until = 0.0
+
+    def backoff(self) -> float:
+        return min(BASE_COOLDOWN * 2 ** self.trips, MAX_COOLDOWN)
+
+    def to_dict(self, now: float) -> dict:
+        self.refresh(now)
+        return {
+            "key": self.masked,
+            "state": self.state,
+            "error_rate": round(self.error_rate, 3),
+            "samples": len(self.outcomes),
+            "latency": {mode: round(value, 3) for mode, value in self.latency.items()},
+            "cooldown_left": round(max(0.0, self.cooldown_until - now), 1) if self.state == OPEN else 0,
+            "last_error": self.last_error,
+        }
+
+
+_keys: Dict[Tuple[str, str], KeyHealth] = {}
+
+
+def get_health(provider: str, key: str) -> KeyHealth:
+    health = _keys.get((provider, key_id(key)))
+    if health is None:
+        health = _keys[(provider, key_id(key))] = KeyHealth(masked=mask_key(key))
+    return health
+
+
+def available(provider: str, key: str) -> bool:
+    """Можно ли пробовать ключ сейчас (ничего не занимает — для выбора кандидатов)."""
+    return get_health(provider, key).available(time.monotonic())
+
+
+def acquire(provider: str, key: str) -> bool:
+    """Можно ли пробовать ключ сейчас; в half-open занимает единственную пробную попытку."""
+    now = time.monotonic()
+    health = get_health(provider, key)
+    if not health.available(now):
+        return False
+    if health.state == HALF_OPEN:
+        health.probing_until = now + PROBE_TIMEOUT
+        logger.info(f"[AI HEALTH] {provider} {health.masked}: half-open probe")
+    return True
+
+
+def release(provider: str, key: str):
+    """Попытка отменена без результата — пробу можно повторить."""
+    get_health(provider, key).probing_until = 0.0
+
+
+def record_success(provider: str, key: str, mode: str, latency: float):
+    health = get_health(provider, key)
+    if health.state != CLOSED:
+        logger.info(f"[AI HEALTH] {provider} {health.masked}: recovered")
+        health.outcomes.clear()
+    health.outcomes.append(True)
+    previous = health.latency.get(mode)
+    health.latency[mode] = latency if previous is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * previous
+    health.state = CLOSED
+    health.trips = 0
+    health.probing_until = 0.0
+
+
+def record_failure(provider: str, key: str, error: Optional[Exception] = None):
+    """Неудача попытки: исключение или пустой ответ (error=None)."""
+    now = time.monotonic()
+    health = get_health(provider, key)
+    health.outcomes.append(False)
+    health.last_error = str(error)[:200] if error is not None else "empty response"
+    health.refresh(now)
+    if isinstance(error, KeyLimitError):
+        if error.retry_after is not None:
+            cooldown = max(1.0, min(error.retry_after, MAX_COOLDOWN))
+        elif error.status in (402, 403):
+            cooldown = AUTH_COOLDOWN
+        else:
+            cooldown = health.backoff()
+    elif health.state == HALF_OPEN or (
+            len(health.outcomes) >= MIN_SAMPLES and health.error_rate >= ERROR_RATE_THRESHOLD):
+        cooldown = health.backoff()
+    else:
+        health.probing_until = 0.0
+        return
+    health.trip(cooldown, now)
+    logger.warning(f"[AI HEALTH] {provider} {health.masked}: paused for {cooldown:.0f}s ({health.last_error})")
+
+
+def _score(health: KeyHealth, mode: str) -> Tuple[float, float]:
+    # Доля ошибок с шагом 0.1, чтобы единичный сбой не перетасовывал ключи
+    return round(health.error_rate, 1), health.latency.get(mode, 0.0)
+
+
+def order_keys(provider: str, keys: List[str], tiebreak: Callable[[int], Any]) -> List[int]:
+    """Индексы доступных ключей: сначала здоровые, при равенстве — по tiebreak(индекс)."""
+    now = time.monotonic()
+    ready = [idx for idx in range(len(keys)) if get_health(provider, keys[idx]).available(now)]
+    return sorted(ready, key=lambda idx: (round(get_health(provider, keys[idx]).error_rate, 1), tiebreak(idx)))
+
+
+def provider_score(provider: str, keys: List[str], mode: str) -> Tuple[float, float]:
+    """Лучший из ключей провайдера — для порядка резервных провайдеров."""
+    scores = [_score(get_health(provider, key), mode) for key in keys]
+    return min(scores) if scores else (1.0, 0.0)
+
+
+def snapshot() -> Dict[str, List[dict]]:
+    now = time.monotonic()
+    result: Dict[str, List[dict]] = {}
+    for (provider, _), health in _keys.items():
+        result.setdefault(provider, []).append(health.to_dict(now))
+    return result
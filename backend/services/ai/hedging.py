@@ -0,0 +1,172 @@
+"""
+Хеджирование запросов к AI.
+
+Если основная попытка не ответила за "обычное" для провайдера время
+(перцентиль последних задержек), тот же запрос параллельно уходит следующему
+кандидату (ключу или провайдеру). Побеждает первый хороший ответ, остальные
+попытки отменяются. Ошибка попытки сразу запускает следующую (обычный failover).
+
+Статистика задержек и хеджей — в памяти процесса, по провайдерам.
+"""
+import asyncio
+import logging
+import math
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Настройки (settings) по умолчанию
+DEFAULT_HEDGE_PERCENTILE = 90
+DEFAULT_HEDGE_MIN_DELAY = 1.5
+DEFAULT_HEDGE_MAX_DELAY = 20.0
+# Пока замеров меньше — ждём DEFAULT_HEDGE_MAX_DELAY
+MIN_SAMPLES = 10
+LATENCY_WINDOW = 200
+
+
+@dataclass
+class HedgeStats:
+    """Счётчики по провайдеру (mode: chat — целый ответ, stream — первый кусок)."""
+    latencies: Dict[str, Deque[float]] = field(default_factory=dict)
+    attempts: int = 0
+    wins: int = 0
+    failures: int = 0
+    # Попытки, запущенные хеджем (а не после ошибки), и сколько из них победило
+    hedges_fired: int = 0
+    hedge_wins: int = 0
+    # Попытки, отменённые, потому что победил другой кандидат
+    cancelled: int = 0
+
+    def record_latency(self, mode: str, seconds: float):
+        self.latencies.setdefault(mode, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def percentile(self, mode: str, pct: float) -> Optional[float]:
+        window = self.latencies.get(mode)
+        if not window or len(window) < MIN_SAMPLES:
+            return None
+        ordered = sorted(window)
+        rank = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+        return ordered[rank]
+
+    def to_dict(self) -> dict:
+        return {
+            "attempts": self.attempts,
+            "wins": self.wins,
+            "failures": self.failures,
+            "hedges_fired": self.hedges_fired,
+            "hedge_wins": self.hedge_wins,
+            "cancelled": self.cancelled,
+            "latency": {
+                mode: {"samples": len(window), "p50": self.percentile(mode, 50), "p90": self.percentile(mode, 90)}
+                for mode, window in self.latencies.items()
+            },
+        }
+
+
+_stats: Dict[str, HedgeStats] = {}
+
+
+def get_stats(provider: str) -> HedgeStats:
+    return _stats.setdefault(provider, HedgeStats())
+
+
+def stats_snapshot() -> Dict[str, dict]:
+    return {name: s.to_dict() for name, s in _stats.items()}
+
+
+def hedge_delay(provider: str, mode: str, settings) -> float:
+    """Сколько ждать основную попытку перед хеджем: перцентиль задержек провайдера в рамках [min, max]."""
+    pct = float(settings.get("ai_hedge_percentile", DEFAULT_HEDGE_PERCENTILE))
+    low = float(settings.get("ai_hedge_min_delay", DEFAULT_HEDGE_MIN_DELAY))
+    high = float(settings.get("ai_hedge_max_delay", DEFAULT_HEDGE_MAX_DELAY))
+    observed = get_stats(provider).percentile(mode, pct)
+    if observed is None:
+        return high
+    return min(max(observed, low), high)
+
+
+# Кандидат: (provider, label для логов, фабрика попытки). Попытка возвращает
+# результат или None (ответа нет), исключение — тоже неудача.
+Candidate = Tuple[str, str, Callable[[], Awaitable[Any]]]
+
+
+async def race(candidates: Iterator[Candidate], mode: str, settings,
+               on_discard: Callable[[Any], Awaitable[None]] = None) -> Optional[Tuple[str, Any]]:
+    """
+    Запускает кандидатов по очереди с хеджированием; возвращает (label, результат)
+    первой удачной попытки или None. on_discard — уборка результата, который
+    пришёл одновременно с победителем (например, закрыть поток).
+    """
+    loop = asyncio.get_running_loop()
+    running: Dict[asyncio.Task, Tuple[str, str, float, bool]] = {}
+
+    def launch(hedged: bool) -> bool:
+        candidate = next(candidates, None)
+        if candidate is None:
+            return False
+        provider, label, factory = candidate
+        stats = get_stats(provider)
+        stats.attempts += 1
+        if hedged:
+            stats.hedges_fired += 1
+            logger.info(f"[HEDGE] {label}: primary is slow, hedging")
+        task = asyncio.ensure_future(factory())
+        running[task] = (provider, label, loop.time(), hedged)
+        return True
+
+    if not launch(hedged=False):
+        return None
+    exhausted = False
+    winner = None
+    try:
+        while running:
+            newest_provider = list(running.values())[-1][0]
+            timeout = None if exhausted else hedge_delay(newest_provider, mode, settings)
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Основная попытка медленная — хедж следующим кандидатом
+                exhausted = not launch(hedged=True)
+                continue
+            failed = 0
+            for task in done:
+                provider, label, started, hedged = running.pop(task)
+                stats = get_stats(provider)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    logger.warning(f"AI {label} failed: {e}")
+                    result = None
+                if result is None:
+                    stats.failures += 1
+                    failed += 1
+                    continue
+                if winner is not None:
+                    # Одновременно пришли два ответа — лишний убираем
+                    if on_discard is not None:
+                        await on_discard(result)
+                    continue
+                stats.wins += 1
+                stats.record_latency(mode, loop.time() - started)
+                if hedged:
+                    stats.hedge_wins += 1
+                winner = (label, result)
+            if winner is not None:
+                return winner
+            for _ in range(failed):
+                # Упавшую попытку сразу заменяет следующий кандидат
+                if exhausted or not launch(hedged=False):
+                    exhausted = True
+                    break
+        return None
+    finally:
+        for task, (provider, _, _, _) in running.items():
+            task.cancel()
+            get_stats(provider).cancelled += 1
+        if running:
+            results = await asyncio.gather(*running, return_exceptions=True)
+            for result in results:
+                # Попытка успела завершиться раньше отмены
+                if on_discard is not None and result is not None and not isinstance(result, BaseException):
+                    await on_discard(result)
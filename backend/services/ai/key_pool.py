@@ -0,0 +1,183 @@
+"""
+Распределение нагрузки по API-ключам провайдера.
+
+Раньше весь трафик шёл на active_key_index, пока ключ не упирался в 429.
+Теперь среди одинаково здоровых ключей (services/ai/health.py) первым идёт
+наименее загруженный: меньше запросов в полёте, больше остаток квоты по
+заголовкам rate limit, дольше не использовался (при прочих равных — по кругу).
+Ключ, у которого по заголовкам квота кончилась до сброса, уходит в конец
+очереди ещё до того, как провайдер ответит 429.
+
+Состояние — в памяти процесса.
+"""
+import re
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from services.ai.health import key_id, mask_key
+
+# Ниже этого остатка ключ считаем исчерпанным до сброса окна
+REQUEST_HEADROOM = 1
+# Запрос с контекстом и max_tokens=2048 — примерно столько токенов
+TOKEN_HEADROOM = 4096
+
+# Заголовки: OpenAI / Groq / OpenRouter (x-ratelimit-*) и Anthropic (anthropic-ratelimit-*)
+HEADER_PREFIXES = ("x-ratelimit-", "anthropic-ratelimit-")
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value: str) -> Optional[float]:
+    """
+    Через сколько секунд сбросится окно: "6m0s" / "59.5s" / "120ms" (OpenAI, Groq),
+    RFC 3339 (Anthropic), unix-время в мс или с (OpenRouter), число секунд.
+    """
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        number = None
+    if number is not None:
+        now = time.time()
+        if number > 1e12:
+            return max(0.0, number / 1000 - now)
+        if number > 1e9:
+            return max(0.0, number - now)
+        return max(0.0, number)
+    parts = _DURATION_PART.findall(value)
+    if parts and "".join(n + u for n, u in parts) == value:
+        return sum(float(n) * _DURATION_UNITS[u] for n, u in parts)
+    try:
+        when = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _int(value) -> Optional[int]:
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class Budget:
+    """Окно rate limit по запросам или токенам."""
+    limit: Optional[int] = None
+    remaining: Optional[int] = None
+    reset_at: float = 0.0
+
+    def current(self, now: float) -> Optional[int]:
+        """Остаток сейчас; после сброса окна (или без заголовков) — неизвестен."""
+        if self.remaining is None or now >= self.reset_at:
+            return None
+        return self.remaining
+
+    def fraction(self, now: float) -> float:
+        remaining = self.current(now)
+        if remaining is None or not self.limit:
+            return 1.0
+        return remaining / self.limit
+
+    def to_dict(self, now: float) -> Optional[dict]:
+        if self.remaining is None:
+            return None
+        return {
+            "limit": self.limit,
+            "remaining": self.current(now),
+            "reset_in": round(max(0.0, self.reset_at - now), 1),
+        }
+
+
+@dataclass
+class KeyLoad:
+    masked: str = ""
+    in_flight: int = 0
+    last_used: float = 0.0
+    requests: Budget = field(default_factory=Budget)
+    tokens: Budget = field(default_factory=Budget)
+
+    def throttled(self, now: float) -> bool:
+        requests = self.requests.current(now)
+        tokens = self.tokens.current(now)
+        return (requests is not None and requests < REQUEST_HEADROOM) or \
+            (tokens is not None and tokens < TOKEN_HEADROOM)
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "key": self.masked,
+            "in_flight": self.in_flight,
+            "throttled": self.throttled(now),
+            "requests": self.requests.to_dict(now),
+            "tokens": self.tokens.to_dict(now),
+        }
+
+
+_keys: Dict[Tuple[str, str], KeyLoad] = {}
+
+
+def get_load(provider: str, key: str) -> KeyLoad:
+    load = _keys.get((provider, key_id(key)))
+    if load is None:
+        load = _keys[(provider, key_id(key))] = KeyLoad(masked=mask_key(key))
+    return load
+
+
+def load_score(provider: str, key: str) -> Tuple[bool, int, float, float]:
+    """Ключ сортировки: исчерпан ли, запросов в полёте, остаток квоты (с шагом 0.1), давность использования."""
+    now = time.monotonic()
+    load = get_load(provider, key)
+    headroom = min(load.requests.fraction(now), load.tokens.fraction(now))
+    return load.throttled(now), load.in_flight, -round(headroom, 1), load.last_used
+
+
+def begin(provider: str, key: str):
+    load = get_load(provider, key)
+    load.in_flight += 1
+    load.last_used = time.monotonic()
+
+
+def end(provider: str, key: str):
+    load = get_load(provider, key)
+    load.in_flight = max(0, load.in_flight - 1)
+
+
+def observe(provider: str, key: str, headers):
+    """Запоминает остаток квоты из заголовков ответа (любой статус, в том числе 429)."""
+    if headers is None:
+        return
+    now = time.monotonic()
+    load = get_load(provider, key)
+    for prefix in HEADER_PREFIXES:
+        for kind, budget in (("requests", load.requests), ("tokens", load.tokens)):
+            remaining = _int(headers.get(f"{prefix}remaining-{kind}") or headers.get(f"{prefix}{kind}-remaining"))
+            if remaining is None:
+                continue
+            budget.remaining = remaining
+            budget.limit = _int(headers.get(f"{prefix}limit-{kind}") or headers.get(f"{prefix}{kind}-limit")) or budget.limit
+            reset = parse_reset(headers.get(f"{prefix}reset-{kind}") or headers.get(f"{prefix}{kind}-reset") or "")
+            # Без времени сброса остаток верим минуту
+            budget.reset_at = now + (reset if reset is not None else 60.0)
+    # OpenRouter: x-ratelimit-limit / -remaining / -reset без уточнения — это запросы
+    remaining = _int(headers.get("x-ratelimit-remaining"))
+    if remaining is not None:
+        load.requests.remaining = remaining
+        load.requests.limit = _int(headers.get("x-ratelimit-limit")) or load.requests.limit
+        reset = parse_reset(headers.get("x-ratelimit-reset") or "")
+        load.requests.reset_at = now + (reset if reset is not None else 60.0)
+
+
+def snapshot() -> Dict[str, list]:
+    now = time.monotonic()
+    result: Dict[str, list] = {}
+    for (provider, _), load in _keys.items():
+        result.setdefault(provider, []).append(load.to_dict(now))
+    return result
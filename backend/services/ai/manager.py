@@ -1,27 +1,30 @@
 # AI Provider Manager - Multi-provider with key failover
 import logging
-import requests
 import json
 import asyncio
-from typing import Optional, List, Dict, Any
+import concurrent.futures
+from typing import AsyncIterator, Optional, List, Dict, Any
+
+from services.ai import dispatcher, emergent, health, hedging, key_pool, routing, telemetry, transport
+from services.ai.errors import KEY_ERROR_STATUSES, AIOverloaded, KeyLimitError, KeyUnavailable, key_limit_error
+from services.ai.prompts import CACHEABLE, plain_messages, record_usage as record_prompt_usage
+from services.ai.transport import close_clients
+
+from utils.db_config import (
+    get_settings_snapshot, invalidate_settings, get_ai_providers, invalidate_ai_providers
+)
 
 logger = logging.getLogger(__name__)
 
-# Для работы nested event loops
-try:
-    import nest_asyncio
-    nest_asyncio.apply()
-except ImportError:
-    pass
+ANTHROPIC_MESSAGES_URL = "https://api.anthropic.com/v1/messages"
 
-# Emergent integrations для работы с EMERGENT_LLM_KEY
-EMERGENT_LLM_KEY = None
-try:
-    from emergentintegrations.llm.chat import LlmChat, UserMessage
-    import os
-    EMERGENT_LLM_KEY = os.environ.get("EMERGENT_LLM_KEY", "sk-emergent-f2c59A63a8639De58B")
-except ImportError:
-    logger.warning("emergentintegrations not available, using direct API calls")
+# Бюджет на весь ответ (все попытки failover вместе), секунды — settings.ai_deadline_seconds
+DEFAULT_AI_DEADLINE = 45.0
+# Ответ по истечении бюджета — settings.ai_fallback_message. Фраза эскалации:
+# бот передаст вопрос менеджеру
+DEFAULT_AI_FALLBACK = "Данный вопрос нужно уточнить у менеджера, вызываю менеджера."
+# Таймаут проверки ключа (test connection), секунды
+TEST_TIMEOUT = 15.0
 
 
 class AIProviderManager:
@@ -31,26 +34,31 @@ class AIProviderManager:
         self.db = db
 
     def get_providers(self) -> List[Dict]:
-        return list(self.db.ai_providers.find({}, {"_id": 0}))
+        return get_ai_providers()
 
     def get_provider(self, name: str) -> Optional[Dict]:
-        return self.db.ai_providers.find_one({"name": name}, {"_id": 0})
+        for p in get_ai_providers():
+            if p.get("name") == name:
+                return p
+        return None
+
+    def _update_provider(self, name: str, update: Dict):
+        self.db.ai_providers.update_one({"name": name}, update)
+        invalidate_ai_providers()
 
     def get_active_provider(self) -> Optional[Dict]:
-        settings = self.db.settings.find_one({}, {"_id": 0})
-        if not settings:
+        settings = get_settings_snapshot()
+        if not settings.data:
             return None
         active = settings.get("active_provider", "groq")
         return self.get_provider(active)
 
     def set_active_provider(self, name: str):
         self.db.settings.update_one({}, {"$set": {"active_provider": name}})
+        invalidate_settings()
 
     def add_key(self, provider_name: str, key: str):
-        self.db.ai_providers.update_one(
-            {"name": provider_name},
-            {"$addToSet": {"api_keys": key}}
-        )
+        self._update_provider(provider_name, {"$addToSet": {"api_keys": key}})
 
     def remove_key(self, provider_name: str, key_index: int):
         provider = self.get_provider(provider_name)
@@ -62,22 +70,13 @@ class AIProviderManager:
             active_idx = provider.get("active_key_index", 0)
             if active_idx >= len(keys):
                 active_idx = max(0, len(keys) - 1)
-            self.db.ai_providers.update_one(
-                {"name": provider_name},
-                {"$set": {"api_keys": keys, "active_key_index": active_idx}}
-            )
+            self._update_provider(provider_name, {"$set": {"api_keys": keys, "active_key_index": active_idx}})
 
     def set_model(self, provider_name: str, model: str):
-        self.db.ai_providers.update_one(
-            {"name": provider_name},
-            {"$set": {"selected_model": model}}
-        )
+        self._update_provider(provider_name, {"$set": {"selected_model": model}})
 
     def set_enabled(self, provider_name: str, enabled: bool):
-        self.db.ai_providers.update_one(
-            {"name": provider_name},
-            {"$set": {"enabled": enabled}}
-        )
+        self._update_provider(provider_name, {"$set": {"enabled": enabled}})
 
     def _get_working_key(self, provider: Dict) -> Optional[str]:
         keys = provider.get("api_keys", [])
@@ -88,22 +87,8 @@ class AIProviderManager:
             return keys[active_idx]
         return keys[0] if keys else None
 
-    def _rotate_key(self, provider_name: str, failed_key: str):
-        provider = self.get_provider(provider_name)
-        if not provider:
-            return
-        keys = provider.get("api_keys", [])
-        if len(keys) <= 1:
-            return
-        current_idx = provider.get("active_key_index", 0)
-        next_idx = (current_idx + 1) % len(keys)
-        self.db.ai_providers.update_one(
-            {"name": provider_name},
-            {"$set": {"active_key_index": next_idx}}
-        )
-        logger.info(f"Rotated key for {provider_name}: {current_idx} -> {next_idx}")
-
-    def test_connection(self, provider_name: str, key: Optional[str] = None) -> Dict:
+    async def atest_connection(self, provider_name: str, key: Optional[str] = None) -> Dict:
+        """Проверка ключа и список моделей; идёт через диспетчер с фоновым приоритетом."""
         provider = self.get_provider(provider_name)
         if not provider:
             return {"ok": False, "error": "Provider not found", "models": []}
@@ -111,64 +96,84 @@ class AIProviderManager:
         if not test_key:
             return {"ok": False, "error": "No API keys configured", "models": []}
 
-        try:
-            if provider_name == "groq":
-                return self._test_groq(provider, test_key)
-            elif provider_name == "openai":
-                return self._test_openai(provider, test_key)
-            elif provider_name == "anthropic":
-                return self._test_anthropic(provider, test_key)
-            elif provider_name == "google":
-                return self._test_google(provider, test_key)
-            elif provider_name == "openrouter":
-                return self._test_openrouter(provider, test_key)
+        tests = {
+            "groq": self._test_groq,
+            "openai": self._test_openai,
+            "anthropic": self._test_anthropic,
+            "google": self._test_google,
+            "openrouter": self._test_openrouter,
+        }
+        test = tests.get(provider_name)
+        if test is None and provider.get("endpoint"):
+            # Свой OpenAI-совместимый сервер (local: llama.cpp, vLLM, Ollama)
+            test = self._test_openai_compat
+        if test is None:
             return {"ok": False, "error": "Unknown provider", "models": []}
+        settings = get_settings_snapshot()
+        proxy = provider.get("proxy", "") or None
+        try:
+            with dispatcher.with_priority(dispatcher.PRIORITY_BACKGROUND):
+                await dispatcher.acquire(provider_name, test_key, settings)
+                try:
+                    return await test(provider, test_key, proxy)
+                finally:
+                    dispatcher.release(provider_name, test_key, settings)
         except Exception as e:
             logger.warning(f"test_connection {provider_name}: {e}")
             return {"ok": False, "error": str(e), "models": []}
 
-    def _test_groq(self, provider: Dict, key: str) -> Dict:
+    async def _test_openai_compat(self, provider: Dict, key: str, proxy: Optional[str] = None) -> Dict:
+        base = provider["endpoint"].rstrip("/")
+        headers = {"Authorization": f"Bearer {key}"}
+        r = await transport.get(provider["name"], f"{base}/models", headers, proxy, timeout=TEST_TIMEOUT)
+        if r.status_code == 200:
+            data = r.json()
+            models = [m["id"] for m in data.get("data", [])]
+            return {"ok": True, "models": models, "count": len(models)}
+        return {"ok": False, "error": f"HTTP {r.status_code}: {r.text[:200]}", "models": []}
+
+    async def _test_groq(self, provider: Dict, key: str, proxy: Optional[str] = None) -> Dict:
         base = provider.get("base_url", "https://api.groq.com/openai/v1")
         headers = {"Authorization": f"Bearer {key}", "Content-Type": "application/json"}
-        r = requests.get(f"{base}/models", headers=headers, timeout=15)
+        r = await transport.get(provider["name"], f"{base}/models", headers, proxy, timeout=TEST_TIMEOUT)
         if r.status_code == 200:
             data = r.json()
             models = [m["id"] for m in data.get("data", [])]
             return {"ok": True, "models": models, "count": len(models)}
         return {"ok": False, "error": f"HTTP {r.status_code}: {r.text[:200]}", "models": []}
 
-    def _test_openai(self, provider: Dict, key: str) -> Dict:
+    async def _test_openai(self, provider: Dict, key: str, proxy: Optional[str] = None) -> Dict:
         base = provider.get("base_url", "https://api.openai.com/v1")
         headers = {"Authorization": f"Bearer {key}"}
-        r = requests.get(f"{base}/models", headers=headers, timeout=15)
+        r = await transport.get(provider["name"], f"{base}/models", headers, proxy, timeout=TEST_TIMEOUT)
         if r.status_code == 200:
             data = r.json()
             models = [m["id"] for m in data.get("data", []) if "gpt" in m["id"].lower() or "o1" in m["id"].lower() or "o3" in m["id"].lower()]
             return {"ok": True, "models": sorted(models), "count": len(models)}
         return {"ok": False, "error": f"HTTP {r.status_code}: {r.text[:200]}", "models": []}
 
-    def _test_anthropic(self, provider: Dict, key: str) -> Dict:
+    async def _test_anthropic(self, provider: Dict, key: str, proxy: Optional[str] = None) -> Dict:
         headers = {"x-api-key": key, "anthropic-version": "2023-06-01", "Content-Type": "application/json"}
         payload = {"model": "claude-3-5-haiku-20241022", "max_tokens": 10, "messages": [{"role": "user", "content": "hi"}]}
-        r = requests.post("https://api.anthropic.com/v1/messages", json=payload, headers=headers, timeout=15)
+        r = await transport.post_json(provider["name"], ANTHROPIC_MESSAGES_URL, payload, headers, proxy, timeout=TEST_TIMEOUT)
         if r.status_code == 200:
             models = ["claude-sonnet-4-20250514", "claude-3-5-haiku-20241022", "claude-3-opus-20240229"]
             return {"ok": True, "models": models, "count": len(models)}
         return {"ok": False, "error": f"HTTP {r.status_code}: {r.text[:200]}", "models": []}
 
-    def _test_google(self, provider: Dict, key: str) -> Dict:
+    async def _test_google(self, provider: Dict, key: str, proxy: Optional[str] = None) -> Dict:
         base = provider.get("base_url", "https://generativelanguage.googleapis.com/v1beta")
         headers = {"x-goog-api-key": key}
-        r = requests.get(f"{base}/models", headers=headers, timeout=15)
+        r = await transport.get(provider["name"], f"{base}/models", headers, proxy, timeout=TEST_TIMEOUT)
         if r.status_code == 200:
             data = r.json()
             models = [m["name"].replace("models/", "") for m in data.get("models", []) if "generateContent" in str(m.get("supportedGenerationMethods", []))]
             return {"ok": True, "models": models, "count": len(models)}
         return {"ok": False, "error": f"HTTP {r.status_code}: {r.text[:200]}", "models": []}
 
-    def _test_openrouter(self, provider: Dict, key: str) -> Dict:
+    async def _test_openrouter(self, provider: Dict, key: str, proxy: Optional[str] = None) -> Dict:
         headers = {"Authorization": f"Bearer {key}"}
-        r = requests.get("https://openrouter.ai/api/v1/models", headers=headers, timeout=15)
+        r = await transport.get(provider["name"], "https://openrouter.ai/api/v1/models", headers, proxy, timeout=TEST_TIMEOUT)
         if r.status_code == 200:
             data = r.json()
             models = [m["id"] for m in data.get("data", [])[:100]]
@@ -176,8 +181,45 @@ class AIProviderManager:
         return {"ok": False, "error": f"HTTP {r.status_code}: {r.text[:200]}", "models": []}
 
     def chat(self, messages: List[Dict], provider_name: Optional[str] = None) -> Optional[str]:
-        settings = self.db.settings.find_one({}, {"_id": 0})
-        name = provider_name or (settings.get("active_provider") if settings else "groq")
+        """Sync-обёртка над achat для старых вызовов; новый код должен вызывать achat."""
+        async def _run():
+            try:
+                return await self.achat(messages, provider_name)
+            finally:
+                await close_clients()
+
+        def _in_new_loop():
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(_run())
+            finally:
+                loop.close()
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return _in_new_loop()
+        # Вызов из async-кода: свой loop в отдельном потоке, чтобы не блокировать текущий
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            return pool.submit(_in_new_loop).result()
+
+    def _candidates(self, provider_name: Optional[str] = None, mode: str = "chat",
+                    route: Optional[routing.Route] = None):
+        """
+        Порядок попыток: для простых запросов (route.tier == fast) — сначала
+        ключи быстрого уровня, затем ключи выбранного (или первого включённого)
+        провайдера, затем ключи остальных включённых провайдеров — от самого здорового.
+        Внутри провайдера ключи идут по здоровью, при равенстве — по нагрузке
+        (key_pool), затем по кругу от active_key_index. Ключи на паузе
+        (circuit breaker) пропускаются. Пробу half-open здесь не занимаем:
+        её берёт сама попытка (_tracked_call/_tracked_stream), чтобы перебор,
+        прерванный по бюджету, ничего не держал.
+        Отдаёт (name, provider, key_index, key).
+        """
+        settings = get_settings_snapshot()
+        if route is not None and route.tier == routing.FAST and not provider_name:
+            yield from self._fast_candidates(settings)
+        name = provider_name or (settings.get("active_provider") if settings.data else "groq")
         provider = self.get_provider(name)
         if not provider or not provider.get("enabled"):
             all_providers = self.get_providers()
@@ -187,188 +229,517 @@ class AIProviderManager:
                     name = p["name"]
                     break
             if not provider or not provider.get("enabled"):
-                return None
+                return
 
         keys = provider.get("api_keys", [])
         if not keys:
-            return None
+            return
 
-        active_idx = provider.get("active_key_index", 0)
-        tried = set()
-        for attempt in range(len(keys)):
-            idx = (active_idx + attempt) % len(keys)
-            if idx in tried:
-                continue
-            tried.add(idx)
-            key = keys[idx]
+        for idx in self._order_keys(name, provider):
+            if health.available(name, keys[idx]):
+                yield name, provider, idx, keys[idx]
+
+        logger.warning(f"All keys exhausted for {name}, trying other providers")
+        others = [p for p in self.get_providers() if p["name"] != name and p.get("enabled") and p.get("api_keys")]
+        others.sort(key=lambda p: health.provider_score(p["name"], p["api_keys"], mode))
+        for p in others:
+            p_keys = p["api_keys"]
+            for idx in self._order_keys(p["name"], p):
+                if health.available(p["name"], p_keys[idx]):
+                    yield p["name"], p, idx, p_keys[idx]
+
+    def fast_model(self, settings) -> str:
+        """Модель быстрого уровня: ai_fast_model или выбранная модель ai_fast_provider."""
+        tier = routing.fast_tier(settings)
+        if tier is None:
+            return ""
+        name, model = tier
+        return model or (self.get_provider(name) or {}).get("selected_model", "")
+
+    def _fast_candidates(self, settings):
+        """Ключи провайдера быстрого уровня (ai_fast_provider) с моделью ai_fast_model."""
+        tier = routing.fast_tier(settings)
+        if tier is None:
+            return
+        name, model = tier
+        provider = self.get_provider(name)
+        if not provider or not provider.get("enabled") or not provider.get("api_keys"):
+            logger.warning(f"[AI ROUTE] fast tier {name} is not enabled or has no keys")
+            return
+        if model:
+            provider = {**provider, "selected_model": model}
+        keys = provider["api_keys"]
+        for idx in self._order_keys(name, provider):
+            if health.available(name, keys[idx]):
+                yield name, provider, idx, keys[idx]
+
+    @staticmethod
+    def _order_keys(name: str, provider: Dict) -> List[int]:
+        keys = provider["api_keys"]
+        start = provider.get("active_key_index", 0)
+        return health.order_keys(
+            name, keys, lambda idx: (key_pool.load_score(name, keys[idx]), (idx - start) % len(keys))
+        )
+
+    @staticmethod
+    async def _dispatch(name: str, key: str, settings):
+        """
+        Начало попытки: проба half-open (если ключ в этом состоянии) и слот
+        диспетчера. Не дождались слота — ключ не виноват, пробу отпускаем.
+        """
+        if not health.acquire(name, key):
+            # Пока ждали своей очереди, ключ ушёл на паузу или пробу занял другой запрос
+            raise KeyUnavailable(f"{name} key is paused")
+        try:
+            await dispatcher.acquire(name, key, settings)
+        except AIOverloaded:
+            health.release(name, key)
+            logger.warning(f"AI {name}: dispatcher rejected attempt ({dispatcher.PRIORITY_NAMES[dispatcher.current_priority()]})")
+            raise
+        except asyncio.CancelledError:
+            health.release(name, key)
+            raise
+
+    async def _tracked_call(self, name: str, provider: Dict, idx: int, key: str, messages: List[Dict],
+                            failover: bool = False) -> Optional[str]:
+        """_call_provider со слотом диспетчера, учётом здоровья ключа и телеметрией попытки."""
+        loop = asyncio.get_running_loop()
+        settings = get_settings_snapshot()
+        call = telemetry.start_call(name, provider.get("selected_model", ""), idx, key, "chat", failover)
+        queued = loop.time()
+        try:
+            await self._dispatch(name, key, settings)
+        except AIOverloaded:
+            telemetry.record(call, telemetry.STATUS_OVERLOADED, loop.time() - queued, settings=settings)
+            raise
+        started = loop.time()
+        key_pool.begin(name, key)
+        try:
+            result = await self._call_provider(name, provider, key, messages, call)
+        except asyncio.CancelledError:
+            health.release(name, key)
+            telemetry.record(call, telemetry.STATUS_CANCELLED, loop.time() - started, settings=settings)
+            raise
+        except Exception as e:
+            health.record_failure(name, key, e)
+            telemetry.record(call, self._error_status(e), loop.time() - started, settings=settings)
+            raise
+        finally:
+            key_pool.end(name, key)
+            dispatcher.release(name, key, settings)
+        latency = loop.time() - started
+        if result:
+            health.record_success(name, key, "chat", latency)
+            telemetry.record(call, telemetry.STATUS_OK, latency, messages, result, settings=settings)
+        else:
+            health.record_failure(name, key)
+            telemetry.record(call, telemetry.STATUS_EMPTY, latency, settings=settings)
+        return result
+
+    @staticmethod
+    def _error_status(error: Exception) -> str:
+        return telemetry.STATUS_KEY_LIMIT if isinstance(error, KeyLimitError) else telemetry.STATUS_ERROR
+
+    async def _tracked_stream(self, name: str, provider: Dict, idx: int, key: str, messages: List[Dict],
+                              failover: bool = False) -> AsyncIterator[str]:
+        """
+        _stream_provider со слотом диспетчера, учётом здоровья ключа (успех —
+        по первому куску) и телеметрией попытки. Слот держится, пока поток не закрыт.
+        """
+        loop = asyncio.get_running_loop()
+        settings = get_settings_snapshot()
+        call = telemetry.start_call(name, provider.get("selected_model", ""), idx, key, "stream", failover)
+        queued = loop.time()
+        try:
+            await self._dispatch(name, key, settings)
+        except AIOverloaded:
+            telemetry.record(call, telemetry.STATUS_OVERLOADED, loop.time() - queued, settings=settings)
+            raise
+        begin = loop.time()
+        first_chunk = None
+        parts: List[str] = []
+        finished = False
+        error: Optional[Exception] = None
+        stream = self._stream_provider(name, provider, key, messages, call)
+        key_pool.begin(name, key)
+        try:
+            async for chunk in stream:
+                if chunk and first_chunk is None:
+                    first_chunk = loop.time() - begin
+                    health.record_success(name, key, "stream", first_chunk)
+                parts.append(chunk)
+                yield chunk
+            finished = True
+        except Exception as e:
+            error = e
+            health.record_failure(name, key, e)
+            raise
+        finally:
+            key_pool.end(name, key)
+            dispatcher.release(name, key, settings)
+            await stream.aclose()
+            latency = loop.time() - begin
+            if error is not None:
+                telemetry.record(call, self._error_status(error), latency, first_chunk=first_chunk, settings=settings)
+            elif first_chunk is not None:
+                telemetry.record(call, telemetry.STATUS_OK, latency, messages, "".join(parts),
+                                 first_chunk=first_chunk, settings=settings)
+            elif finished:
+                health.record_failure(name, key)
+                telemetry.record(call, telemetry.STATUS_EMPTY, latency, settings=settings)
+            else:
+                # Закрыт снаружи до первого куска (проиграл хедж, отмена)
+                health.release(name, key)
+                telemetry.record(call, telemetry.STATUS_CANCELLED, latency, settings=settings)
+
+    @staticmethod
+    def _budget(settings) -> float:
+        return float(settings.get("ai_deadline_seconds", DEFAULT_AI_DEADLINE))
+
+    @staticmethod
+    def _fallback(settings) -> str:
+        return settings.get("ai_fallback_message") or DEFAULT_AI_FALLBACK
+
+    async def achat(self, messages: List[Dict], provider_name: Optional[str] = None,
+                    fallback: bool = True, route: Optional[routing.Route] = None) -> Optional[str]:
+        """
+        Ответ с перебором ключей и провайдеров в пределах общего бюджета
+        ai_deadline_seconds: каждой попытке достаётся только остаток. Бюджет
+        кончился — возвращается ai_fallback_message (fallback=False — None:
+        для служебных вызовов); все кандидаты отказали раньше — None.
+        """
+        settings = get_settings_snapshot()
+        budget = self._budget(settings)
+        if settings.get("ai_hedging_enabled", False):
+            try:
+                return await asyncio.wait_for(self._achat_hedged(messages, provider_name, settings, route), budget)
+            except asyncio.TimeoutError:
+                logger.warning(f"AI deadline {budget:g}s exceeded (hedged)")
+                return self._fallback(settings) if fallback else None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + budget
+        for attempt, (name, provider, idx, key) in enumerate(self._candidates(provider_name, "chat", route)):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
             try:
-                result = self._call_provider(name, provider, key, messages)
+                started = loop.time()
+                result = await asyncio.wait_for(
+                    self._tracked_call(name, provider, idx, key, messages, failover=attempt > 0), remaining)
                 if result:
-                    if idx != active_idx:
-                        self.db.ai_providers.update_one(
-                            {"name": name}, {"$set": {"active_key_index": idx}}
-                        )
+                    # Задержки копим и без хеджа — чтобы при включении перцентиль уже был
+                    hedging.get_stats(name).record_latency("chat", loop.time() - started)
                     return result
+            except asyncio.TimeoutError:
+                break
             except Exception as e:
                 logger.warning(f"AI {name} key#{idx} failed: {e}")
                 continue
+        else:
+            return None
+        logger.warning(f"AI deadline {budget:g}s exceeded")
+        return self._fallback(settings) if fallback else None
+
+    async def _achat_hedged(self, messages: List[Dict], provider_name: Optional[str], settings,
+                            route: Optional[routing.Route] = None) -> Optional[str]:
+        """achat с хеджированием: медленную попытку дублирует следующий кандидат."""
+        def attempts():
+            for n, (name, provider, idx, key) in enumerate(self._candidates(provider_name, "chat", route)):
+                async def attempt(name=name, provider=provider, idx=idx, key=key, failover=n > 0):
+                    return await self._tracked_call(name, provider, idx, key, messages, failover)
+                yield name, f"{name} key#{idx}", attempt
+
+        won = await hedging.race(attempts(), "chat", settings)
+        return won[1] if won else None
+
+    @staticmethod
+    async def _first_chunk(stream: AsyncIterator[str]) -> Optional[str]:
+        async for chunk in stream:
+            if chunk:
+                return chunk
+        return None
 
-        logger.warning(f"All keys exhausted for {name}, trying other providers")
-        all_providers = self.get_providers()
-        for p in all_providers:
-            if p["name"] != name and p.get("enabled") and p.get("api_keys"):
-                for k in p["api_keys"]:
+    async def _astream_hedged(self, messages: List[Dict], provider_name: Optional[str], settings,
+                              route: Optional[routing.Route] = None) -> AsyncIterator[str]:
+        """astream с хеджированием по времени до первого куска."""
+        def attempts():
+            for n, (name, provider, idx, key) in enumerate(self._candidates(provider_name, "stream", route)):
+                async def attempt(name=name, provider=provider, idx=idx, key=key, failover=n > 0):
+                    stream = self._tracked_stream(name, provider, idx, key, messages, failover)
                     try:
-                        result = self._call_provider(p["name"], p, k, messages)
-                        if result:
-                            return result
-                    except Exception as e:
-                        logger.warning(f"Fallback AI {p['name']} failed: {e}")
-                        continue
+                        first = await self._first_chunk(stream)
+                    except BaseException:
+                        await stream.aclose()
+                        raise
+                    return (first, stream) if first else None
+                yield name, f"{name} key#{idx}", attempt
+
+        async def discard(result):
+            await result[1].aclose()
+
+        budget = self._budget(settings)
+        try:
+            won = await asyncio.wait_for(hedging.race(attempts(), "stream", settings, on_discard=discard), budget)
+        except asyncio.TimeoutError:
+            logger.warning(f"AI stream deadline {budget:g}s exceeded (hedged)")
+            yield self._fallback(settings)
+            return
+        if won is None:
+            return
+        _, (first, stream) = won
+        try:
+            yield first
+            async for chunk in stream:
+                if chunk:
+                    yield chunk
+        finally:
+            await stream.aclose()
+
+    async def astream(self, messages: List[Dict], provider_name: Optional[str] = None,
+                      route: Optional[routing.Route] = None) -> AsyncIterator[str]:
+        """
+        Как achat, но отдаёт текст кусками по мере генерации. Ключи и провайдеры
+        перебираются только до первого куска, и бюджет ai_deadline_seconds
+        ограничивает именно ожидание первого куска: начатый ответ дописывается,
+        обрыв посреди ответа пробрасывается. Бюджет кончился — отдаётся
+        ai_fallback_message; ничего не отдал — ответа нет (как None у achat).
+        """
+        settings = get_settings_snapshot()
+        if settings.get("ai_hedging_enabled", False):
+            async for chunk in self._astream_hedged(messages, provider_name, settings, route):
+                yield chunk
+            return
+        budget = self._budget(settings)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + budget
+        for attempt, (name, provider, idx, key) in enumerate(self._candidates(provider_name, "stream", route)):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            begin = loop.time()
+            stream = self._tracked_stream(name, provider, idx, key, messages, failover=attempt > 0)
+            try:
+                first = await asyncio.wait_for(self._first_chunk(stream), remaining)
+            except asyncio.TimeoutError:
+                await stream.aclose()
+                break
+            except Exception as e:
+                await stream.aclose()
+                logger.warning(f"AI stream {name} key#{idx} failed: {e}")
+                continue
+            if first is None:
+                await stream.aclose()
+                continue
+            hedging.get_stats(name).record_latency("stream", loop.time() - begin)
+            try:
+                yield first
+                async for chunk in stream:
+                    if chunk:
+                        yield chunk
+            finally:
+                await stream.aclose()
+            return
+        else:
+            return
+        logger.warning(f"AI stream deadline {budget:g}s exceeded")
+        yield self._fallback(settings)
+
+    @staticmethod
+    def _openai_compat_base(name: str, provider: Dict) -> Optional[str]:
+        """base_url для OpenAI-совместимого API (кастомный endpoint или провайдер), иначе None."""
+        custom_endpoint = provider.get("endpoint", "")
+        if custom_endpoint:
+            return custom_endpoint.rstrip("/")
+        defaults = {
+            "groq": "https://api.groq.com/openai/v1",
+            "openai": "https://api.openai.com/v1",
+            "openrouter": "https://openrouter.ai/api/v1",
+        }
+        if name in defaults:
+            return provider.get("base_url", defaults[name])
         return None
 
-    def _call_provider(self, name: str, provider: Dict, key: str, messages: List[Dict]) -> Optional[str]:
+    async def _call_provider(self, name: str, provider: Dict, key: str, messages: List[Dict],
+                             call: Optional[telemetry.CallRecord] = None) -> Optional[str]:
         model = provider.get("selected_model", "")
-        proxy = provider.get("proxy", "")
-        proxies = {"http": proxy, "https": proxy} if proxy else None
+        proxy = provider.get("proxy", "") or None
         
-        # Проверяем Emergent LLM key
-        is_emergent_key = key.startswith("sk-emergent-") if key else False
-        if is_emergent_key and EMERGENT_LLM_KEY:
-            return self._call_emergent(key, model, messages, name)
+        # Emergent LLM key — async-адаптер в текущем event loop
+        if emergent.is_emergent_key(key):
+            return await emergent.chat(key, model, messages, name)
         
-        # Проверяем кастомный endpoint
-        custom_endpoint = provider.get("endpoint", "")
-        if custom_endpoint and not is_emergent_key:
-            return self._call_openai_compat(custom_endpoint.rstrip("/"), key, model, messages, proxies)
-
-        if name == "groq":
-            return self._call_openai_compat(provider.get("base_url", "https://api.groq.com/openai/v1"), key, model, messages, proxies)
-        elif name == "openai":
-            return self._call_openai_compat(provider.get("base_url", "https://api.openai.com/v1"), key, model, messages, proxies)
-        elif name == "openrouter":
-            return self._call_openai_compat(provider.get("base_url", "https://openrouter.ai/api/v1"), key, model, messages, proxies)
-        elif name == "anthropic":
-            return self._call_anthropic(key, model, messages, proxies)
+        # Кастомный endpoint или OpenAI-совместимый провайдер
+        base_url = self._openai_compat_base(name, provider)
+        if base_url:
+            return await self._call_openai_compat(name, base_url, key, model, messages, proxy, call)
+        if name == "anthropic":
+            return await self._call_anthropic(key, model, messages, proxy, call)
         elif name == "google":
             # Если нет кастомного endpoint — используем нативный Google API
-            return self._call_google(provider.get("base_url", ""), key, model, messages)
+            return await self._call_google(provider.get("base_url", ""), key, model, messages, call)
         return None
 
-    def _call_emergent(self, key: str, model: str, messages: List[Dict], provider_name: str = "gemini") -> Optional[str]:
-        """Вызов AI через emergentintegrations библиотеку"""
-        if not EMERGENT_LLM_KEY:
-            logger.warning("emergentintegrations not available")
-            return None
-        
-        try:
-            # Определяем провайдера по модели
-            if model.startswith("gpt") or model.startswith("o1") or model.startswith("o3") or model.startswith("o4"):
-                provider = "openai"
-            elif model.startswith("claude"):
-                provider = "anthropic"
-            elif model.startswith("gemini"):
-                provider = "gemini"
-            else:
-                provider = provider_name
-            
-            # Извлекаем system message и все сообщения
-            system_msg = ""
-            conversation = []
-            for m in messages:
-                if m.get("role") == "system":
-                    system_msg = m.get("content", "")
-                elif m.get("role") == "user":
-                    conversation.append(("user", m.get("content", "")))
-                elif m.get("role") == "assistant":
-                    conversation.append(("assistant", m.get("content", "")))
-            
-            # Берём последнее сообщение пользователя
-            last_user_content = ""
-            for role, content in reversed(conversation):
-                if role == "user":
-                    last_user_content = content
-                    break
-            
-            if not last_user_content:
-                return None
-            
-            async def _async_call():
-                chat = LlmChat(
-                    api_key=key,
-                    session_id=f"support_{hash(str(messages)) % 100000}",
-                    system_message=system_msg
-                ).with_model(provider, model)
-                
-                user_message = UserMessage(text=last_user_content)
-                return await chat.send_message(user_message)
-            
-            # Запускаем в новом event loop
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    # Если уже есть running loop — используем nest_asyncio
-                    import nest_asyncio
-                    nest_asyncio.apply()
-                    import concurrent.futures
-                    with concurrent.futures.ThreadPoolExecutor() as pool:
-                        future = pool.submit(lambda: asyncio.run(_async_call()))
-                        response = future.result(timeout=60)
-                else:
-                    response = loop.run_until_complete(_async_call())
-            except RuntimeError:
-                # Нет event loop — создаём
-                response = asyncio.run(_async_call())
-            
-            logger.info(f"Emergent AI response: {response[:100] if response else 'None'}...")
-            return response.strip() if response else None
-                
-        except Exception as e:
-            logger.warning(f"Emergent AI error: {e}")
-            raise Exception(f"Emergent error: {e}")
+    async def _stream_provider(self, name: str, provider: Dict, key: str, messages: List[Dict],
+                               call: Optional[telemetry.CallRecord] = None) -> AsyncIterator[str]:
+        model = provider.get("selected_model", "")
+        proxy = provider.get("proxy", "") or None
+
+        if emergent.is_emergent_key(key):
+            # Emergent не умеет стримить — отдаём ответ одним куском
+            reply = await emergent.chat(key, model, messages, name)
+            if reply:
+                yield reply
+            return
+
+        base_url = self._openai_compat_base(name, provider)
+        if base_url:
+            stream = self._stream_openai_compat(name, base_url, key, model, messages, proxy, call)
+        elif name == "anthropic":
+            stream = self._stream_anthropic(key, model, messages, proxy, call)
+        elif name == "google":
+            stream = self._stream_google(provider.get("base_url", ""), key, model, messages, call)
+        else:
+            return
+        async for chunk in stream:
+            yield chunk
+
+    # --- OpenAI-совместимые API (Groq, OpenAI, OpenRouter, кастомный endpoint) ---
 
-    def _call_openai_compat(self, base_url: str, key: str, model: str, messages: List[Dict], proxies=None) -> Optional[str]:
+    @staticmethod
+    def _openai_compat_request(base_url: str, key: str, model: str, messages: List[Dict]):
         url = f"{base_url}/chat/completions"
         headers = {"Authorization": f"Bearer {key}", "Content-Type": "application/json"}
-        payload = {"model": model, "messages": messages, "temperature": 0.7, "max_tokens": 2048}
-        r = requests.post(url, json=payload, headers=headers, timeout=60, proxies=proxies)
+        # Стабильный префикс идёт первым — провайдер кэширует совпадающее начало сам
+        payload = {"model": model, "messages": plain_messages(messages), "temperature": 0.7, "max_tokens": 2048}
+        return url, headers, payload
+
+    @staticmethod
+    def _record_openai_usage(name: str, usage: Optional[Dict], call: Optional[telemetry.CallRecord] = None):
+        if usage:
+            details = usage.get("prompt_tokens_details") or {}
+            record_prompt_usage(name, usage.get("prompt_tokens"), details.get("cached_tokens"))
+            if call is not None:
+                call.usage(usage.get("prompt_tokens"), usage.get("completion_tokens"), details.get("cached_tokens"))
+
+    async def _call_openai_compat(self, name: str, base_url: str, key: str, model: str, messages: List[Dict],
+                                  proxy: Optional[str] = None,
+                                  call: Optional[telemetry.CallRecord] = None) -> Optional[str]:
+        url, headers, payload = self._openai_compat_request(base_url, key, model, messages)
+        r = await transport.post_json(name, url, payload, headers, proxy)
+        key_pool.observe(name, key, r.headers)
         if r.status_code == 200:
             data = r.json()
+            self._record_openai_usage(name, data.get("usage"), call)
             choices = data.get("choices", [])
             if choices:
                 content = choices[0].get("message", {}).get("content", "")
                 return content.strip() if content else None
-        if r.status_code in (429, 402, 403):
-            raise Exception(f"Key limit/auth error: {r.status_code}")
+        if r.status_code in KEY_ERROR_STATUSES:
+            raise key_limit_error(r)
         logger.warning(f"OpenAI-compat {model}: {r.status_code} {r.text[:200]}")
         return None
 
-    def _call_anthropic(self, key: str, model: str, messages: List[Dict], proxies=None) -> Optional[str]:
-        system_parts = []
+    async def _stream_openai_compat(self, name: str, base_url: str, key: str, model: str, messages: List[Dict],
+                                    proxy: Optional[str] = None,
+                                    call: Optional[telemetry.CallRecord] = None) -> AsyncIterator[str]:
+        url, headers, payload = self._openai_compat_request(base_url, key, model, messages)
+        payload["stream"] = True
+        if name == "openai":
+            # usage (в том числе cached_tokens) — последним куском потока
+            payload["stream_options"] = {"include_usage": True}
+        async with transport.stream_post(name, url, payload, headers, proxy) as r:
+            key_pool.observe(name, key, r.headers)
+            if r.status_code != 200:
+                await self._stream_failed(r, f"OpenAI-compat {model}", KEY_ERROR_STATUSES)
+                return
+            async for data in transport.iter_sse_data(r):
+                if data == "[DONE]":
+                    break
+                event = json.loads(data)
+                # OpenAI — usage, Groq — x_groq.usage в последнем куске
+                self._record_openai_usage(name, event.get("usage") or (event.get("x_groq") or {}).get("usage"), call)
+                choices = event.get("choices") or []
+                if choices:
+                    yield choices[0].get("delta", {}).get("content") or ""
+
+    # --- Anthropic Messages API ---
+
+    @staticmethod
+    def _anthropic_request(key: str, model: str, messages: List[Dict]):
+        system_blocks = []
         chat_messages = []
         for m in messages:
             if m.get("role") == "system":
-                system_parts.append(m.get("content", ""))
+                block = {"type": "text", "text": m.get("content", "")}
+                if m.get(CACHEABLE):
+                    # Кэш Anthropic: всё до этого блока включительно
+                    block["cache_control"] = {"type": "ephemeral"}
+                system_blocks.append(block)
             else:
                 chat_messages.append({"role": m["role"], "content": m.get("content", "")})
         if not chat_messages:
-            return None
+            return None, None
         headers = {"x-api-key": key, "anthropic-version": "2023-06-01", "Content-Type": "application/json"}
         payload = {"model": model, "max_tokens": 2048, "messages": chat_messages}
-        if system_parts:
-            payload["system"] = "\n\n".join(system_parts)
-        r = requests.post("https://api.anthropic.com/v1/messages", json=payload, headers=headers, timeout=60, proxies=proxies)
+        if system_blocks:
+            payload["system"] = system_blocks
+        return headers, payload
+
+    @staticmethod
+    def _record_anthropic_usage(usage: Optional[Dict], call: Optional[telemetry.CallRecord] = None):
+        if usage:
+            cached = usage.get("cache_read_input_tokens") or 0
+            written = usage.get("cache_creation_input_tokens") or 0
+            # input_tokens у Anthropic — только некэшированная часть
+            prompt_tokens = (usage.get("input_tokens") or 0) + cached + written
+            record_prompt_usage("anthropic", prompt_tokens, cached, written)
+            if call is not None:
+                call.usage(prompt_tokens, usage.get("output_tokens"), cached)
+
+    async def _call_anthropic(self, key: str, model: str, messages: List[Dict], proxy: Optional[str] = None,
+                              call: Optional[telemetry.CallRecord] = None) -> Optional[str]:
+        headers, payload = self._anthropic_request(key, model, messages)
+        if payload is None:
+            return None
+        r = await transport.post_json("anthropic", ANTHROPIC_MESSAGES_URL, payload, headers, proxy)
+        key_pool.observe("anthropic", key, r.headers)
         if r.status_code == 200:
             data = r.json()
+            self._record_anthropic_usage(data.get("usage"), call)
             content = data.get("content", [])
             if content and content[0].get("type") == "text":
                 return content[0].get("text", "").strip()
-        if r.status_code in (429, 402, 403):
-            raise Exception(f"Key limit/auth error: {r.status_code}")
+        if r.status_code in KEY_ERROR_STATUSES:
+            raise key_limit_error(r)
         logger.warning(f"Anthropic {model}: {r.status_code} {r.text[:200]}")
         return None
 
-    def _call_google(self, base_url: str, key: str, model: str, messages: List[Dict]) -> Optional[str]:
+    async def _stream_anthropic(self, key: str, model: str, messages: List[Dict], proxy: Optional[str] = None,
+                                call: Optional[telemetry.CallRecord] = None) -> AsyncIterator[str]:
+        headers, payload = self._anthropic_request(key, model, messages)
+        if payload is None:
+            return
+        async with transport.stream_post("anthropic", ANTHROPIC_MESSAGES_URL, {**payload, "stream": True}, headers, proxy) as r:
+            key_pool.observe("anthropic", key, r.headers)
+            if r.status_code != 200:
+                await self._stream_failed(r, f"Anthropic {model}", KEY_ERROR_STATUSES)
+                return
+            async for data in transport.iter_sse_data(r):
+                event = json.loads(data)
+                if event.get("type") == "message_start":
+                    self._record_anthropic_usage(event.get("message", {}).get("usage"), call)
+                elif event.get("type") == "message_delta" and call is not None:
+                    # Итоговое число токенов ответа — в message_delta
+                    call.usage(completion_tokens=(event.get("usage") or {}).get("output_tokens"))
+                elif event.get("type") == "content_block_delta" and event.get("delta", {}).get("type") == "text_delta":
+                    yield event["delta"].get("text", "")
+                elif event.get("type") == "error":
+                    raise Exception(f"Anthropic stream error: {event.get('error')}")
+
+    # --- Google Gemini API ---
+
+    @staticmethod
+    def _google_request(base_url: str, key: str, messages: List[Dict]):
         if not base_url:
             base_url = "https://generativelanguage.googleapis.com/v1beta"
         system_parts = []
@@ -382,21 +753,68 @@ class AIProviderManager:
             gemini_role = "model" if role == "assistant" else "user"
             contents.append({"role": gemini_role, "parts": [{"text": content}]})
         if not contents:
-            return None
+            return base_url, None, None
         payload = {"contents": contents, "generationConfig": {"temperature": 0.7, "maxOutputTokens": 2048}}
         if system_parts:
             payload["systemInstruction"] = {"parts": [{"text": "\n\n".join(system_parts)}]}
-        url = f"{base_url}/models/{model}:generateContent"
         headers = {"Content-Type": "application/json", "x-goog-api-key": key}
-        r = requests.post(url, headers=headers, json=payload, timeout=30)
+        return base_url, headers, payload
+
+    @staticmethod
+    def _record_google_usage(usage: Optional[Dict], call: Optional[telemetry.CallRecord] = None):
+        if usage:
+            record_prompt_usage("google", usage.get("promptTokenCount"), usage.get("cachedContentTokenCount"))
+            if call is not None:
+                call.usage(usage.get("promptTokenCount"), usage.get("candidatesTokenCount"),
+                           usage.get("cachedContentTokenCount"))
+
+    async def _call_google(self, base_url: str, key: str, model: str, messages: List[Dict],
+                           call: Optional[telemetry.CallRecord] = None) -> Optional[str]:
+        base_url, headers, payload = self._google_request(base_url, key, messages)
+        if payload is None:
+            return None
+        url = f"{base_url}/models/{model}:generateContent"
+        r = await transport.post_json("google", url, payload, headers, timeout=30)
+        key_pool.observe("google", key, r.headers)
         if r.status_code == 200:
             data = r.json()
+            self._record_google_usage(data.get("usageMetadata"), call)
             candidates = data.get("candidates", [])
             if candidates:
                 parts = candidates[0].get("content", {}).get("parts", [])
                 if parts:
                     return parts[0].get("text", "").strip()
         if r.status_code in (429, 403):
-            raise Exception(f"Key limit/auth error: {r.status_code}")
+            raise key_limit_error(r)
         logger.warning(f"Google {model}: {r.status_code} {r.text[:200]}")
         return None
+
+    async def _stream_google(self, base_url: str, key: str, model: str, messages: List[Dict],
+                             call: Optional[telemetry.CallRecord] = None) -> AsyncIterator[str]:
+        base_url, headers, payload = self._google_request(base_url, key, messages)
+        if payload is None:
+            return
+        url = f"{base_url}/models/{model}:streamGenerateContent?alt=sse"
+        async with transport.stream_post("google", url, payload, headers) as r:
+            key_pool.observe("google", key, r.headers)
+            if r.status_code != 200:
+                await self._stream_failed(r, f"Google {model}", (429, 403))
+                return
+            usage = None
+            async for data in transport.iter_sse_data(r):
+                event = json.loads(data)
+                # usageMetadata накопительная — учитываем последнюю
+                usage = event.get("usageMetadata") or usage
+                candidates = event.get("candidates") or []
+                if candidates:
+                    for part in candidates[0].get("content", {}).get("parts", []):
+                        yield part.get("text", "")
+            self._record_google_usage(usage, call)
+
+    @staticmethod
+    async def _stream_failed(r, label: str, key_errors: tuple):
+        """Ответ со статусом != 200 на потоковый запрос: ошибки ключа — исключение, остальное — лог."""
+        if r.status_code in key_errors:
+            raise key_limit_error(r)
+        body = (await r.aread()).decode("utf-8", "replace")
+        logger.warning(f"{label}: {r.status_code} {body[:200]}")
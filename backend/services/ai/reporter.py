@@ -0,0 +1,68 @@
+"""
+Периодическая выгрузка статистики AI-вызовов процесса (бот, backend) в MongoDB.
+
+Счётчики живут в памяти каждого процесса; раз в AI_STATS_INTERVAL секунд их
+сводка пишется одним документом в ai_stats (_id — имя процесса), откуда её
+отдаёт /api/ai/stats (live) — без записи в базу на каждый запрос.
+"""
+import os
+import asyncio
+import logging
+from typing import Callable, Dict, Optional
+
+from database.repositories import AIStatsRepository
+from services.ai import dispatcher, health, hedging, key_pool, routing
+from services.ai.answer_cache import answer_cache
+from services.ai.prompts import usage_snapshot as prompt_cache_snapshot
+from services.ai.token_budget import stats_snapshot as token_budget_snapshot
+
+logger = logging.getLogger(__name__)
+
+AI_STATS_INTERVAL = int(os.environ.get("AI_STATS_INTERVAL", "60"))
+
+# Разделы сводки: имя -> функция, возвращающая JSON-совместимый dict
+SECTIONS: Dict[str, Callable[[], dict]] = {
+    "hedging": hedging.stats_snapshot,
+    "health": health.snapshot,
+    "key_pool": key_pool.snapshot,
+    "answer_cache": answer_cache.stats,
+    "prompt_cache": prompt_cache_snapshot,
+    "token_budget": token_budget_snapshot,
+    "dispatcher": dispatcher.stats_snapshot,
+    "routing": routing.stats_snapshot,
+}
+
+
+class AIStatsReporter:
+    def __init__(self, source: str, db=None, interval: int = AI_STATS_INTERVAL):
+        self.source = source
+        self.repo = AIStatsRepository(db)
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def report_once(self):
+        await self.repo.save(self.source, {name: collect() for name, collect in SECTIONS.items()})
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.report_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"[AI STATS] report failed: {e}")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """Останавливает цикл и выгружает последнюю сводку."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.report_once()
+        except Exception as e:
+            logger.warning(f"[AI STATS] final report failed: {e}")
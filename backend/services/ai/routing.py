@@ -0,0 +1,109 @@
+"""
+Маршрутизация запросов по уровням моделей.
+
+Простые сообщения ("спасибо", короткий вопрос, ответ на который целиком есть
+в базе знаний) уходят быстрому/дешёвому уровню: провайдер ai_fast_provider с
+моделью ai_fast_model (например, свой llama.cpp через поле endpoint провайдера
+local). Остальное — основной (premium) модели активного провайдера, как раньше.
+
+Классификация — без вызова модели: длина сообщения, число вопросов, уверенность
+поиска по базе знаний (textScore лучшей статьи) и ключевые слова намерений
+(оплата, возврат, неработающее подключение — сразу premium). Быстрый уровень
+не ответил — запрос продолжает обычный перебор ключей и провайдеров.
+
+Без ai_fast_provider в settings всё идёт в premium.
+"""
+import logging
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+FAST = "fast"
+PREMIUM = "premium"
+
+# Настройки (settings) по умолчанию
+DEFAULT_FAST_MAX_CHARS = 160
+DEFAULT_FAST_MIN_KB_SCORE = 5.0
+DEFAULT_FAST_MAX_TURNS = 4
+
+# Вежливость и короткие реакции — ответ не требует ни базы знаний, ни рассуждений
+SMALLTALK = (
+    "спасибо", "спс", "благодарю", "привет", "здравствуй", "добрый день", "добрый вечер",
+    "доброе утро", "ок", "окей", "ok", "понял", "поняла", "ясно", "хорошо", "отлично",
+    "супер", "пока", "до свидания", "thanks", "thank you", "hello", "hi",
+)
+# Намерения, где ошибка модели дорого стоит: деньги, доступ, диагностика
+HARD_KEYWORDS = (
+    "оплат", "деньг", "списал", "списан", "возврат", "вернит", "баланс", "чек", "платеж", "платёж",
+    "не работает", "не подключ", "не открыва", "ошибк", "блокир", "медленн", "скорост",
+    "настро", "маршрут", "роутер", "dns", "ipv6", "протокол", "конфиг",
+    "менеджер", "жалоб", "человек", "оператор",
+)
+
+
+@dataclass(frozen=True)
+class Route:
+    tier: str
+    reason: str
+
+
+_counts: Counter = Counter()
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s-]", " ", (text or "").lower())).strip()
+
+
+def _keywords(settings, name: str, default: Tuple[str, ...]) -> Tuple[str, ...]:
+    extra = settings.get(name) or []
+    return default + tuple(k.lower() for k in extra)
+
+
+def fast_tier(settings) -> Optional[Tuple[str, str]]:
+    """(провайдер, модель) быстрого уровня или None; пустая модель — selected_model провайдера."""
+    provider = settings.get("ai_fast_provider") or ""
+    if not provider:
+        return None
+    return provider, settings.get("ai_fast_model") or ""
+
+
+def classify(message: str, settings, kb_score: Optional[float] = None, turns: int = 0) -> Route:
+    """
+    Уровень модели для сообщения. kb_score — textScore лучшей найденной
+    статьи (None — не искали или ничего не нашли), turns — реплик в истории.
+    """
+    if fast_tier(settings) is None:
+        return Route(PREMIUM, "no_fast_tier")
+    text = _normalize(message)
+    max_chars = int(settings.get("ai_fast_max_chars", DEFAULT_FAST_MAX_CHARS))
+
+    for keyword in _keywords(settings, "ai_routing_hard_keywords", HARD_KEYWORDS):
+        if keyword in text:
+            return _routed(PREMIUM, "intent")
+    if text and len(text) <= 40 and any(
+        text == phrase or text.startswith(phrase + " ")
+        for phrase in _keywords(settings, "ai_routing_smalltalk", SMALLTALK)
+    ):
+        return _routed(FAST, "smalltalk")
+    if len(text) > max_chars:
+        return _routed(PREMIUM, "long")
+    if (message or "").count("?") > 1:
+        return _routed(PREMIUM, "multi_question")
+    if turns > int(settings.get("ai_fast_max_turns", DEFAULT_FAST_MAX_TURNS)):
+        # Длинный диалог — вопрос, скорее всего, не решился с первого раза
+        return _routed(PREMIUM, "long_dialog")
+    if kb_score is not None and kb_score >= float(settings.get("ai_fast_min_kb_score", DEFAULT_FAST_MIN_KB_SCORE)):
+        return _routed(FAST, "kb_hit")
+    return _routed(PREMIUM, "default")
+
+
+def _routed(tier: str, reason: str) -> Route:
+    _counts[f"{tier}:{reason}"] += 1
+    return Route(tier, reason)
+
+
+def stats_snapshot() -> Dict[str, int]:
+    return dict(_counts)
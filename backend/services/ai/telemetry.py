@@ -0,0 +1,279 @@
+"""
+Телеметрия AI-вызовов: одна запись на каждую попытку к провайдеру.
+
+Попытка (CallRecord) знает провайдера, модель, номер ключа, задержку, исход,
+токены промпта/ответа и оценку стоимости; failover — попытка не первая в своём
+запросе (после ошибки или хедж). Записи копятся в памяти процесса и пачками
+уходят в time-series коллекцию ai_calls (AICallWriter): раз в
+AI_CALLS_FLUSH_INTERVAL секунд или сразу, как набралось AI_CALLS_BATCH.
+Если база недоступна, буфер держит не больше AI_CALLS_BUFFER записей —
+старые выбрасываются.
+
+Сводка по ai_calls (p50/p95, доля ошибок, расходы по дням) — /api/ai/stats.
+"""
+import os
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Deque, Dict, List, Optional, Tuple
+
+from database.indexes import AI_CALLS_RETENTION_DAYS
+from database.repositories import AICallRepository
+from services.ai.health import key_id
+from services.ai.token_budget import estimate_tokens, message_tokens
+
+logger = logging.getLogger(__name__)
+
+AI_CALLS_FLUSH_INTERVAL = int(os.environ.get("AI_CALLS_FLUSH_INTERVAL", "10"))
+AI_CALLS_BATCH = int(os.environ.get("AI_CALLS_BATCH", "200"))
+AI_CALLS_BUFFER = int(os.environ.get("AI_CALLS_BUFFER", "5000"))
+
+# Исходы попытки
+STATUS_OK = "ok"
+STATUS_EMPTY = "empty"              # провайдер ответил, но без текста
+STATUS_ERROR = "error"
+STATUS_KEY_LIMIT = "key_limit"      # 429 / 402 / 403 — ключ на паузу
+STATUS_CANCELLED = "cancelled"      # проиграла хедж или кончился бюджет ответа
+STATUS_OVERLOADED = "overloaded"    # диспетчер не дал слот
+
+# Цены, USD за 1M токенов (промпт, ответ), по префиксу имени модели — первый
+# подходящий. Переопределяются settings.ai_model_prices: {"model": [in, out]}.
+MODEL_PRICES: Tuple[Tuple[str, Tuple[float, float]], ...] = (
+    ("gpt-4.1-nano", (0.10, 0.40)),
+    ("gpt-4.1-mini", (0.40, 1.60)),
+    ("gpt-4.1", (2.00, 8.00)),
+    ("gpt-4o-mini", (0.15, 0.60)),
+    ("gpt-4o", (2.50, 10.00)),
+    ("gpt-4-turbo", (10.00, 30.00)),
+    ("gpt-3.5", (0.50, 1.50)),
+    ("o3-mini", (1.10, 4.40)),
+    ("o4-mini", (1.10, 4.40)),
+    ("claude-3-5-haiku", (0.80, 4.00)),
+    ("claude-3-haiku", (0.25, 1.25)),
+    ("claude-3-opus", (15.00, 75.00)),
+    ("claude-opus", (15.00, 75.00)),
+    ("claude", (3.00, 15.00)),
+    ("gemini-2.5-pro", (1.25, 10.00)),
+    ("gemini-2.5-flash", (0.30, 2.50)),
+    ("gemini-2.0-flash", (0.10, 0.40)),
+    ("gemini-1.5-pro", (1.25, 5.00)),
+    ("gemini-1.5-flash", (0.075, 0.30)),
+    ("llama-3.1-8b", (0.05, 0.08)),
+    ("llama-3.3-70b", (0.59, 0.79)),
+    ("mixtral", (0.24, 0.24)),
+)
+# Доля цены промпта за токены, прочитанные из кэша провайдера
+CACHED_PRICE_RATIO = {"openai": 0.5, "anthropic": 0.1, "google": 0.25}
+
+
+def model_price(model: str, settings=None) -> Optional[Tuple[float, float]]:
+    """(промпт, ответ) в USD за 1M токенов или None, если модель неизвестна."""
+    overrides = (settings.get("ai_model_prices") if settings is not None else None) or {}
+    if model in overrides:
+        prompt, completion = overrides[model]
+        return float(prompt), float(completion)
+    name = (model or "").lower().rsplit("/", 1)[-1]
+    for prefix, price in MODEL_PRICES:
+        if name.startswith(prefix):
+            return price
+    return None
+
+
+@dataclass
+class CallRecord:
+    provider: str
+    model: str
+    key_index: int
+    key: str
+    mode: str
+    failover: bool
+    source: str = ""
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached_tokens: int = 0
+
+    def usage(self, prompt_tokens: Optional[int] = None, completion_tokens: Optional[int] = None,
+              cached_tokens: Optional[int] = None):
+        """Токены из ответа провайдера (поля, которых нет, не трогает)."""
+        if prompt_tokens is not None:
+            self.prompt_tokens = prompt_tokens
+        if completion_tokens is not None:
+            self.completion_tokens = completion_tokens
+        if cached_tokens is not None:
+            self.cached_tokens = cached_tokens
+
+    def cost(self, settings=None) -> Optional[float]:
+        price = model_price(self.model, settings)
+        if price is None:
+            return None
+        cached = min(self.cached_tokens or 0, self.prompt_tokens or 0)
+        ratio = CACHED_PRICE_RATIO.get(self.provider, 1.0)
+        prompt = (self.prompt_tokens or 0) - cached + cached * ratio
+        return round((prompt * price[0] + (self.completion_tokens or 0) * price[1]) / 1_000_000, 8)
+
+    def to_doc(self, status: str, latency: float, messages: List[Dict] = None, reply: str = None,
+               first_chunk: float = None, settings=None) -> dict:
+        estimated = False
+        if self.prompt_tokens is None and messages:
+            # Провайдер не вернул usage (Emergent, часть OpenAI-совместимых) — оцениваем сами
+            self.prompt_tokens = sum(message_tokens(m) for m in messages)
+            estimated = True
+        if self.completion_tokens is None and reply:
+            self.completion_tokens = estimate_tokens(reply)
+            estimated = True
+        doc = {
+            "ts": datetime.now(timezone.utc),
+            "meta": {"provider": self.provider, "model": self.model, "source": self.source},
+            "key_index": self.key_index,
+            "key_id": key_id(self.key),
+            "mode": self.mode,
+            "status": status,
+            "failover": self.failover,
+            "latency_ms": round(latency * 1000),
+            "prompt_tokens": self.prompt_tokens or 0,
+            "completion_tokens": self.completion_tokens or 0,
+            "cached_tokens": self.cached_tokens or 0,
+            "tokens_estimated": estimated,
+            "cost_usd": self.cost(settings),
+        }
+        if first_chunk is not None:
+            doc["first_chunk_ms"] = round(first_chunk * 1000)
+        return doc
+
+
+_buffer: Deque[dict] = deque(maxlen=AI_CALLS_BUFFER)
+_source = ""
+_writer: Optional["AICallWriter"] = None
+
+
+def start_call(provider: str, model: str, key_index: int, key: str, mode: str, failover: bool) -> CallRecord:
+    return CallRecord(provider, model, key_index, key, mode, failover, _source)
+
+
+def record(call: CallRecord, status: str, latency: float, messages: List[Dict] = None, reply: str = None,
+           first_chunk: float = None, settings=None):
+    """Кладёт попытку в буфер; полный пакет будит AICallWriter."""
+    try:
+        _buffer.append(call.to_doc(status, latency, messages, reply, first_chunk, settings))
+    except Exception as e:
+        logger.warning(f"[AI CALLS] record failed: {e}")
+        return
+    if _writer is not None and len(_buffer) >= AI_CALLS_BATCH:
+        _writer.wake()
+
+
+class AICallWriter:
+    """Пакетная запись буфера попыток в ai_calls (как AIStatsReporter — start/stop)."""
+
+    def __init__(self, source: str, db=None, interval: int = AI_CALLS_FLUSH_INTERVAL):
+        self.source = source
+        self.repo = AICallRepository(db)
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def wake(self):
+        if self._wake is None or self._loop is None or self._loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._wake.set()
+        else:
+            # Попытка из другого event loop (sync-обёртка chat)
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def flush(self):
+        while _buffer:
+            batch = [_buffer.popleft() for _ in range(min(AI_CALLS_BATCH, len(_buffer)))]
+            try:
+                await self.repo.insert_many(batch)
+            except Exception:
+                # Вернём пакет в начало буфера — уйдёт следующей попыткой
+                _buffer.extendleft(reversed(batch))
+                raise
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"[AI CALLS] flush failed ({len(_buffer)} buffered): {e}")
+
+    def start(self):
+        global _source, _writer
+        _source = self.source
+        _writer = self
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает цикл и дописывает остаток буфера."""
+        global _writer
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if _writer is self:
+            _writer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.warning(f"[AI CALLS] final flush failed: {e}")
+
+
+def _summary(group: dict) -> dict:
+    p50, p95 = group.get("latency_pct") or (None, None)
+    completed = group["ok"] + group["errors"]
+    return {
+        "calls": group["calls"],
+        "errors": group["errors"],
+        "key_limits": group["key_limits"],
+        "cancelled": group["cancelled"],
+        "overloaded": group["overloaded"],
+        "failovers": group["failovers"],
+        "error_rate": round(group["errors"] / completed, 3) if completed else None,
+        "p50_ms": round(p50) if p50 is not None else None,
+        "p95_ms": round(p95) if p95 is not None else None,
+        "prompt_tokens": group["prompt_tokens"],
+        "completion_tokens": group["completion_tokens"],
+        "cost_usd": round(group["cost_usd"], 4),
+    }
+
+
+async def stats(days: int, db=None) -> dict:
+    """Сводка по ai_calls за последние days дней: по моделям, ключам и дням."""
+    days = max(1, min(days, AI_CALLS_RETENTION_DAYS))
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    repo = AICallRepository(db)
+    models = await repo.aggregate({"provider": "$meta.provider", "model": "$meta.model"}, since)
+    keys = await repo.aggregate({"provider": "$meta.provider", "key_index": "$key_index", "key_id": "$key_id"}, since)
+    daily = await repo.aggregate({"$dateToString": {"format": "%Y-%m-%d", "date": "$ts"}}, since)
+
+    totals = {"calls": 0, "errors": 0, "failovers": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+    for group in models:
+        for field in totals:
+            totals[field] += group[field]
+    completed = sum(g["ok"] + g["errors"] for g in models)
+    totals["error_rate"] = round(totals["errors"] / completed, 3) if completed else None
+    totals["cost_usd"] = round(totals["cost_usd"], 4)
+    return {
+        "days": days,
+        "totals": totals,
+        "models": [{**g["_id"], **_summary(g)} for g in models],
+        "keys": [{**g["_id"], **_summary(g)} for g in keys],
+        "daily": [{"day": g["_id"], **_summary(g)} for g in daily],
+    }
@@ -0,0 +1,160 @@
+"""
+Бюджет токенов при сборке промпта.
+
+Токены оцениваются локально и дёшево (без токенизатора провайдера): латиница
+и цифры ~4 символа на токен, кириллица и прочее ~2.2 символа, плюс накладные
+расходы на сообщение. Оценка с запасом — этого достаточно, чтобы не упереться
+в контекстное окно модели и не платить за раздутые промпты.
+
+Бюджет: settings.ai_prompt_token_budget, но не больше окна модели за вычетом
+места под ответ. Обязательные части (шаблон промпта, вопрос) входят всегда;
+остальные секции добавляются по убыванию приоритета, не влезающие целиком
+обрезаются (если можно) или выкидываются. Что выкинуто — в отчёте и в логе.
+"""
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# settings.ai_prompt_token_budget
+DEFAULT_PROMPT_BUDGET = 6000
+# Столько оставляем под ответ (max_tokens в запросах к провайдерам)
+RESPONSE_RESERVE = 2048
+# Накладные расходы на сообщение (роль, разделители)
+MESSAGE_OVERHEAD = 4
+# Обрезать секцию короче этого нет смысла — лучше выкинуть
+MIN_TRUNCATED_TOKENS = 80
+TRUNCATION_MARK = " …"
+
+# Контекстные окна по префиксу имени модели (первое совпадение); по умолчанию — DEFAULT_CONTEXT_WINDOW
+MODEL_CONTEXT_WINDOWS: Tuple[Tuple[str, int], ...] = (
+    ("gpt-4.1", 1_000_000),
+    ("gpt-4o", 128_000),
+    ("gpt-4-turbo", 128_000),
+    ("gpt-4", 8_192),
+    ("gpt-3.5", 16_385),
+    ("o1", 128_000),
+    ("o3", 200_000),
+    ("o4", 200_000),
+    ("claude", 200_000),
+    ("gemini", 1_000_000),
+    ("llama3-", 8_192),
+    ("llama-3", 128_000),
+    ("mixtral", 32_768),
+    ("gemma", 8_192),
+    ("deepseek", 64_000),
+    ("qwen", 32_768),
+)
+DEFAULT_CONTEXT_WINDOW = 8_192
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return int(ascii_chars / 4 + (len(text) - ascii_chars) / 2.2) + 1
+
+
+def message_tokens(message: Dict) -> int:
+    return estimate_tokens(message.get("content", "")) + MESSAGE_OVERHEAD
+
+
+def context_window(model: str) -> int:
+    # Имя может быть с префиксом провайдера (openrouter: "anthropic/claude-...")
+    name = (model or "").lower().rsplit("/", 1)[-1]
+    for prefix, window in MODEL_CONTEXT_WINDOWS:
+        if name.startswith(prefix):
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def prompt_budget(settings, model: str = "") -> int:
+    configured = int(settings.get("ai_prompt_token_budget", DEFAULT_PROMPT_BUDGET))
+    return min(configured, context_window(model) - RESPONSE_RESERVE)
+
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """Обрезает текст примерно до tokens токенов по границе слова."""
+    total = estimate_tokens(text)
+    if total <= tokens:
+        return text
+    cut = text[:max(0, int(len(text) * tokens / total))]
+    space = cut.rfind(" ")
+    if space > len(cut) // 2:
+        cut = cut[:space]
+    return cut.rstrip() + TRUNCATION_MARK
+
+
+@dataclass
+class Section:
+    """Необязательная часть промпта. priority: больше — важнее."""
+    name: str
+    text: str
+    priority: int
+    truncatable: bool = False
+
+
+@dataclass
+class BudgetReport:
+    budget: int
+    used: int = 0
+    dropped: List[str] = field(default_factory=list)
+    truncated: List[str] = field(default_factory=list)
+
+    @property
+    def trimmed(self) -> bool:
+        return bool(self.dropped or self.truncated)
+
+    def __str__(self):
+        parts = [f"{self.used}/{self.budget} tokens"]
+        if self.truncated:
+            parts.append(f"truncated: {', '.join(self.truncated)}")
+        if self.dropped:
+            parts.append(f"dropped: {', '.join(self.dropped)}")
+        return "; ".join(parts)
+
+
+# Счётчики по процессу: сколько промптов собрано и что из них приходилось выкидывать
+_counters: Counter = Counter()
+
+
+def fit(required_tokens: int, sections: List[Section], budget: int) -> Tuple[Dict[str, str], BudgetReport]:
+    """
+    Выбирает секции в пределах бюджета (required_tokens — уже занятое обязательными
+    частями). Возвращает {name: текст, возможно обрезанный} и отчёт.
+    """
+    report = BudgetReport(budget=budget, used=required_tokens)
+    kept: Dict[str, str] = {}
+    for section in sorted(sections, key=lambda s: -s.priority):
+        cost = estimate_tokens(section.text) + MESSAGE_OVERHEAD
+        left = budget - report.used
+        if cost <= left:
+            kept[section.name] = section.text
+            report.used += cost
+        elif section.truncatable and left - MESSAGE_OVERHEAD >= MIN_TRUNCATED_TOKENS:
+            # Запас на метку обрезки и округление оценки
+            text = truncate_to_tokens(section.text, left - MESSAGE_OVERHEAD - 2)
+            kept[section.name] = text
+            report.used += estimate_tokens(text) + MESSAGE_OVERHEAD
+            report.truncated.append(section.name)
+        else:
+            report.dropped.append(section.name)
+
+    _counters["prompts"] += 1
+    if report.trimmed:
+        _counters["trimmed"] += 1
+        for name in report.dropped:
+            _counters[f"dropped:{name.split(':')[0]}"] += 1
+        for name in report.truncated:
+            _counters[f"truncated:{name.split(':')[0]}"] += 1
+        logger.info(f"[AI BUDGET] {report}")
+    if required_tokens > budget:
+        _counters["over_budget"] += 1
+        logger.warning(f"[AI BUDGET] required parts alone take {required_tokens}/{budget} tokens")
+    return kept, report
+
+
+def stats_snapshot() -> Dict[str, int]:
+    return dict(_counters)
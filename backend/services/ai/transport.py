@@ -0,0 +1,107 @@
+"""
+HTTP-транспорт для AI-провайдеров.
+
+Долгоживущие httpx.AsyncClient — по одному на (event loop, провайдер, прокси):
+keep-alive и HTTP/2 (если установлен пакет `h2`) избавляют от нового TLS-рукопожатия
+на каждый запрос. Клиент привязан к event loop, в котором создан, поэтому пул
+ведётся отдельно для каждого loop (backend, бот, asyncio.run в sync-обёртке).
+"""
+import os
+import asyncio
+import logging
+import weakref
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+import httpx
+
+try:
+    import h2  # noqa: F401 — нужен httpx для HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:  # HTTP/2 необязателен
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Общий таймаут запроса к LLM и таймаут установки соединения (секунды)
+AI_HTTP_TIMEOUT = float(os.environ.get("AI_HTTP_TIMEOUT", "60"))
+AI_HTTP_CONNECT_TIMEOUT = float(os.environ.get("AI_HTTP_CONNECT_TIMEOUT", "10"))
+# Лимиты пула на одного провайдера
+AI_HTTP_MAX_CONNECTIONS = int(os.environ.get("AI_HTTP_MAX_CONNECTIONS", "20"))
+AI_HTTP_MAX_KEEPALIVE = int(os.environ.get("AI_HTTP_MAX_KEEPALIVE", "10"))
+AI_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("AI_HTTP_KEEPALIVE_EXPIRY", "120"))
+
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str], httpx.AsyncClient]]" = weakref.WeakKeyDictionary()
+
+
+def _new_client(proxy: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        proxy=proxy or None,
+        timeout=httpx.Timeout(AI_HTTP_TIMEOUT, connect=AI_HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=AI_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=AI_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=AI_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def get_client(provider: str, proxy: Optional[str] = None) -> httpx.AsyncClient:
+    """Пул соединений провайдера (через прокси, если задан) для текущего event loop."""
+    loop = asyncio.get_running_loop()
+    clients = _clients.setdefault(loop, {})
+    key = (provider, proxy or "")
+    client = clients.get(key)
+    if client is None or client.is_closed:
+        client = _new_client(proxy or "")
+        clients[key] = client
+        logger.info(f"AI transport: new pool for {provider}{' via proxy' if proxy else ''} (http2={HTTP2_AVAILABLE})")
+    return client
+
+
+async def close_clients():
+    """Закрывает пулы текущего event loop (при остановке backend/бота и в конце asyncio.run)."""
+    clients = _clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"AI transport close failed: {e}")
+
+
+async def post_json(provider: str, url: str, payload: dict, headers: dict,
+                    proxy: Optional[str] = None, timeout: Optional[float] = None) -> httpx.Response:
+    client = get_client(provider, proxy)
+    kwargs = {"timeout": timeout} if timeout is not None else {}
+    return await client.post(url, json=payload, headers=headers, **kwargs)
+
+
+async def get(provider: str, url: str, headers: dict,
+              proxy: Optional[str] = None, timeout: Optional[float] = None) -> httpx.Response:
+    client = get_client(provider, proxy)
+    kwargs = {"timeout": timeout} if timeout is not None else {}
+    return await client.get(url, headers=headers, **kwargs)
+
+
+@asynccontextmanager
+async def stream_post(provider: str, url: str, payload: dict, headers: dict,
+                      proxy: Optional[str] = None, timeout: Optional[float] = None):
+    """POST с потоковым чтением ответа (SSE от провайдера)."""
+    client = get_client(provider, proxy)
+    kwargs = {"timeout": timeout} if timeout is not None else {}
+    async with client.stream("POST", url, json=payload, headers=headers, **kwargs) as response:
+        yield response
+
+
+async def iter_sse_data(response: httpx.Response) -> AsyncIterator[str]:
+    """Поля `data:` событий text/event-stream (многострочные data склеиваются)."""
+    lines = []
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            lines.append(line[5:].lstrip())
+        elif not line and lines:
+            yield "\n".join(lines)
+            lines = []
+    if lines:
+        yield "\n".join(lines)
@@ -0,0 +1,145 @@
+"""
+Архивация тикетов.
+
+Закрытые и убранные тикеты не удаляются сразу: фоновый архиватор пачками
+переносит их (вместе с перепиской из ticket_messages) в компактную коллекцию
+tickets_archive и убирает из горячей tickets. Переписка в архиве при наличии
+пакета `zstandard` сжимается. Архив чистится TTL-индексом по archived_at.
+"""
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from bson import Binary
+from pymongo.errors import BulkWriteError
+
+from database import queries
+
+try:
+    import zstandard
+except ImportError:  # сжатие необязательно
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Как часто запускать архиватор (секунды)
+ARCHIVE_INTERVAL = int(os.environ.get("ARCHIVE_INTERVAL", "300"))
+# Сколько тикетов переносить за одну пачку
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "200"))
+# Через сколько минут после закрытия тикет уезжает в архив
+ARCHIVE_AFTER_MINUTES = int(os.environ.get("ARCHIVE_AFTER_MINUTES", "60"))
+# Сжимать переписку в архиве (если установлен zstandard)
+ARCHIVE_COMPRESS = os.environ.get("ARCHIVE_COMPRESS", "true").lower() == "true"
+
+# Поля тикета, которые сохраняются в архиве (user_data и last_messages не нужны)
+ARCHIVED_FIELDS = (
+    "client_id", "client_name", "client_username", "topic_id", "status", "reason",
+    "attachments", "created_at", "escalated_at", "closed_at", "removed_at", "is_removed",
+)
+
+CODEC_JSON = "json"
+CODEC_ZSTD = "zstd+json"
+
+
+def archivable_query(now: Optional[datetime] = None) -> dict:
+    """Тикеты, готовые к архивации: убранные или закрытые дольше ARCHIVE_AFTER_MINUTES."""
+    now = now or datetime.now(timezone.utc)
+    return queries.archivable_tickets(now - timedelta(minutes=ARCHIVE_AFTER_MINUTES))
+
+
+def encode_messages(messages: List[dict]):
+    """Переписка для архива: (codec, payload)."""
+    if ARCHIVE_COMPRESS and zstandard is not None:
+        raw = json.dumps(messages, default=str, ensure_ascii=False).encode("utf-8")
+        return CODEC_ZSTD, Binary(zstandard.ZstdCompressor(level=10).compress(raw))
+    return CODEC_JSON, messages
+
+
+def decode_messages(doc: dict) -> List[dict]:
+    """Обратное преобразование для архивного документа."""
+    payload = doc.get("messages") or []
+    if doc.get("messages_codec") == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read compressed archive")
+        return json.loads(zstandard.ZstdDecompressor().decompress(bytes(payload)).decode("utf-8"))
+    return payload
+
+
+class TicketArchiver:
+    """Периодически переносит закрытые/убранные тикеты в tickets_archive (async, Motor)."""
+
+    def __init__(self, db, interval: int = ARCHIVE_INTERVAL, batch_size: int = ARCHIVE_BATCH_SIZE):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+
+    async def archive_batch(self) -> int:
+        """Переносит одну пачку; возвращает число заархивированных тикетов."""
+        tickets = await self.db.tickets.find(archivable_query()).limit(self.batch_size).to_list(length=self.batch_size)
+        if not tickets:
+            return 0
+        ids = [t["_id"] for t in tickets]
+
+        messages = {tid: [] for tid in ids}
+        buckets = self.db.ticket_messages.find(queries.buckets_for_tickets(ids)).sort(queries.BUCKETS_OLDEST_FIRST)
+        async for bucket in buckets:
+            messages[bucket["ticket_id"]].extend(bucket.get("messages", []))
+
+        now = datetime.now(timezone.utc)
+        docs = []
+        for ticket in tickets:
+            ticket_messages = sorted(messages[ticket["_id"]], key=lambda m: m["ts"])
+            codec, payload = encode_messages(ticket_messages)
+            doc = {k: ticket[k] for k in ARCHIVED_FIELDS if k in ticket}
+            doc.update({
+                "_id": ticket["_id"],
+                "archived_at": now,
+                "message_count": len(ticket_messages),
+                "messages_codec": codec,
+                "messages": payload,
+            })
+            docs.append(doc)
+
+        try:
+            await self.db.tickets_archive.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Повторный запуск после сбоя: уже заархивированные _id пропускаем
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+        await self.db.ticket_messages.delete_many(queries.buckets_for_tickets(ids))
+        await self.db.tickets.delete_many({"_id": {"$in": ids}})
+        return len(ids)
+
+    async def run_once(self) -> int:
+        total = 0
+        while True:
+            moved = await self.archive_batch()
+            total += moved
+            if moved < self.batch_size:
+                break
+        if total:
+            logger.info(f"[ARCHIVE] Archived {total} tickets")
+        return total
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[ARCHIVE] archive run failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
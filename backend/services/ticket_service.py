@@ -1,17 +1,39 @@
+import os
 import logging
-from datetime import datetime, timezone
-from typing import List, Optional
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
 from bson import ObjectId
-from pymongo.database import Database
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from database import queries
+from database.pagination import InvalidCursor, encode_cursor, decode_cursor
+from database.repositories import (
+    TicketRepository, TicketMessageRepository, TicketEventRepository,
+    EVENT_CREATE, EVENT_ESCALATE, EVENT_REPLY, EVENT_CLOSE, EVENT_REMOVE,
+)
 
 from services.telegram_service import TelegramService
 from utils.support_common import get_topic_name, build_support_header, TOPIC_CLOSED
 
 logger = logging.getLogger(__name__)
 
+# Насколько /changes перечитывает назад от токена: запись, начатая раньше чужой,
+# может закоммититься позже неё (и часы бота и backend немного расходятся)
+TICKET_CHANGES_OVERLAP_SECONDS = int(os.environ.get("TICKET_CHANGES_OVERLAP_SECONDS", "10"))
+TICKET_CHANGES_LIMIT = 500
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
 class TicketService:
-    def __init__(self, db: Database, telegram_service: Optional[TelegramService] = None, support_group_id: Optional[int] = None):
+    def __init__(self, db: AsyncIOMotorDatabase, telegram_service: Optional[TelegramService] = None, support_group_id: Optional[int] = None):
         self.db = db
+        self.tickets = TicketRepository(db)
+        self.messages = TicketMessageRepository(db)
+        self.events = TicketEventRepository(db)
         self.telegram_service = telegram_service
         self.support_group_id = support_group_id
 
@@ -67,53 +89,98 @@ class TicketService:
              except Exception as e:
                 logger.error(f"Error creating telegram topic: {e}")
 
-        result = self.db.tickets.insert_one(ticket)
+        inserted_id = await self.tickets.insert(ticket)
+        await self.events.publish(EVENT_CREATE, inserted_id, topic_id, status)
         return {
-            "ticket_id": str(result.inserted_id),
+            "ticket_id": str(inserted_id),
             "status": status,
             "topic_id": topic_id
         }
 
-    async def get_active_tickets(self, manager_id: int = None) -> List[dict]:
-        """Get all active tickets (escalated + suspicious)"""
-        tickets = list(self.db.tickets.find(
-            {
-                "status": {"$in": ["escalated", "suspicious"]},
-                "is_removed": {"$ne": True}
-            }
-        ).sort([("status", 1), ("created_at", -1)]).limit(100))
-        
-        order = {"suspicious": 0, "escalated": 1}
-        tickets.sort(key=lambda t: order.get(t.get("status"), 3))
-        return tickets
-
-    async def get_escalated_tickets(self, limit: int = 50) -> List[dict]:
-        """Get escalated tickets"""
-        return list(self.db.tickets.find(
-            {"status": "escalated", "is_removed": {"$ne": True}}
-        ).sort("escalated_at", -1).limit(limit))
-
-    async def get_suspicious_tickets(self, limit: int = 50) -> List[dict]:
-        """Get suspicious tickets"""
-        return list(self.db.tickets.find(
-            {"status": "suspicious", "is_removed": {"$ne": True}}
-        ).sort("created_at", -1).limit(limit))
+    async def get_active_tickets(self, limit: int = 50, after: Optional[str] = None,
+                                 projection: Optional[dict] = None) -> Tuple[List[dict], Optional[str]]:
+        """Active tickets (suspicious first, then escalated; newest first) and the next-page cursor"""
+        return await self.tickets.page(queries.active_tickets(), queries.ACTIVE_SORT, limit, after, projection)
+
+    async def get_escalated_tickets(self, limit: int = 50, after: Optional[str] = None,
+                                    projection: Optional[dict] = None) -> Tuple[List[dict], Optional[str]]:
+        """Escalated tickets and the next-page cursor"""
+        return await self.tickets.page(queries.escalated_tickets(), queries.ESCALATED_SORT, limit, after, projection)
+
+    async def get_suspicious_tickets(self, limit: int = 50, after: Optional[str] = None,
+                                     projection: Optional[dict] = None) -> Tuple[List[dict], Optional[str]]:
+        """Suspicious tickets and the next-page cursor"""
+        return await self.tickets.page(queries.suspicious_tickets(), queries.SUSPICIOUS_SORT, limit, after, projection)
+
+    async def get_sync_token(self) -> str:
+        """Токен для /changes: версия самого свежего тикета (берётся до чтения списка)"""
+        latest = await self.tickets.latest_version() or datetime.now(timezone.utc)
+        return encode_cursor({"updated_at": _naive_utc(latest), "_id": None}, queries.CHANGES_SORT)
+
+    async def get_changes(self, since: str, limit: int = TICKET_CHANGES_LIMIT,
+                          projection: Optional[dict] = None) -> dict:
+        """
+        Изменения активного списка с момента токена: tickets — созданные/изменённые
+        активные тикеты, removed — id выпавших (закрыты, убраны, заархивированы).
+        has_more — пачка неполная, следующую запрашивать сразу с новым токеном.
+        Бросает pagination.InvalidCursor на битом токене.
+        """
+        since_ts, last_id = decode_cursor(since, queries.CHANGES_SORT)
+        if not isinstance(since_ts, datetime):
+            raise InvalidCursor("sync token has no timestamp")
+        since_ts = _naive_utc(since_ts)
+
+        if last_id is None:
+            # Новый опрос — с перекрытием назад; дубли клиент схлопывает по id
+            lower, after = since_ts - timedelta(seconds=TICKET_CHANGES_OVERLAP_SECONDS), None
+        else:
+            # Продолжение пачки — строго после последнего отданного документа
+            lower, after = since_ts, [since_ts, last_id]
+
+        if projection is not None:
+            projection = {**projection, "status": 1, "is_removed": 1, "updated_at": 1}
+        docs = await self.tickets.changed_since(lower, after, limit + 1, projection)
+        has_more = len(docs) > limit
+        docs = docs[:limit]
+
+        changed = [d for d in docs if queries.is_active_ticket(d)]
+        removed = [str(d["_id"]) for d in docs if not queries.is_active_ticket(d)]
+        if not has_more:
+            # Тикет мог уехать в архив, пока клиент не опрашивал (обычно он уже выпал при закрытии)
+            archived = self.db.tickets_archive.find(queries.archived_since(lower), {"_id": 1}).limit(limit)
+            removed += [str(d["_id"]) async for d in archived]
+
+        if has_more:
+            token = encode_cursor(docs[-1], queries.CHANGES_SORT)
+        else:
+            latest = max([_naive_utc(d["updated_at"]) for d in docs] + [since_ts])
+            token = encode_cursor({"updated_at": latest, "_id": None}, queries.CHANGES_SORT)
+        return {"tickets": changed, "removed": removed, "sync_token": token, "has_more": has_more}
 
     async def get_ticket(self, ticket_id: str) -> Optional[dict]:
         """Get ticket by ID"""
-        if not ObjectId.is_valid(ticket_id):
+        return await self.tickets.get(ticket_id)
+
+    async def get_messages(self, ticket_id: str, before: Optional[str] = None,
+                           limit: int = 30) -> Optional[Tuple[List[dict], Optional[str]]]:
+        """
+        Страница переписки тикета (по возрастанию времени) и курсор на более ранние,
+        None — тикета нет. Бросает pagination.InvalidCursor на битом курсоре.
+        """
+        ticket = await self.tickets.get(ticket_id)
+        if not ticket:
             return None
-        return self.db.tickets.find_one({"_id": ObjectId(ticket_id)})
+        return await self.messages.page(ticket["_id"], before=before, limit=limit)
 
     async def remove_ticket(self, ticket_id: str) -> bool:
         """Remove ticket"""
-        if not ObjectId.is_valid(ticket_id):
-            return False
-        result = self.db.tickets.update_one(
-            {"_id": ObjectId(ticket_id)},
+        modified = await self.tickets.update_by_id(
+            ticket_id,
             {"$set": {"is_removed": True, "removed_at": datetime.now(timezone.utc)}}
         )
-        return result.modified_count > 0
+        if modified:
+            await self.events.publish(EVENT_REMOVE, ticket_id)
+        return modified > 0
 
     async def escalate_ticket(self, ticket_id: str, reason: str = None, user_data: dict = None, last_messages: list = None):
         """Escalate ticket to manager"""
@@ -125,11 +192,10 @@ class TicketService:
         if user_data: update_data["user_data"] = user_data
         if last_messages: update_data["last_messages"] = last_messages
 
-        result = self.db.tickets.update_one(
-            {"_id": ObjectId(ticket_id)},
-            {"$set": update_data}
-        )
-        return result.modified_count > 0
+        modified = await self.tickets.update_by_id(ticket_id, {"$set": update_data})
+        if modified:
+            await self.events.publish(EVENT_ESCALATE, ticket_id, status="escalated")
+        return modified > 0
 
     async def mark_suspicious(self, ticket_id: str, reason: str = None):
         """Mark ticket as suspicious"""
@@ -139,11 +205,10 @@ class TicketService:
         }
         if reason: update_data["reason"] = reason
         
-        result = self.db.tickets.update_one(
-            {"_id": ObjectId(ticket_id)},
-            {"$set": update_data}
-        )
-        return result.modified_count > 0
+        modified = await self.tickets.update_by_id(ticket_id, {"$set": update_data})
+        if modified:
+            await self.events.publish(EVENT_ESCALATE, ticket_id, status="suspicious")
+        return modified > 0
 
     async def add_attachment(self, ticket_id: str, att_type: str, value: str, url: str = None):
         """Add attachment to ticket"""
@@ -153,15 +218,12 @@ class TicketService:
             "url": url,
             "added_at": datetime.now(timezone.utc).isoformat()
         }
-        result = self.db.tickets.update_one(
-            {"_id": ObjectId(ticket_id)},
-            {"$push": {"attachments": attachment}}
-        )
-        return result.modified_count > 0
+        modified = await self.tickets.update_by_id(ticket_id, {"$push": {"attachments": attachment}})
+        return modified > 0
 
     async def reply_to_ticket(self, ticket_id: str, message: str, manager_name: str) -> dict:
         """Reply to ticket from manager"""
-        ticket = self.db.tickets.find_one({"_id": ObjectId(ticket_id)})
+        ticket = await self.tickets.get(ticket_id)
         if not ticket:
             return {"ok": False, "error": "ticket_not_found"}
 
@@ -205,17 +267,18 @@ class TicketService:
         last_messages.append(reply_record)
         if len(last_messages) > 20: last_messages = last_messages[-20:]
         
-        self.db.tickets.update_one(
-            {"_id": ObjectId(ticket_id)},
+        await self.tickets.update_by_id(
+            ticket_id,
             {
                 "$set": {
                     "last_messages": last_messages,
                     "last_reply_at": datetime.now(timezone.utc),
                     "ai_disabled": True  # <--- ОТКЛЮЧАЕМ ИИ ПРИ ОТВЕТЕ МЕНЕДЖЕРА (API)
                 },
-                "$push": {"history": reply_record}
             }
         )
+        await self.messages.append(ticket["_id"], [reply_record])
+        await self.events.publish(EVENT_REPLY, ticket["_id"], topic_id, ticket.get("status"))
         
         if telegram_sent:
             return {"ok": True, "message": "Reply sent"}
@@ -231,13 +294,13 @@ class TicketService:
         elif str(ticket_id).isdigit():
             tid = int(ticket_id)
             if tid > 1000000:
-                query = {"client_id": tid, "is_removed": {"$ne": True}, "status": {"$ne": "closed"}}
+                query = queries.live_by_client(tid)
             else:
-                query = {"topic_id": tid}
+                query = queries.by_topic(tid)
         else:
             return {"ok": False, "error": "Invalid ticket_id"}
 
-        ticket = self.db.tickets.find_one(query)
+        ticket = await self.tickets.find_one(query)
         if not ticket:
             return {"ok": False, "error": "Ticket not found"}
 
@@ -284,17 +347,17 @@ class TicketService:
             except Exception as e:
                 logger.error(f"Telegram error in close_ticket: {e}")
         
-        # Удаляем тикет из БД (кроме подозрительных, закрытых клиентом)
+        # Закрываем тикет (кроме подозрительных, закрытых клиентом); в архив его перенесёт TicketArchiver
         if is_manager or not is_suspicious:
-            # Менеджер всегда удаляет, клиент удаляет только обычные тикеты
-            logger.info(f"[CLOSE_TICKET] Deleting ticket {ticket['_id']} from DB")
-            self.db.tickets.delete_one({"_id": ticket["_id"]})
+            logger.info(f"[CLOSE_TICKET] Marking ticket {ticket['_id']} closed")
+            await self.tickets.mark_closed({"_id": ticket["_id"]})
         else:
             # Подозрительный тикет, закрытый клиентом - оставляем в БД
             logger.info(f"[CLOSE_TICKET] Keeping suspicious ticket {ticket['_id']} in DB")
-            self.db.tickets.update_one(
+            await self.tickets.update(
                 {"_id": ticket["_id"]}, 
                 {"$set": {"status": "suspicious", "closed_at": datetime.now(timezone.utc)}}
             )
+        await self.events.publish(EVENT_CLOSE, ticket["_id"], thread_id, final_status)
 
         return {"ok": True, "message": "Ticket closed", "client_id": client_id, "topic_id": thread_id}
@@ -0,0 +1,130 @@
+"""Диспетчер AI-запросов: лимиты одновременных попыток и порядок выдачи слотов по приоритетам."""
+import asyncio
+
+import pytest
+
+from services.ai import dispatcher
+from services.ai.errors import AIOverloaded
+from services.ai.health import key_id
+
+LIVE, MANAGER, BACKGROUND = dispatcher.PRIORITY_LIVE, dispatcher.PRIORITY_MANAGER, dispatcher.PRIORITY_BACKGROUND
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(dispatcher, "_class_stats", {})
+
+
+async def acquire(provider, key, priority, settings, admitted=None, tag=None):
+    with dispatcher.with_priority(priority):
+        await dispatcher.acquire(provider, key, settings)
+    if admitted is not None:
+        admitted.append(tag)
+
+
+def queue(*coros):
+    return [asyncio.create_task(c) for c in coros]
+
+
+async def settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+async def test_provider_and_key_caps():
+    settings = {"ai_max_concurrency_per_provider": 2, "ai_max_concurrency_per_key": 1}
+    admitted = []
+    await acquire("openai", "k1", LIVE, settings)
+    tasks = queue(
+        acquire("openai", "k1", LIVE, settings, admitted, "k1-second"),   # ключ занят
+        acquire("openai", "k2", LIVE, settings, admitted, "k2"),
+        acquire("openai", "k3", LIVE, settings, admitted, "k3"),          # провайдер занят
+        acquire("groq", "g1", LIVE, settings, admitted, "groq"),          # другой провайдер — свой лимит
+    )
+    await settle()
+    # k2 не обгоняет ждущего k1-second того же провайдера
+    assert admitted == ["groq"]
+    d = dispatcher.get_dispatcher()
+    assert d.by_provider["openai"] == 1
+    assert d.by_key[("openai", key_id("k1"))] == 1
+
+    dispatcher.release("openai", "k1", settings)
+    await settle()
+    # Освободился k1: k1-second и k2 укладываются в лимит провайдера, k3 ждёт
+    assert admitted == ["groq", "k1-second", "k2"]
+    assert d.by_provider["openai"] == 2
+
+    dispatcher.release("openai", "k2", settings)
+    await settle()
+    assert admitted[-1] == "k3"
+    await asyncio.gather(*tasks)
+
+
+async def test_slots_go_to_higher_priority_first():
+    settings = {"ai_max_concurrency_per_provider": 1}
+    admitted = []
+    await acquire("openai", "k", LIVE, settings)
+    tasks = queue(
+        acquire("openai", "k", BACKGROUND, settings, admitted, "background"),
+        acquire("openai", "k", MANAGER, settings, admitted, "manager-1"),
+        acquire("openai", "k", MANAGER, settings, admitted, "manager-2"),
+        acquire("openai", "k", LIVE, settings, admitted, "live"),
+    )
+    await settle()
+    for _ in tasks:
+        dispatcher.release("openai", "k", settings)
+        await settle()
+    await asyncio.gather(*tasks)
+    assert admitted == ["live", "manager-1", "manager-2", "background"]
+
+
+async def test_full_queue_sheds_lower_priority():
+    settings = {"ai_max_concurrency_per_provider": 1, "ai_queue_limit": 1}
+    admitted = []
+    await acquire("openai", "k", LIVE, settings)
+    background, = queue(acquire("openai", "k", BACKGROUND, settings, admitted, "background"))
+    await settle()
+    live, = queue(acquire("openai", "k", LIVE, settings, admitted, "live"))
+    await settle()
+    with pytest.raises(AIOverloaded):
+        await background
+
+    # Вытеснять больше некого — следующий запрос получает отказ сразу
+    with pytest.raises(AIOverloaded):
+        await acquire("openai", "k", MANAGER, settings)
+
+    dispatcher.release("openai", "k", settings)
+    await live
+    assert admitted == ["live"]
+    assert dispatcher.stats_snapshot()["classes"]["background"]["shed"] == 1
+
+
+async def test_class_queue_limit():
+    settings = {"ai_max_concurrency_per_provider": 1}
+    await acquire("openai", "k", LIVE, settings)
+    limit = dispatcher.CLASS_QUEUE_LIMITS[BACKGROUND]
+    tasks = queue(*(acquire("openai", "k", BACKGROUND, settings) for _ in range(limit)))
+    await settle()
+    with pytest.raises(AIOverloaded):
+        await acquire("openai", "k", BACKGROUND, settings)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def test_cancelled_waiter_frees_its_place():
+    settings = {"ai_max_concurrency_per_provider": 1}
+    admitted = []
+    await acquire("openai", "k", LIVE, settings)
+    cancelled, waiting = queue(
+        acquire("openai", "k", LIVE, settings, admitted, "cancelled"),
+        acquire("openai", "k", LIVE, settings, admitted, "waiting"),
+    )
+    await settle()
+    cancelled.cancel()
+    await settle()
+    dispatcher.release("openai", "k", settings)
+    await waiting
+    assert admitted == ["waiting"]
+    d = dispatcher.get_dispatcher()
+    assert d.by_provider["openai"] == 1 and not d.waiters
@@ -0,0 +1,56 @@
+"""Хеджирование: медленную попытку дублирует следующий кандидат, проигравший отменяется."""
+import asyncio
+
+import pytest
+
+from services.ai import hedging
+
+SETTINGS = {"ai_hedge_min_delay": 0.01, "ai_hedge_max_delay": 0.05}
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(hedging, "_stats", {})
+
+
+def candidate(provider, delay, result, log):
+    async def attempt():
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            log.append(f"{provider} cancelled")
+            raise
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return provider, provider, attempt
+
+
+async def test_slow_primary_is_hedged_and_cancelled():
+    log = []
+    won = await hedging.race(iter([
+        candidate("slow", 5, "slow answer", log),
+        candidate("fast", 0.01, "fast answer", log),
+    ]), "chat", SETTINGS)
+    assert won == ("fast", "fast answer")
+    assert log == ["slow cancelled"]
+    assert hedging.get_stats("fast").hedge_wins == 1
+    assert hedging.get_stats("slow").cancelled == 1
+
+
+async def test_failure_starts_next_candidate_without_waiting():
+    log = []
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    won = await hedging.race(iter([
+        candidate("broken", 0, RuntimeError("HTTP 500"), log),
+        candidate("backup", 0, "ok", log),
+    ]), "chat", {**SETTINGS, "ai_hedge_max_delay": 5})
+    assert won == ("backup", "ok")
+    assert loop.time() - started < 1
+    assert hedging.get_stats("broken").failures == 1
+    assert hedging.get_stats("backup").hedges_fired == 0
+
+
+async def test_no_answer():
+    assert await hedging.race(iter([candidate("empty", 0, None, [])]), "chat", SETTINGS) is None
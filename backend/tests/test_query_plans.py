@@ -0,0 +1,28 @@
+"""Каждая форма запроса из database/queries.py обслуживается индексом каталога (нужен mongod)."""
+import os
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from database import query_plans
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+
+
+@pytest.fixture(scope="module")
+def mongo_url():
+    client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError as e:
+        pytest.skip(f"mongod is not reachable at {MONGO_URL}: {e}")
+    finally:
+        client.close()
+    return MONGO_URL
+
+
+def test_every_query_shape_uses_an_index(mongo_url):
+    results = query_plans.run(mongo_url)
+    assert set(results) == {shape.name for shape in query_plans.QUERY_SHAPES}
+    assert {name: problems for name, problems in results.items() if problems} == {}
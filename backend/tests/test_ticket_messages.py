@@ -0,0 +1,149 @@
+"""Пагинация переписки тикета (TicketMessageRepository.page) на фейковой коллекции бакетов."""
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+from database import repositories
+from database.pagination import InvalidCursor
+from database.repositories import TicketMessageRepository, TicketWriteBuffer
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, sort):
+        for key, direction in reversed(sort):
+            self.docs.sort(key=lambda d: d[key], reverse=direction < 0)
+        return self
+
+    def __aiter__(self):
+        self._it = iter(self.docs)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._it)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeBuckets:
+    """Ровно те операции ticket_messages, что делает репозиторий: upsert в открытый бакет и find."""
+
+    def __init__(self):
+        self.buckets = []
+
+    async def update_one(self, query, update, upsert=False):
+        bucket = next((b for b in self.buckets if b["ticket_id"] == query["ticket_id"]
+                       and b["count"] < query["count"]["$lt"]), None)
+        if bucket is None:
+            bucket = {"_id": ObjectId(), "ticket_id": query["ticket_id"], "count": 0, "messages": []}
+            self.buckets.append(bucket)
+        bucket["messages"].extend(update["$push"]["messages"]["$each"])
+        bucket["count"] += update["$inc"]["count"]
+        bucket["first_ts"] = min(bucket.get("first_ts", update["$min"]["first_ts"]), update["$min"]["first_ts"])
+        bucket["last_ts"] = max(bucket.get("last_ts", update["$max"]["last_ts"]), update["$max"]["last_ts"])
+
+    def find(self, query, projection=None):
+        docs = [b for b in self.buckets if b["ticket_id"] == query["ticket_id"]]
+        if "first_ts" in query:
+            docs = [b for b in docs if b["first_ts"] <= query["first_ts"]["$lte"]]
+        return FakeCursor(docs)
+
+
+class FakeTickets:
+    """tickets с одним документом: update_one и find_one_and_update по topic_id."""
+
+    def __init__(self, ticket=None):
+        self.ticket = ticket
+        self.updates = []
+
+    async def update_one(self, query, update):
+        self.updates.append(update)
+
+    async def find_one_and_update(self, query, update, projection=None):
+        self.updates.append(update)
+        if self.ticket is None or self.ticket["topic_id"] != query["topic_id"]:
+            return None
+        return {"_id": self.ticket["_id"]}
+
+
+@pytest.fixture
+def repo():
+    repo = TicketMessageRepository.__new__(TicketMessageRepository)
+    repo.collection = FakeBuckets()
+    return repo
+
+
+async def read_all(repo, ticket_id, limit):
+    """Все сообщения, листая страницы назад; проверяет, что каждая страница не длиннее limit."""
+    pages, before = [], None
+    while True:
+        messages, before = await repo.page(ticket_id, before=before, limit=limit)
+        assert len(messages) <= limit
+        pages.insert(0, messages)
+        if before is None:
+            return [m["content"] for page in pages for m in page]
+
+
+async def test_flush_split_by_page_boundary_keeps_every_message(repo):
+    ticket_id = ObjectId()
+    # Одна пачка TicketWriteBuffer в одну миллисекунду — одинаковый ts у всех записей
+    ts = datetime(2024, 5, 1, 12, 0, 0)
+    await repo.append(ticket_id, [{"role": "user", "content": "m0", "ts": datetime(2024, 5, 1, 11, 59)}])
+    await repo.append(ticket_id, [{"role": "user", "content": f"m{i}", "ts": ts} for i in range(1, 6)])
+
+    first, before = await repo.page(ticket_id, limit=3)
+    assert [m["content"] for m in first] == ["m3", "m4", "m5"]
+    assert before is not None
+
+    second, before = await repo.page(ticket_id, before=before, limit=3)
+    assert [m["content"] for m in second] == ["m0", "m1", "m2"]
+    assert before is None
+
+
+async def test_equal_timestamps_across_buckets(repo, monkeypatch):
+    monkeypatch.setattr(repositories, "MESSAGE_BUCKET_SIZE", 4)
+    ticket_id = ObjectId()
+    ts = datetime(2024, 5, 1, 12, 0, 0)
+    for i in range(0, 10, 2):
+        await repo.append(ticket_id, [{"content": f"m{i}", "ts": ts}, {"content": f"m{i + 1}", "ts": ts}])
+
+    assert len(repo.collection.buckets) == 3
+    for limit in (1, 3, 4, 7):
+        assert await read_all(repo, ticket_id, limit) == [f"m{i}" for i in range(10)]
+
+
+async def test_last_page_has_no_cursor(repo):
+    ticket_id = ObjectId()
+    await repo.append(ticket_id, [{"content": "a"}, {"content": "b"}])
+    messages, before = await repo.page(ticket_id, limit=2)
+    assert [m["content"] for m in messages] == ["a", "b"]
+    assert before is None
+
+
+async def test_invalid_cursor(repo):
+    with pytest.raises(InvalidCursor):
+        await repo.page(ObjectId(), before="not-a-cursor", limit=10)
+
+
+async def test_flush_resolves_ticket_id_by_topic(repo):
+    # ticket_oid не пришёл из user_data (устаревший topic_id) — _id берётся из обновления тикета
+    ticket_id = ObjectId()
+    tickets = FakeTickets({"_id": ticket_id, "topic_id": 42})
+    async with TicketWriteBuffer(tickets, {"topic_id": 42}, repo, topic_id=42) as writes:
+        writes.set({"status": "open"})
+        writes.message({"role": "user", "content": "hello"})
+
+    assert len(tickets.updates) == 1
+    assert [m["content"] for m in (await repo.page(ticket_id, limit=10))[0]] == ["hello"]
+
+
+async def test_flush_without_ticket_logs_dropped_messages(repo, caplog):
+    async with TicketWriteBuffer(FakeTickets(), {"topic_id": 42}, repo, topic_id=42) as writes:
+        writes.message({"role": "user", "content": "hello"})
+
+    assert repo.collection.buckets == []
+    assert "dropped 1 message" in caplog.text
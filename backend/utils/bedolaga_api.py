@@ -1,6 +1,6 @@
 import httpx
 import logging
-from utils.db_config import get_settings
+from utils.db_config import get_settings_snapshot
 
 logger = logging.getLogger(__name__)
 
@@ -8,7 +8,7 @@ async def fetch_bedolaga_balance(telegram_id: int) -> dict:
     """
     Get balance from Bedolaga API.
     """
-    config = get_settings()
+    config = get_settings_snapshot()
     api_url = (config.get("bedolaga_webhook_url") or config.get("bedolaga_api_url") or "").rstrip("/")
     api_token = config.get("bedolaga_web_api_token") or config.get("bedolaga_api_token") or ""
     
@@ -41,7 +41,7 @@ async def fetch_bedolaga_transactions(bedolaga_user_id: int) -> list:
     """
     Get transactions from Bedolaga API.
     """
-    config = get_settings()
+    config = get_settings_snapshot()
     api_url = (config.get("bedolaga_webhook_url") or config.get("bedolaga_api_url") or "").rstrip("/")
     api_token = config.get("bedolaga_web_api_token") or config.get("bedolaga_api_token") or ""
     
@@ -0,0 +1,138 @@
+"""
+Наблюдатель за изменениями конфигурации (settings / ai_providers).
+
+Backend и бот работают в разных процессах, и у каждого свой снимок настроек
+в памяти. ConfigWatcher слушает MongoDB change stream и при изменении
+сбрасывает локальные кэши и вызывает подписчиков. На standalone mongod
+(без replica set) change stream недоступен — тогда используется опрос.
+"""
+import os
+import hashlib
+import logging
+import threading
+from typing import Callable, List, Optional
+
+import bson
+from pymongo.errors import OperationFailure, PyMongoError
+
+from utils.db_config import invalidate_settings, invalidate_ai_providers
+
+logger = logging.getLogger(__name__)
+
+WATCHED_COLLECTIONS = ("settings", "ai_providers")
+
+# Интервал опроса для standalone mongod (секунды)
+CONFIG_POLL_INTERVAL = float(os.environ.get("CONFIG_POLL_INTERVAL", "5"))
+
+# Коды ошибок MongoDB, означающие "change streams не поддерживаются"
+_CHANGE_STREAM_UNSUPPORTED = {40573, 40324, 136}
+
+
+class ConfigWatcher:
+    """Pushes settings/ai_providers changes into the running process."""
+
+    def __init__(self, db, poll_interval: float = CONFIG_POLL_INTERVAL):
+        self.db = db
+        self.poll_interval = poll_interval
+        self._listeners: List[Callable[[str], None]] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._resume_token = None
+
+    def add_listener(self, callback: Callable[[str], None]):
+        """callback(collection_name) вызывается из потока наблюдателя."""
+        self._listeners.append(callback)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _notify(self, collection: str):
+        if collection == "settings":
+            invalidate_settings()
+        elif collection == "ai_providers":
+            invalidate_ai_providers()
+        else:
+            return
+        logger.info(f"[CONFIG] '{collection}' changed, pushing new config")
+        for callback in list(self._listeners):
+            try:
+                callback(collection)
+            except Exception as e:
+                logger.error(f"[CONFIG] listener error: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._watch_change_stream()
+            except OperationFailure as e:
+                if e.code in _CHANGE_STREAM_UNSUPPORTED or "replica set" in str(e).lower():
+                    logger.info("[CONFIG] Change streams unavailable, falling back to polling")
+                    self._poll_loop()
+                    return
+                logger.warning(f"[CONFIG] change stream error: {e}")
+                # Токен возобновления мог устареть — начинаем заново и пересинхронизируемся
+                self._resume_token = None
+                for collection in WATCHED_COLLECTIONS:
+                    self._notify(collection)
+                self._stop.wait(self.poll_interval)
+            except PyMongoError as e:
+                logger.warning(f"[CONFIG] change stream error: {e}")
+                self._stop.wait(self.poll_interval)
+
+    def _watch_change_stream(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(WATCHED_COLLECTIONS)}}}]
+        with self.db.watch(pipeline, resume_after=self._resume_token, max_await_time_ms=1000) as stream:
+            logger.info("[CONFIG] Watching settings/ai_providers via change stream")
+            while not self._stop.is_set() and stream.alive:
+                change = stream.try_next()
+                self._resume_token = stream.resume_token
+                if change is not None:
+                    self._notify(change.get("ns", {}).get("coll", ""))
+
+    def _fingerprint(self, collection: str) -> str:
+        docs = list(self.db[collection].find({}).sort("_id", 1))
+        return hashlib.sha1(bson.encode({"docs": docs})).hexdigest()
+
+    def _poll_loop(self):
+        fingerprints = {}
+        while not self._stop.is_set():
+            for collection in WATCHED_COLLECTIONS:
+                try:
+                    fp = self._fingerprint(collection)
+                except PyMongoError as e:
+                    logger.warning(f"[CONFIG] poll error for {collection}: {e}")
+                    continue
+                previous = fingerprints.get(collection)
+                fingerprints[collection] = fp
+                if previous is not None and previous != fp:
+                    self._notify(collection)
+            self._stop.wait(self.poll_interval)
+
+
+_watcher: Optional[ConfigWatcher] = None
+
+
+def start_config_watcher(db) -> ConfigWatcher:
+    """Start (once per process) and return the config watcher."""
+    global _watcher
+    if _watcher is None:
+        _watcher = ConfigWatcher(db)
+    _watcher.start()
+    return _watcher
+
+
+def stop_config_watcher():
+    global _watcher
+    if _watcher is not None:
+        _watcher.stop()
+        _watcher = None
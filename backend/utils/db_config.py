@@ -1,6 +1,12 @@
 
 import os
-from pymongo import MongoClient
+import copy
+import time
+import threading
+from dataclasses import dataclass, field, replace
+from types import MappingProxyType
+from typing import Mapping, Optional
+from pymongo import MongoClient, monitoring
 import logging
 
 # Configure logging
@@ -11,29 +17,283 @@ logger = logging.getLogger(__name__)
 MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
 DB_NAME = os.environ.get("DB_NAME", "reshala_support")
 
+
+def _env_int(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning(f"Invalid {name}={value!r}, using {default}")
+        return default
+
+
+# Connection pool tuning (одинаково для backend и бота)
+MONGO_POOL_OPTIONS = {
+    "maxPoolSize": _env_int("MONGO_MAX_POOL_SIZE", 50),
+    "minPoolSize": _env_int("MONGO_MIN_POOL_SIZE", 0),
+    "maxIdleTimeMS": _env_int("MONGO_MAX_IDLE_TIME_MS", 300000),
+    "connectTimeoutMS": _env_int("MONGO_CONNECT_TIMEOUT_MS", 5000),
+    "serverSelectionTimeoutMS": _env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+    "socketTimeoutMS": _env_int("MONGO_SOCKET_TIMEOUT_MS", 30000),
+    "waitQueueTimeoutMS": _env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000),
+}
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Collects connection pool counters for /api/health."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.created = 0
+        self.closed = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.pool_clears = 0
+        self._checkout_time_total = 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            avg_ms = (self._checkout_time_total / self.checkouts * 1000) if self.checkouts else 0.0
+            return {
+                "open": self.open,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "created": self.created,
+                "closed": self.closed,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "pool_clears": self.pool_clears,
+                "avg_checkout_ms": round(avg_ms, 3),
+                "max_pool_size": MONGO_POOL_OPTIONS["maxPoolSize"],
+            }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open = max(0, self.open - 1)
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            # duration есть в pymongo >= 4.7
+            self._checkout_time_total += getattr(event, "duration", 0.0) or 0.0
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use = max(0, self.in_use - 1)
+
+
+pool_metrics = PoolMetrics()
+
 # Global client and db
 _client = None
 _db = None
+_client_lock = threading.Lock()
+
+def get_client() -> Optional[MongoClient]:
+    """Get the process-wide MongoClient (creates it on first use)."""
+    get_db()
+    return _client
 
 def get_db():
     """
     Get the MongoDB database instance.
     Initializes connection if not already established.
+    One client (and one connection pool) is shared by the whole process.
     """
     global _client, _db
     if _db is None:
-        try:
-            _client = MongoClient(MONGO_URL)
-            _db = _client[DB_NAME]
-            # Verify connection
-            _client.admin.command('ping')
-            logger.info(f"Connected to MongoDB: {DB_NAME}")
-        except Exception as e:
-            logger.error(f"Failed to connect to MongoDB: {e}")
-            return None
+        with _client_lock:
+            if _db is not None:
+                return _db
+            client = None
+            try:
+                client = MongoClient(MONGO_URL, event_listeners=[pool_metrics], **MONGO_POOL_OPTIONS)
+                # Verify connection
+                client.admin.command('ping')
+                _client = client
+                _db = client[DB_NAME]
+                logger.info(f"Connected to MongoDB: {DB_NAME} (pool: {MONGO_POOL_OPTIONS})")
+            except Exception as e:
+                logger.error(f"Failed to connect to MongoDB: {e}")
+                if client is not None:
+                    client.close()
+                return None
     return _db
 
+def close_db():
+    """Close the shared client (called on application shutdown)."""
+    global _client, _db
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _db = None
+
+def get_pool_stats() -> dict:
+    """Connection pool metrics of the shared client."""
+    return pool_metrics.snapshot()
+
+
+# Async (Motor) client — для кода, работающего в event loop (бот, async роутеры).
+# Motor не может делить пул с синхронным клиентом, поэтому пул у него свой,
+# но с теми же настройками.
+async_pool_metrics = PoolMetrics()
+_async_client = None
+_async_db = None
+
+def get_async_db():
+    """
+    Get the Motor database instance (created lazily on first use).
+    Must be used from async code running on the application event loop.
+    """
+    global _async_client, _async_db
+    if _async_db is None:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        _async_client = AsyncIOMotorClient(MONGO_URL, event_listeners=[async_pool_metrics], **MONGO_POOL_OPTIONS)
+        _async_db = _async_client[DB_NAME]
+        logger.info(f"Motor client created for MongoDB: {DB_NAME}")
+    return _async_db
+
+def close_async_db():
+    """Close the Motor client (called on application shutdown)."""
+    global _async_client, _async_db
+    if _async_client is not None:
+        _async_client.close()
+    _async_client = None
+    _async_db = None
+
+def get_async_pool_stats() -> dict:
+    """Connection pool metrics of the Motor client."""
+    return async_pool_metrics.snapshot()
+
+# Settings snapshot cache
+# TTL можно задать через SETTINGS_CACHE_TTL (секунды), 0 — отключить кэш
+SETTINGS_CACHE_TTL = float(os.environ.get("SETTINGS_CACHE_TTL", "30"))
+
+
+@dataclass(frozen=True)
+class SettingsSnapshot:
+    """Immutable view of the merged settings (DB + ENV)."""
+    version: int
+    loaded_at: float
+    data: Mapping = field(default_factory=lambda: MappingProxyType({}))
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+
+_settings_lock = threading.Lock()
+_settings_snapshot: Optional[SettingsSnapshot] = None
+_settings_version = 0
+
+
+def _freeze(value):
+    """Recursively convert lists/dicts to immutable equivalents."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    """Inverse of _freeze — returns plain mutable dicts/lists."""
+    if isinstance(value, Mapping):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return copy.copy(value)
+
+
+def get_settings_snapshot(force_reload: bool = False) -> SettingsSnapshot:
+    """
+    Get the cached settings snapshot.
+    Reloads from MongoDB only when the TTL expired or the cache was invalidated.
+    """
+    global _settings_snapshot, _settings_version
+    snapshot = _settings_snapshot
+    if (
+        not force_reload
+        and snapshot is not None
+        and time.monotonic() - snapshot.loaded_at < SETTINGS_CACHE_TTL
+    ):
+        return snapshot
+
+    with _settings_lock:
+        # Другой поток мог уже обновить снимок, пока мы ждали блокировку
+        snapshot = _settings_snapshot
+        if (
+            not force_reload
+            and snapshot is not None
+            and time.monotonic() - snapshot.loaded_at < SETTINGS_CACHE_TTL
+        ):
+            return snapshot
+
+        data = _freeze(_load_settings())
+        if snapshot is None or snapshot.data != data:
+            _settings_version += 1
+        _settings_snapshot = SettingsSnapshot(
+            version=_settings_version,
+            loaded_at=time.monotonic(),
+            data=data,
+        )
+        return _settings_snapshot
+
+
+def invalidate_settings():
+    """Drop the cached snapshot so the next read goes to MongoDB."""
+    global _settings_snapshot
+    with _settings_lock:
+        if _settings_snapshot is not None:
+            # Оставляем данные для сравнения версий, но помечаем снимок устаревшим
+            _settings_snapshot = replace(_settings_snapshot, loaded_at=float("-inf"))
+
+
 def get_settings():
+    """
+    Get the current settings as a mutable copy of the cached snapshot.
+    Callers that only read a couple of keys should prefer get_settings_snapshot().
+    """
+    return _thaw(get_settings_snapshot().data)
+
+
+def _load_settings():
     """
     Get the current settings from the database, falling back to environment variables.
     This ensures that settings defined in .env are visible in the Mini App and can be overridden.
@@ -145,10 +405,45 @@ def get_settings():
 
 def get_bot_token():
     """Get bot token from settings."""
-    settings = get_settings()
-    return settings.get("bot_token", "")
+    return get_settings_snapshot().get("bot_token", "")
 
 def get_support_group_id():
     """Get support group ID from settings."""
-    settings = get_settings()
-    return settings.get("support_group_id")
+    return get_settings_snapshot().get("support_group_id")
+
+
+# AI providers snapshot cache (same TTL as settings)
+_providers_lock = threading.Lock()
+_providers_snapshot = None
+_providers_loaded_at = float("-inf")
+
+
+def get_ai_providers():
+    """
+    Get AI provider documents (without _id) from the in-process cache.
+    Returns mutable copies, the cached snapshot itself is immutable.
+    """
+    global _providers_snapshot, _providers_loaded_at
+    with _providers_lock:
+        if (
+            _providers_snapshot is None
+            or time.monotonic() - _providers_loaded_at >= SETTINGS_CACHE_TTL
+        ):
+            db = get_db()
+            providers = []
+            if db is not None:
+                try:
+                    providers = list(db.ai_providers.find({}, {"_id": 0}))
+                except Exception as e:
+                    logger.error(f"Error fetching AI providers: {e}")
+            _providers_snapshot = _freeze(providers)
+            _providers_loaded_at = time.monotonic()
+        snapshot = _providers_snapshot
+    return _thaw(snapshot)
+
+
+def invalidate_ai_providers():
+    """Drop the cached AI providers so the next read goes to MongoDB."""
+    global _providers_loaded_at
+    with _providers_lock:
+        _providers_loaded_at = float("-inf")
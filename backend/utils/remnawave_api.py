@@ -1,12 +1,12 @@
 import httpx
 import logging
-from utils.db_config import get_settings
+from utils.db_config import get_settings_snapshot
 
 logger = logging.getLogger(__name__)
 
 async def fetch_user_data(telegram_id: int) -> dict:
     """Получение полных данных пользователя из Remnawave API"""
-    config = get_settings()
+    config = get_settings_snapshot()
     api_url = config.get("remnawave_api_url", "").rstrip("/")
     api_token = config.get("remnawave_api_token", "")
     
@@ -74,7 +74,7 @@ async def remnawave_action(user_uuid: str, action_type: str) -> dict:
     Выполнение действий над пользователем Remnawave.
     action_type: reset_traffic, revoke_sub, disable, enable, hwid_all
     """
-    config = get_settings()
+    config = get_settings_snapshot()
     api_url = config.get("remnawave_api_url", "").rstrip("/")
     api_token = config.get("remnawave_api_token", "")
     
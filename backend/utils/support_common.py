@@ -20,11 +20,11 @@ ESCALATION_TRIGGERS = [
     "обратитесь к менеджеру",
 ]
 
-from utils.db_config import get_settings
+from utils.db_config import get_settings_snapshot
 import re
 
 def check_access(user_id):
-    config = get_settings()
+    config = get_settings_snapshot()
     allowed = set(config.get("allowed_manager_ids", []))
     return user_id in allowed
 
@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect, useCallback } from 'react';
 import { Zap, Key, Plus, Trash2, Check, X, ChevronDown, ChevronUp, Wifi, WifiOff, AlertCircle } from 'lucide-react';
 
 const API = process.env.REACT_APP_BACKEND_URL;
@@ -9,6 +9,7 @@ const PROVIDER_COLORS = {
   anthropic: { bg: 'linear-gradient(135deg, #d4a574, #b8956a)', color: '#1a1a1a' },
   google: { bg: 'linear-gradient(135deg, #4285f4, #00c896)', color: '#fff' },
   openrouter: { bg: 'linear-gradient(135deg, #6366f1, #8b5cf6)', color: '#fff' },
+  local: { bg: 'linear-gradient(135deg, #64748b, #334155)', color: '#fff' },
 };
 
 function Toggle({ on, onClick }) {
@@ -25,6 +26,7 @@ function ProviderCard({ provider, isActive, onSetActive, onRefresh, initData })
   const [testing, setTesting] = useState(false);
   const [testResult, setTestResult] = useState(null);
   const [selectedModel, setSelectedModel] = useState(provider.selected_model || '');
+  const [endpoint, setEndpoint] = useState(provider.endpoint || '');
 
   const colors = PROVIDER_COLORS[provider.name] || { bg: 'var(--bg-elevated)', color: 'var(--text-primary)' };
   const hasModels = provider.models && provider.models.length > 0;
@@ -79,6 +81,16 @@ function ProviderCard({ provider, isActive, onSetActive, onRefresh, initData })
     onRefresh();
   };
 
+  const saveEndpoint = async () => {
+    if (endpoint.trim() === (provider.endpoint || '')) return;
+    await fetch(`${API}/api/settings/providers/${provider.name}`, {
+      method: 'PUT',
+      headers,
+      body: JSON.stringify({ endpoint: endpoint.trim() })
+    });
+    onRefresh();
+  };
+
   const changeModel = async (model) => {
     setSelectedModel(model);
     await fetch(`${API}/api/ai/set-model`, {
@@ -171,6 +183,21 @@ function ProviderCard({ provider, isActive, onSetActive, onRefresh, initData })
             </div>
           </div>
 
+          {/* Свой OpenAI-совместимый сервер (llama.cpp, vLLM, Ollama) вместо API провайдера */}
+          <div style={{ marginBottom: 12 }}>
+            <span className="card-title" style={{ display: 'block', marginBottom: 6 }}>Endpoint (OpenAI API)</span>
+            <input
+              className="input"
+              placeholder={provider.name === 'local' ? 'http://llama:8080/v1' : 'по умолчанию — API провайдера'}
+              value={endpoint}
+              onChange={e => setEndpoint(e.target.value)}
+              onBlur={saveEndpoint}
+              onKeyDown={e => e.key === 'Enter' && saveEndpoint()}
+              style={{ fontSize: '0.82rem' }}
+              data-testid={`endpoint-input-${provider.name}`}
+            />
+          </div>
+
           {/* Model select — only if models loaded */}
           {hasModels ? (
             <div style={{ marginBottom: 12 }}>
@@ -235,6 +262,122 @@ function ProviderCard({ provider, isActive, onSetActive, onRefresh, initData })
   );
 }
 
+const STATS_PERIODS = [1, 7, 30];
+
+const formatMs = (ms) => (ms == null ? '—' : ms >= 1000 ? `${(ms / 1000).toFixed(1)} с` : `${ms} мс`);
+const formatRate = (rate) => (rate == null ? '—' : `${(rate * 100).toFixed(1)}%`);
+const formatUsd = (usd) => `$${(usd || 0).toFixed(usd >= 1 ? 2 : 4)}`;
+
+function CallStats({ initData }) {
+  const [days, setDays] = useState(7);
+  const [stats, setStats] = useState(null);
+  const [loading, setLoading] = useState(true);
+
+  const fetchStats = useCallback(async () => {
+    setLoading(true);
+    try {
+      const headers = initData ? { 'X-Telegram-Init-Data': initData } : {};
+      const r = await fetch(`${API}/api/ai/stats?days=${days}`, { headers });
+      const data = await r.json();
+      setStats(data.ok ? data : null);
+    } catch (e) {
+      console.error(e);
+    } finally {
+      setLoading(false);
+    }
+  }, [days, initData]);
+
+  useEffect(() => {
+    fetchStats();
+  }, [fetchStats]);
+
+  const daily = stats?.daily || [];
+  const maxCost = Math.max(...daily.map(d => d.cost_usd), 0);
+  const maxCalls = Math.max(...daily.map(d => d.calls), 0);
+
+  return (
+    <div className="card" style={{ marginBottom: 14 }} data-testid="ai-call-stats">
+      <div className="card-header">
+        <span className="card-title">Статистика вызовов</span>
+        <div style={{ display: 'flex', gap: 4 }}>
+          {STATS_PERIODS.map(p => (
+            <button
+              key={p}
+              className={`btn ${p === days ? 'btn-primary' : 'btn-secondary'}`}
+              style={{ padding: '4px 10px', fontSize: '0.78rem' }}
+              onClick={() => setDays(p)}
+              data-testid={`stats-period-${p}`}
+            >
+              {p} д
+            </button>
+          ))}
+        </div>
+      </div>
+
+      {loading && !stats ? (
+        <div style={{ display: 'flex', justifyContent: 'center', padding: 12 }}><span className="loading-spinner" /></div>
+      ) : !stats || stats.totals.calls === 0 ? (
+        <p style={{ color: 'var(--text-secondary)', fontSize: '0.82rem' }}>Вызовов за период нет.</p>
+      ) : (
+        <>
+          <div className="call-stats-totals">
+            <div><span className="call-stats-value">{stats.totals.calls}</span><span className="call-stats-label">попыток</span></div>
+            <div><span className="call-stats-value">{formatRate(stats.totals.error_rate)}</span><span className="call-stats-label">ошибок</span></div>
+            <div><span className="call-stats-value">{stats.totals.failovers}</span><span className="call-stats-label">failover</span></div>
+            <div><span className="call-stats-value">{formatUsd(stats.totals.cost_usd)}</span><span className="call-stats-label">расходы</span></div>
+          </div>
+
+          <div className="call-stats-subtitle">Расходы по дням</div>
+          <div className="call-stats-chart" data-testid="ai-cost-chart">
+            {daily.map(d => {
+              // Без цен (локальные модели) столбик — по числу попыток; красная часть — доля ошибок
+              const height = maxCost > 0 ? (d.cost_usd / maxCost) * 100 : (d.calls / maxCalls) * 100;
+              return (
+                <div key={d.day} className="call-stats-col" title={`${d.day}: ${formatUsd(d.cost_usd)}, ${d.calls} попыток, ошибок ${formatRate(d.error_rate)}`}>
+                  <div className="call-stats-bar" style={{ height: `${height}%` }} />
+                  {d.errors > 0 && (
+                    <div className="call-stats-bar error" style={{ height: `${(height * d.errors) / d.calls}%` }} />
+                  )}
+                  <span className="call-stats-day">{d.day.slice(8)}</span>
+                </div>
+              );
+            })}
+          </div>
+
+          <div className="call-stats-subtitle">Модели</div>
+          <div className="call-stats-table">
+            <div className="call-stats-row head">
+              <span>Модель</span><span>p50</span><span>p95</span><span>Ошибки</span><span>$</span>
+            </div>
+            {stats.models.map(m => (
+              <div key={`${m.provider}/${m.model}`} className="call-stats-row">
+                <span className="call-stats-model" title={`${m.provider} · ${m.calls} попыток`}>{m.provider} · {m.model || '—'}</span>
+                <span>{formatMs(m.p50_ms)}</span>
+                <span>{formatMs(m.p95_ms)}</span>
+                <span className={m.error_rate > 0.1 ? 'call-stats-bad' : ''}>{formatRate(m.error_rate)}</span>
+                <span>{formatUsd(m.cost_usd)}</span>
+              </div>
+            ))}
+          </div>
+
+          <div className="call-stats-subtitle">Ключи</div>
+          <div className="call-stats-table">
+            {stats.keys.map(k => (
+              <div key={`${k.provider}/${k.key_id}`} className="call-stats-row">
+                <span className="call-stats-model">{k.provider} · ключ #{k.key_index + 1}</span>
+                <span>{formatMs(k.p50_ms)}</span>
+                <span>{formatMs(k.p95_ms)}</span>
+                <span className={k.error_rate > 0.1 ? 'call-stats-bad' : ''}>{formatRate(k.error_rate)}</span>
+                <span>{k.calls}</span>
+              </div>
+            ))}
+          </div>
+        </>
+      )}
+    </div>
+  );
+}
+
 export default function ProvidersPage({ providers, settings, onRefresh, initData }) {
   const activeProvider = settings?.active_provider || '';
   const enabledCount = providers.filter(p => p.enabled).length;
@@ -257,6 +400,8 @@ export default function ProvidersPage({ providers, settings, onRefresh, initData
         </p>
       </div>
 
+      <CallStats initData={initData} />
+
       {providers.map(p => (
         <ProviderCard
           key={p.name}
@@ -1,4 +1,4 @@
-import React, { useState, useEffect, useCallback } from 'react';
+import React, { useState, useEffect, useCallback, useRef } from 'react';
 import { Flame, User, BarChart3, Calendar, Link2, Smartphone, RotateCcw, RefreshCw, Trash2, Lock, Unlock, AlertTriangle, Clock, ChevronDown, ChevronUp, Send, X, Image } from 'lucide-react';
 import ConfirmModal from '../components/ConfirmModal';
 
@@ -29,6 +29,15 @@ const DataRow = ({ label, value, code }) => (
 );
 
 // Статусы тикетов
+// Порядок как на сервере: подозрительные выше эскалированных, внутри — новые сверху
+const STATUS_ORDER = { suspicious: 0, escalated: 1 };
+function sortTickets(list) {
+  return [...list].sort((a, b) =>
+    (STATUS_ORDER[a.status] ?? 2) - (STATUS_ORDER[b.status] ?? 2) ||
+    (b.created_at || '').localeCompare(a.created_at || '') ||
+    b.id.localeCompare(a.id));
+}
+
 const TICKET_STATUSES = {
   open: { emoji: '💬', label: 'Открыт', color: 'info' },
   escalated: { emoji: '🔥', label: 'Эскалация', color: 'warning' },
@@ -46,18 +55,28 @@ export default function TicketsPage({ settings, initData }) {
   const [confirm, setConfirm] = useState({ open: false, action: null, data: null });
   const [actionMsg, setActionMsg] = useState('');
   const [filter, setFilter] = useState('all'); // all, escalated, suspicious
+  const [messages, setMessages] = useState({ ticketId: null, items: [], nextBefore: null, loading: false });
+  const [nextCursor, setNextCursor] = useState(null);
+  const [details, setDetails] = useState({ ticketId: null, ticket: null });
+  const syncToken = useRef(null);
 
   const headers = { 'Content-Type': 'application/json' };
   if (initData) headers['X-Telegram-Init-Data'] = initData;
 
-  const fetchTickets = useCallback(async () => {
+  // Список приходит страницами (after — курсор следующей) и без тяжёлых полей
+  const fetchTickets = useCallback(async (after = null) => {
     try {
       const reqHeaders = {};
       if (initData) reqHeaders['X-Telegram-Init-Data'] = initData;
 
-      const r = await fetch(`${API}/api/tickets/active`, { headers: reqHeaders });
+      const params = new URLSearchParams({ limit: '50' });
+      if (after) params.set('after', after);
+      const r = await fetch(`${API}/api/tickets/active?${params}`, { headers: reqHeaders });
       const data = await r.json();
-      setTickets(data.tickets || []);
+      const page = data.tickets || [];
+      setTickets(t => after ? [...t, ...page] : page);
+      setNextCursor(data.next_cursor || null);
+      if (data.sync_token) syncToken.current = data.sync_token;
     } catch (e) {
       console.error('Tickets fetch error:', e);
     } finally {
@@ -65,11 +84,103 @@ export default function TicketsPage({ settings, initData }) {
     }
   }, [initData]);
 
+  // Опрос: только изменения с прошлого токена (новые/изменённые и выпавшие тикеты)
+  const fetchChanges = useCallback(async () => {
+    if (!syncToken.current) return fetchTickets();
+    try {
+      const reqHeaders = {};
+      if (initData) reqHeaders['X-Telegram-Init-Data'] = initData;
+
+      let hasMore = true;
+      while (hasMore) {
+        const params = new URLSearchParams({ since: syncToken.current });
+        const r = await fetch(`${API}/api/tickets/changes?${params}`, { headers: reqHeaders });
+        if (r.status === 400) {
+          // Токен не принят — перечитываем список целиком
+          syncToken.current = null;
+          return fetchTickets();
+        }
+        const data = await r.json();
+        const changed = data.tickets || [];
+        const gone = new Set([...(data.removed || []), ...changed.map(t => t.id)]);
+        if (gone.size > 0) {
+          setTickets(list => sortTickets([...list.filter(t => !gone.has(t.id)), ...changed]));
+          setSelectedTicket(sel => sel && (data.removed || []).includes(sel.id) ? null : sel);
+        }
+        syncToken.current = data.sync_token;
+        hasMore = data.has_more;
+      }
+    } catch (e) {
+      console.error('Tickets changes error:', e);
+    }
+  }, [initData, fetchTickets]);
+
   useEffect(() => {
     fetchTickets();
-    const interval = setInterval(fetchTickets, 30000);
-    return () => clearInterval(interval);
-  }, [fetchTickets]);
+    // Push: событие по тикету -> забираем дельту. Опрос остаётся редким запасным вариантом
+    let source = null;
+    if (window.EventSource) {
+      const params = new URLSearchParams();
+      if (initData) params.set('init_data', initData);
+      source = new EventSource(`${API}/api/events/tickets?${params}`);
+      source.addEventListener('ticket', () => fetchChanges());
+      source.addEventListener('reset', () => { syncToken.current = null; fetchTickets(); });
+    }
+    const interval = setInterval(fetchChanges, source ? 60000 : 10000);
+    return () => {
+      clearInterval(interval);
+      if (source) source.close();
+    };
+  }, [initData, fetchTickets, fetchChanges]);
+
+  // Переписка грузится отдельно, страницами (before — курсор на более старые)
+  const fetchMessages = useCallback(async (ticketId, before = null) => {
+    setMessages(m => ({ ...m, ticketId, loading: true }));
+    try {
+      const reqHeaders = {};
+      if (initData) reqHeaders['X-Telegram-Init-Data'] = initData;
+
+      const params = new URLSearchParams({ limit: '30' });
+      if (before) params.set('before', before);
+      const r = await fetch(`${API}/api/tickets/${ticketId}/messages?${params}`, { headers: reqHeaders });
+      const data = await r.json();
+      const page = data.messages || [];
+      setMessages(m => m.ticketId !== ticketId ? m : {
+        ticketId,
+        items: before ? [...page, ...m.items] : page,
+        nextBefore: data.next_before || null,
+        loading: false,
+      });
+    } catch (e) {
+      console.error('Messages fetch error:', e);
+      setMessages(m => ({ ...m, loading: false }));
+    }
+  }, [initData]);
+
+  // Полная карточка (user_data, вложения) — только для выбранного тикета
+  const fetchDetails = useCallback(async (ticketId) => {
+    try {
+      const reqHeaders = {};
+      if (initData) reqHeaders['X-Telegram-Init-Data'] = initData;
+
+      const r = await fetch(`${API}/api/tickets/${ticketId}`, { headers: reqHeaders });
+      const data = await r.json();
+      if (data.ok) setDetails({ ticketId, ticket: data.ticket });
+    } catch (e) {
+      console.error('Ticket fetch error:', e);
+    }
+  }, [initData]);
+
+  const selectedId = selectedTicket?.id;
+  useEffect(() => {
+    if (selectedId) {
+      fetchMessages(selectedId);
+      fetchDetails(selectedId);
+    } else {
+      setMessages({ ticketId: null, items: [], nextBefore: null, loading: false });
+      setDetails({ ticketId: null, ticket: null });
+    }
+  }, [selectedId, fetchMessages, fetchDetails]);
 
   const sendReply = async (ticketId) => {
     if (!replyText.trim()) return;
@@ -85,7 +196,8 @@ export default function TicketsPage({ settings, initData }) {
       if (data.ok) {
         setReplyText('');
         setActionMsg('Ответ отправлен клиенту в Telegram');
-        fetchTickets();
+        fetchChanges();
+        fetchMessages(ticketId);
       } else {
         setActionMsg(data.error || 'Ошибка отправки');
       }
@@ -100,7 +212,7 @@ export default function TicketsPage({ settings, initData }) {
   const closeTicket = async (ticketId) => {
     try {
       await fetch(`${API}/api/tickets/${ticketId}/close`, { method: 'POST', headers });
-      fetchTickets();
+      fetchChanges();
       setSelectedTicket(null);
       setActionMsg('Тикет закрыт');
     } catch (e) {
@@ -111,7 +223,7 @@ export default function TicketsPage({ settings, initData }) {
   const removeTicket = async (ticketId) => {
     try {
       await fetch(`${API}/api/tickets/${ticketId}/remove`, { method: 'POST', headers });
-      fetchTickets();
+      fetchChanges();
       setSelectedTicket(null);
       setActionMsg('Тикет удалён');
     } catch (e) {
@@ -141,7 +253,7 @@ export default function TicketsPage({ settings, initData }) {
         });
         const result = await r.json();
         setActionMsg(result.message || (result.ok ? 'Готово' : 'Ошибка'));
-        if (result.ok) fetchTickets();
+        if (result.ok) fetchChanges();
       } catch {
         setActionMsg('Ошибка сети');
       }
@@ -163,7 +275,8 @@ export default function TicketsPage({ settings, initData }) {
     suspicious: tickets.filter(t => t.status === 'suspicious').length,
   };
 
-  const user = selectedTicket?.user_data?.user;
+  const selectedDetails = details.ticketId === selectedId ? details.ticket : null;
+  const user = selectedDetails?.user_data?.user;
   const uuid = user?.uuid || '';
   const isDisabled = (user?.status || '').toUpperCase() === 'DISABLED';
 
@@ -222,6 +335,8 @@ export default function TicketsPage({ settings, initData }) {
           {filteredTickets.map(ticket => {
             const status = TICKET_STATUSES[ticket.status] || TICKET_STATUSES.open;
             const isSuspicious = ticket.status === 'suspicious';
+            const full = selectedDetails && selectedDetails.id === ticket.id ? selectedDetails : ticket;
+            const chat = messages.ticketId === ticket.id && messages.items.length > 0 ? messages.items : (full.last_messages || []);
 
             return (
               <div
@@ -273,13 +388,21 @@ export default function TicketsPage({ settings, initData }) {
                       )}
                     </div>
 
+                    {/* Резюме диалога с AI (сжатые старые реплики) */}
+                    {full.conversation_summary && (
+                      <div className="ticket-reason">
+                        <strong>Резюме диалога с AI:</strong>
+                        <div style={{ whiteSpace: 'pre-wrap', marginTop: 4 }}>{full.conversation_summary}</div>
+                      </div>
+                    )}
+
                     {/* Прикреплённые файлы (скриншоты, ссылки) */}
-                    {ticket.attachments && ticket.attachments.length > 0 && (
+                    {full.attachments && full.attachments.length > 0 && (
                       <div className="ticket-attachments">
                         <div style={{ fontWeight: 600, fontSize: '0.82rem', marginBottom: 8, color: 'var(--text-secondary)' }}>
                           <Image size={14} style={{ marginRight: 4 }} /> Прикреплённые файлы:
                         </div>
-                        {ticket.attachments.map((att, i) => (
+                        {full.attachments.map((att, i) => (
                           <div key={i} className="attachment-item">
                             {att.type === 'photo' ? (
                               <a href={att.url} target="_blank" rel="noopener noreferrer">📷 Скриншот {i + 1}</a>
@@ -294,13 +417,23 @@ export default function TicketsPage({ settings, initData }) {
                     )}
 
                     {/* История переписки */}
-                    {(ticket.last_messages?.length > 0 || ticket.history?.length > 0) && (
+                    {chat.length > 0 && (
                       <div className="ticket-messages">
                         <div style={{ fontWeight: 600, fontSize: '0.85rem', marginBottom: 10, color: 'var(--text-secondary)', display: 'flex', alignItems: 'center', gap: 6 }}>
-                          💬 Переписка ({(ticket.history || ticket.last_messages || []).length} сообщений)
+                          💬 Переписка ({chat.length}{messages.nextBefore ? '+' : ''} сообщений)
                         </div>
                         <div className="messages-container">
-                          {(ticket.history || ticket.last_messages || []).slice(-15).map((msg, i) => (
+                          {messages.nextBefore && (
+                            <button
+                              className="btn btn-secondary btn-sm"
+                              disabled={messages.loading}
+                              onClick={() => fetchMessages(ticket.id, messages.nextBefore)}
+                              style={{ marginBottom: 8 }}
+                            >
+                              {messages.loading ? 'Загрузка...' : 'Показать более ранние'}
+                            </button>
+                          )}
+                          {chat.map((msg, i) => (
                             <div key={i} className={`chat-message ${msg.role}`}>
                               <div className="chat-message-header">
                                 <span className="chat-message-role">
@@ -322,7 +455,7 @@ export default function TicketsPage({ settings, initData }) {
                     )}
 
                     {/* Данные пользователя (если найден) */}
-                    {ticket.user_data?.user && !isSuspicious && (
+                    {full.user_data?.user && !isSuspicious && (
                       <div className="ticket-user-data">
                         <div
                           className="ticket-accordion-header"
@@ -412,6 +545,11 @@ export default function TicketsPage({ settings, initData }) {
               </div>
             );
           })}
+          {nextCursor && (
+            <button className="btn btn-secondary btn-sm" onClick={() => fetchTickets(nextCursor)} style={{ marginTop: 8 }}>
+              Показать ещё
+            </button>
+          )}
         </div>
       )}
 